@@ -14,6 +14,12 @@ class TransientSetting:
     apodization_method: str = 'Hanning'
     number_of_truncations: int = 0
     number_of_zero_fills: int = 1
+    # scans of a ser file transformed together with one multi-row FFT, 1 transforms one scan at a time
+    fft_batch_size: int = 1
+    # threads used by scipy.fft
+    fft_workers: int = 1
+    # processes used by ReadBruker_SolarixTransientMassSpectra to process the scans, 1 processes them in the reader thread
+    scan_jobs: int = 1
     
     def __post_init__(self):
         
@@ -125,6 +131,8 @@ class MassSpecPeakSetting:
 
     peak_max_prominence_percent :float = 0.1 # 1-100 % used for baseline detection
 
+    peak_interpolation_method :str = 'analytic' # 'analytic' closed-form apex and half height crossings or 'polyfit' (numpy.polyfit per peak)
+
     def __post_init__(self):
         
         # default to CH2
@@ -188,6 +196,11 @@ class CompoundSearchSettings:
 
     url_database: str = 'sqlite:///db/pnnl_lowres_gcms_compounds.sqlite'
     
+    # connections kept open by the process wide engine of url_database, and the extra ones opened under load
+    db_pool_size:int = 5
+
+    db_max_overflow:int = 10
+
     ri_search_range:float = 35
 
     rt_search_range:float = 1.0 #used for retention index calibration
@@ -288,6 +301,15 @@ class MolecularLookupDictSettings:
 
         self.db_jobs = 1
 
+        # max number of molecular formulas rows kept in memory before each bulk insert
+        self.bulk_insert_rows = 500000
+
+        # number of classes generated and inserted by each db_jobs worker task
+        self.db_classes_per_task = 20
+
+        # tasks submitted per db_jobs worker before waiting for results, bounds the memory of the parallel generation
+        self.db_tasks_in_flight = 2
+
         self.used_atom_valences = {'C': 4,
                             '13C': 4,
                             'H': 1,
@@ -324,6 +346,25 @@ class MolecularFormulaSearchSettings:
 
     db_jobs:int = 3
 
+    # connections kept open by the process wide engine of url_database, and the extra ones opened under load
+    db_pool_size:int = 5
+
+    db_max_overflow:int = 10
+
+    # PostgreSQL only, a new molecularformula table is created partitioned by heteroatom class (one partition per heteroAtoms_id),
+    # raises an Exception if the database already has a molecularformula table without partitions
+    db_partition_by_class:bool = False
+
+    # number of processes used to search the heteroatom classes, 1 runs the serial search
+    search_jobs:int = 1
+
+    # load the candidates from a memory mapped formula index built from the database instead of querying it for every classes chunk,
+    # the index (.npy and .json files) is written next to the sqlite database file, or to ./db for server databases
+    use_formula_index:bool = False
+
+    # memory budget in bytes of the process wide candidates cache shared by the mass spectra searched with the same settings, 0 disables it 
+    formula_cache_bytes:int = 536870912
+
     '''query setting'''
     ion_charge:int = -1
 
@@ -392,6 +433,12 @@ class MolecularFormulaSearchSettings:
     # 'distance', 'lowest', 'symmetrical','average' 'None'
     error_method:str = 'None'
 
+    # match all peaks against sorted candidate m/z arrays, only used when error_method does not update the ppm window
+    use_batch_search:bool = True
+
+    # when the ppm window moves, retrieve each peak candidates by nominal mass and mass defect bucket instead of the nominal mass overlay
+    use_mass_defect_buckets:bool = True
+
     mz_error_average:float = 0.0
 
     #used_atom_valences: {'C': 4, 'H':1, etc} = dataclasses.field(default_factory=dict)
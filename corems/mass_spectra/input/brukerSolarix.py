@@ -3,13 +3,52 @@ __date__ = "Oct 29, 2019"
 
 from threading import Thread
 from pathlib import Path
+import multiprocessing
 
 import h5py
+from numpy import empty
 
 from corems.encapsulation.constant import Labels
 from corems.mass_spectra.factory.LC_Class import LCMSBase
-from corems.encapsulation.factory.parameters import default_parameters
+from corems.encapsulation.factory.parameters import default_parameters, MSParameters
+from corems.transient.calc.TransientCalc import batch_magnitude_mode_ft
 from corems.transient.input.brukerSolarix import ReadBrukerSolarix
+from corems import chunks
+
+# lc reader of the scan processing worker process, its ser file is memory mapped once per process
+worker_state = {}
+
+def init_scan_processing_worker(reader_args, transient_settings, mass_spectrum_settings, ms_peak_settings):
+    
+    # same processing settings as the parent process
+    MSParameters.transient = transient_settings
+    MSParameters.mass_spectrum = mass_spectrum_settings
+    MSParameters.ms_peak = ms_peak_settings
+    
+    worker_state['lcms_reader'] = ReadBruker_SolarixTransientMassSpectra(*reader_args)
+
+def scan_processing_worker(scans_numbers):
+    
+    '''
+    processes the scans, returns compact centroid tables instead of the mass spectra objs:
+    (centroid table, baseline noise, baseline noise std, frequency domain, magnitude), 
+    the profile is only returned when it is kept or the peaks were not picked
+    '''
+    
+    lcms_reader = worker_state['lcms_reader']
+
+    results = list()
+
+    for mass_spec in lcms_reader.get_mass_spectra(scans_numbers):
+
+        if lcms_reader.keep_profile or not lcms_reader.auto_process:
+            profile = (mass_spec.freq_exp_profile, mass_spec.abundance_profile)
+        else:
+            profile = (empty(0), empty(0))
+        
+        results.append((mass_spec.get_centroid_table(), mass_spec._baselise_noise, mass_spec._baselise_noise_std) + profile)
+
+    return results
 
 class ReadBruker_SolarixTransientMassSpectra(Thread):
     
@@ -42,9 +81,16 @@ class ReadBruker_SolarixTransientMassSpectra(Thread):
 
         self.lcms = LCMSBase(d_directory_location, analyzer, instrument_label)
 
+        self.d_directory_location = d_directory_location
+        self.analyzer = analyzer
+        self.instrument_label = instrument_label
+
         self.auto_process = auto_process
         self.auto_noise = auto_noise
         self.keep_profile = keep_profile
+        
+        # one transient reader for all the scans, the ser file is memory mapped once
+        self._bruker_reader = None
     
     def get_scan_attr(self):
     
@@ -69,25 +115,42 @@ class ReadBruker_SolarixTransientMassSpectra(Thread):
 
         list_scans = sorted(list(dict_scan_rt_tic.keys()))
         
-        for scan_number in list_scans:
+        # MSParameters.transient.fft_batch_size scans are transformed together
+        scans_batches = list(chunks(list_scans, MSParameters.transient.fft_batch_size))
+        
+        if MSParameters.transient.scan_jobs > 1:
+            mass_spectra_batches = self.get_mass_spectra_parallel(scans_batches)
+        else:
+            mass_spectra_batches = (self.get_mass_spectra(scans_batch) for scans_batch in scans_batches)
+
+        for scans_batch, mass_spectra in zip(scans_batches, mass_spectra_batches):
             
-            mass_spec = self.get_mass_spectrum(scan_number)
+            for scan_number, mass_spec in zip(scans_batch, mass_spectra):
 
-            self.lcms.add_mass_spectrum(mass_spec)
+                self.lcms.add_mass_spectrum(mass_spec)
 
-            list_rt.append(dict_scan_rt_tic.get(scan_number)[0])
+                list_rt.append(dict_scan_rt_tic.get(scan_number)[0])
 
-            list_tic.append(dict_scan_rt_tic.get(scan_number)[1])
+                list_tic.append(dict_scan_rt_tic.get(scan_number)[1])
 
         self.lcms.retention_time = list_rt
         self.lcms.tic = list_tic
         self.lcms.scans_number = list_scans
         
-    def get_mass_spectrum(self, scan_number):
+    def get_bruker_reader(self):
+        
+        if self._bruker_reader is None:
+            self._bruker_reader = ReadBrukerSolarix(self.lcms.file_location)
         
-        bruker_reader = ReadBrukerSolarix(self.lcms.file_location)
+        return self._bruker_reader
+
+    def get_ser_scans(self):
+        '''random access to the time domain data of all the scans, see BrukerSerScans'''
+        return self.get_bruker_reader().get_ser_scans()
 
-        bruker_transient = bruker_reader.get_transient(scan_number)
+    def get_mass_spectrum(self, scan_number):
+        
+        bruker_transient = self.get_bruker_reader().get_transient(scan_number)
 
         mass_spec = bruker_transient.get_mass_spectrum(plot_result=False, 
                                                        auto_process=self.auto_process,
@@ -96,6 +159,70 @@ class ReadBruker_SolarixTransientMassSpectra(Thread):
 
         return mass_spec
 
+    def get_mass_spectra(self, scans_numbers):
+        
+        '''mass spectra of the scans, the transients are stacked and transformed by one multi-row FFT'''
+        
+        if len(scans_numbers) == 1:
+            
+            return [self.get_mass_spectrum(scans_numbers[0])]
+        
+        bruker_reader = self.get_bruker_reader()
+        
+        bruker_transients = [bruker_reader.get_transient(scan_number) for scan_number in scans_numbers]
+
+        frequency_domains = batch_magnitude_mode_ft(bruker_transients, workers=bruker_transients[0].parameters.fft_workers)
+
+        return [bruker_transient.get_mass_spectrum_from_frequency_domain(frequency_domain, magnitude, 
+                                                                         auto_process=self.auto_process,
+                                                                         keep_profile=self.keep_profile, 
+                                                                         auto_noise=self.auto_noise)
+                for bruker_transient, (frequency_domain, magnitude) in zip(bruker_transients, frequency_domains)]
+
+    def get_mass_spectra_parallel(self, scans_batches):
+        
+        '''
+        yields the mass spectra of each scans batch in order, 
+        the scans are processed by MSParameters.transient.scan_jobs worker processes
+        only the centroid tables are sent back, the mass spectra are recreated here
+        '''
+        
+        reader_args = (self.d_directory_location, self.analyzer, self.instrument_label, 
+                       self.auto_process, self.auto_noise, self.keep_profile)
+        
+        initargs = (reader_args, MSParameters.transient, MSParameters.mass_spectrum, MSParameters.ms_peak)
+
+        bruker_reader = self.get_bruker_reader()
+
+        pool = multiprocessing.Pool(MSParameters.transient.scan_jobs, initializer=init_scan_processing_worker, initargs=initargs)
+        
+        try:
+            
+            for scans_batch, results in zip(scans_batches, pool.imap(scan_processing_worker, scans_batches)):
+                
+                mass_spectra = list()
+                
+                for scan_number, (centroid_table, baselise_noise, baselise_noise_std, frequency_domain, magnitude) in zip(scans_batch, results):
+                    
+                    # the transient only provides the parameters, its data is not read
+                    bruker_transient = bruker_reader.get_transient(scan_number)
+
+                    mass_spec = bruker_transient.get_mass_spectrum_from_frequency_domain(frequency_domain, magnitude, auto_process=False)
+
+                    if self.auto_process:
+                        mass_spec.add_mspeaks_from_centroid_table(centroid_table, baselise_noise, baselise_noise_std)
+
+                    mass_spectra.append(mass_spec)
+
+                yield mass_spectra
+            
+            pool.close()
+            pool.join()
+        
+        finally:
+            
+            pool.terminate()
+
     def run(self):
         '''creates the lcms obj'''
         self.import_mass_spectra()
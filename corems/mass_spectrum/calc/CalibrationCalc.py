@@ -170,4 +170,5 @@ class FreqDomain_Calibration:
             for mspeak in self.mass_spectrum[start_index:final_index]:
                 mspeak.mz_cal = f_to_mz(mspeak.freq_exp, A, B, C, 0)
         
-        self.mass_spectrum.is_calibrated = True    
\ No newline at end of file
+        self.mass_spectrum.is_calibrated = True
+        self.mass_spectrum.clear_mz_index()    
\ No newline at end of file
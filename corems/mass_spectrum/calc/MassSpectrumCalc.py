@@ -4,6 +4,7 @@ __date__ = "Jun 27, 2019"
 from numpy import power, multiply, sqrt, multiply, array, mean
 from corems.mass_spectrum.calc.NoiseCalc import NoiseThresholdCalc
 from corems.mass_spectrum.calc.PeakPicking import PeakPicking
+from corems.molecular_formula.calc.MolecularFormulaCalc import MolecularFormulaScores
 
 class MassSpecCalc(PeakPicking, NoiseThresholdCalc ):
     '''
@@ -43,6 +44,13 @@ class MassSpecCalc(PeakPicking, NoiseThresholdCalc ):
             return i, j, total_percent, total_relative_abundance
         
         
+    def score_molecular_formulas(self):
+        '''calculates the confidence scores of all the assigned molecular formulas at once'''
+        molecular_formulas = [mf for mspeak in self.mspeaks for mf in mspeak.molecular_formulas]
+
+        MolecularFormulaScores.calc(molecular_formulas, self.molecular_search_settings.mz_error_score_weight, 
+                                    self.molecular_search_settings.isotopologue_score_weight)
+        
     def resolving_power_calc(self, B, T):
         '''
         low pressure limits, 
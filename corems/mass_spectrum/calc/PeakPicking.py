@@ -3,7 +3,8 @@
 @date: Jun 27, 2019
 '''
 
-from numpy import hstack, inf, isnan, poly1d, polyfit, where
+from numpy import (absolute, array, errstate, flatnonzero, hstack, inf, int64, isfinite, isnan, maximum, minimum, nanmax,
+                   poly1d, polyfit, searchsorted, where)
 from corems.encapsulation.constant import Labels
 
 class PeakPicking:
@@ -86,6 +87,10 @@ class PeakPicking:
                the peak need to be resolved at least at the half-maximum magnitude,
                otherwise, the combined full width at half maximum is used to calculate resolving power'''
 
+            if self.mspeaks_settings.peak_interpolation_method == 'analytic':
+                
+                return self.calculate_resolving_powers(intes, massa, array([current_index]))[0]
+
             peak_height = intes[current_index]
             target_peak_height = peak_height/2
 
@@ -161,10 +166,8 @@ class PeakPicking:
 
         len_abundance = len(abund)
         
-        max_abundance = max(abund)
+        max_abundance = nanmax(abund)
         
-        peak_height_diff = lambda hi, li : ((abund[hi] - abund[li]) / max_abundance )*100
-
         abundance_threshold, factor = self.get_threshold(abund)
         #print(abundance_threshold, factor)
         # find indices of all peaks
@@ -183,7 +186,71 @@ class PeakPicking:
         # noise threshold
         if indexes.size and abundance_threshold is not None:
             indexes = indexes[abund[indexes]/factor >= abundance_threshold]
+        
+        if not indexes.size:
+            return
+
+        interpolation_method = self.mspeaks_settings.peak_interpolation_method
+
+        if interpolation_method == 'polyfit':
+            
+            self.calc_centroid_per_apex(mass, abund, freq, indexes, max_abundance)
+            return
+        
+        elif interpolation_method != 'analytic':
+            
+            raise Exception("%s interpolation method was not implemented, please use 'analytic' or 'polyfit'" % interpolation_method)
+
+        # all apexes are processed at once, same results as the per apex methods 
+        # check_prominence, find_apex_fit_quadratic, use_the_max and calculate_resolving_power
+        start_indexes, final_indexes = self.find_minima_indexes(indexes, abund, len_abundance)
+
+        with errstate(divide='ignore', invalid='ignore'):
+            
+            prominence = minimum(((abund[indexes] - abund[start_indexes]) / max_abundance )*100, 
+                                 ((abund[indexes] - abund[final_indexes]) / max_abundance )*100)
+        
+        prominent = prominence > self.mspeaks_settings.peak_min_prominence_percent
+
+        indexes, start_indexes, final_indexes = indexes[prominent], start_indexes[prominent], final_indexes[prominent]
+
+        if self.label == Labels.simulated_profile: 
+            
+            mz_exp_centroid = mass[indexes]
+            freqs_centr = [None] * len(indexes)
+        
+        else:
+            
+            mz_exp_centroid = self.fit_quadratic_apexes(mass, abund, indexes)
+
+            if self.label == Labels.bruker_frequency or self.label == Labels.midas_frequency:
+                
+                freqs_centr = self.fit_quadratic_apexes(freq, abund, indexes, nominal_check=False)
+            
+            else:
+                
+                freqs_centr = [None] * len(indexes)
+
+        peaks_resolving_power = self.calculate_resolving_powers(abund, mass, indexes)
+        
+        s2n = abund[indexes]/self.baselise_noise_std
+
+        for i, current_index in enumerate(indexes): 
             
+            if mz_exp_centroid[i]:
+                
+                peak_indexes = (start_indexes[i], current_index, final_indexes[i])
+                
+                self.add_mspeak(self.polarity, mz_exp_centroid[i], abund[current_index] , peaks_resolving_power[i], s2n[i], peak_indexes, exp_freq=freqs_centr[i], ms_parent=self)
+    
+    def calc_centroid_per_apex(self, mass, abund, freq, indexes, max_abundance):
+        
+        '''one apex at a time, numpy.polyfit interpolation'''
+        
+        len_abundance = len(abund)
+        
+        peak_height_diff = lambda hi, li : ((abund[hi] - abund[li]) / max_abundance )*100
+        
         for current_index in indexes: 
             
             if self.label == Labels.simulated_profile: 
@@ -204,8 +271,102 @@ class PeakPicking:
                     peak_resolving_power = self.calculate_resolving_power( abund, mass, current_index)
                     s2n = intes_centr/self.baselise_noise_std
                     self.add_mspeak(self.polarity, mz_exp_centroid, abund[current_index] , peak_resolving_power, s2n, peak_indexes, exp_freq=freq_centr, ms_parent=self)
+
+    def find_minima_indexes(self, apex_indexes, abundance, len_abundance):
+        
+        '''vectorized find_minima, returns the start and final indexes of all apexes'''
+        
+        # points where the abundance rises to the right (a[k] < a[k+1]) and to the left (a[k] < a[k-1])
+        rising_right = flatnonzero(abundance[:-1] < abundance[1:])
+        rising_left = flatnonzero(abundance[1:] < abundance[:-1]) + 1
+        
+        # next rising point to the right and previous rising point to the left of each apex,
+        # find_minima stops walking at len_abundance - 2 and 1
+        final_indexes = hstack((rising_right, len_abundance - 2))[searchsorted(rising_right, apex_indexes, side='right')]
+        final_indexes = minimum(final_indexes, len_abundance - 2)
+
+        start_indexes = hstack((1, rising_left))[searchsorted(rising_left, apex_indexes, side='left')]
+        start_indexes = maximum(start_indexes, 1)
+
+        # find_minima stops right away at the edges
+        at_edge = (apex_indexes == 1) | (apex_indexes == len_abundance - 2)
+        
+        return where(at_edge, apex_indexes, start_indexes), where(at_edge, apex_indexes, final_indexes)
+
+    def fit_quadratic_apexes(self, x, abund, apex_indexes, nominal_check=True):
+        
+        '''closed form apex of the parabola through the three most abundant datapoints of each apex,
+           falls back to the apex x value as find_apex_fit_quadratic does'''
+        
+        x0, x1, x2 = x[apex_indexes - 1], x[apex_indexes], x[apex_indexes + 1]
+        y0, y1, y2 = abund[apex_indexes - 1], abund[apex_indexes], abund[apex_indexes + 1]
+        
+        with errstate(divide='ignore', invalid='ignore'):
+            
+            # centered on the apex to avoid the loss of precision at high m/z
+            u0, u2 = x0 - x1, x2 - x1
+            v0, v2 = y0 - y1, y2 - y1
+
+            a = (v0/u0 - v2/u2) / (u0 - u2)
+            b = v0/u0 - a * u0
+
+            calculated = x1 - b/(2*a)
+
+        finite = isfinite(calculated)
+        calculated_int = where(finite, calculated, 0).astype(int64)
+        
+        if nominal_check:
+            keep_datapoint = ~finite | (calculated < 1) | (calculated_int != x1.astype(int64))
+        else:
+            # find_apex_fit_quadratic compares the frequency apex to the datapoint itself
+            keep_datapoint = ~finite | (calculated < 1) | (calculated_int != x1)
+
+        return where(keep_datapoint, x1, calculated)
+
+    def find_half_height_indexes(self, abund, apex_indexes, right=True):
+        
+        '''first datapoint below half of the apex abundance walking away from each apex, stops at the data edges'''
+        
+        target_peak_height = abund[apex_indexes]/2
+        
+        step = 1 if right else -1
+        edge_index = len(abund) - 1 if right else 0
+
+        indexes = apex_indexes.copy()
+        
+        active = flatnonzero(abund[indexes] >= target_peak_height)
+        
+        # all apexes walk together, each step only checks the peaks that are still above half height
+        while active.size:
+
+            active = active[indexes[active] != edge_index]
             
+            indexes[active] += step
+
+            active = active[abund[indexes[active]] >= target_peak_height[active]]
+
+        return indexes
+
+    def calculate_resolving_powers(self, intes, massa, apex_indexes):
         
+        '''vectorized calculate_resolving_power'''
+
+        index_minus = self.find_half_height_indexes(intes, apex_indexes, right=False)
+        index_plus = self.find_half_height_indexes(intes, apex_indexes, right=True)
+
+        with errstate(divide='ignore', invalid='ignore'):
+            
+            # line through the datapoints at each side of the half height crossing
+            y_intercept = intes[index_minus] + ((intes[index_minus+1] - intes[index_minus])/2)
+            slope = (intes[index_minus+1] - intes[index_minus]) / (massa[index_minus+1] - massa[index_minus])
+            massa1 = massa[index_minus] + (y_intercept - intes[index_minus]) / slope
+
+            y_intercept = intes[index_plus - 1] + ((intes[index_plus] - intes[index_plus - 1])/2)
+            slope = (intes[index_plus] - intes[index_plus - 1]) / (massa[index_plus] - massa[index_plus - 1])
+            massa2 = massa[index_plus - 1] + (y_intercept - intes[index_plus - 1]) / slope
+
+            return massa[apex_indexes]/absolute(massa2-massa1)
+
     def get_threshold(self, intes):
         
         threshold_method = self.settings.threshold_method
@@ -242,6 +403,19 @@ class PeakPicking:
         
         else:    
             
+            if self.mspeaks_settings.peak_interpolation_method == 'analytic':
+                
+                apex_indexes = array([current_index])
+
+                mz_exp_centroid = self.fit_quadratic_apexes(mass, abund, apex_indexes)[0]
+                
+                if self.label == Labels.bruker_frequency or self.label == Labels.midas_frequency:
+                    freq_centr = self.fit_quadratic_apexes(freq, abund, apex_indexes, nominal_check=False)[0]
+                else:
+                    freq_centr = None
+
+                return mz_exp_centroid, freq_centr, abund[current_index], peak_indexes
+
             # fit parabola to three most abundant datapoints
             list_mass = [mass[current_index - 1], mass[current_index], mass[current_index +1]]
             list_y = [abund[current_index - 1],abund[current_index], abund[current_index +1]]
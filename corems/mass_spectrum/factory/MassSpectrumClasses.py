@@ -3,12 +3,13 @@ from copy import deepcopy
 
 
 #from matplotlib import rcParamsDefault, rcParams
-from numpy import array, power, float64, where
+from numpy import array, argmax, argsort, flatnonzero, int64, isnan, ones, power, float64, searchsorted, sort, unique, where
 
 from corems.mass_spectrum.calc.MassSpectrumCalc import MassSpecCalc
 from corems.mass_spectrum.calc.KendrickGroup import KendrickGrouping
 from corems.encapsulation.constant import Labels
 from corems.ms_peak.factory.MSPeakClasses import ICRMassPeak as MSPeak
+from corems.ms_peak.factory.MSPeakTable import MSPeakTable
 from corems.encapsulation.factory.parameters import MSParameters
 from corems.encapsulation.input.parameter_from_json import load_and_set_parameters_ms
 
@@ -63,7 +64,12 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
 
         # objects created after process_mass_spec() function
         self._mspeaks = list()
+        # centroid values of the mspeaks, the MSPeak objs are views over its rows
+        self._peak_table = MSPeakTable()
+        self._mspeaks_rows = None
         self._dict_nominal_masses_indexes = dict()
+        # sorted m/z index, built on demand by get_mz_index()
+        self._mz_index = None
         self._baselise_noise = 0.001
         self._baselise_noise_std = 0.001
         self._dynamic_range = None
@@ -130,10 +136,40 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
                 len(self._mspeaks),
                 exp_freq=exp_freq,
                 ms_parent=ms_parent,
+                peak_table=self._peak_table,
         )
 
         self._mspeaks.append(mspeak)
 
+    def get_centroid_table(self):
+        '''centroid values of the mspeaks as a dict of columns, a compact copy of the peak table'''
+        rows = self.get_mspeaks_rows()
+
+        return {column: getattr(self._peak_table, column)[rows] for column in MSPeakTable.centroid_columns}
+
+    def add_mspeaks_from_centroid_table(self, centroid_table, baselise_noise, baselise_noise_std):
+        '''recreates the mspeaks of get_centroid_table, i.e. of a mass spectrum processed by another process'''
+        self._baselise_noise, self._baselise_noise_std = baselise_noise, baselise_noise_std
+        
+        self._mspeaks = list()
+        self._peak_table = MSPeakTable(capacity=len(centroid_table.get('mz_exp')))
+
+        for (ion_charge, mz_exp, abundance, resolving_power, signal_to_noise, 
+             start_index, apex_index, final_index, freq_exp) in zip(*(centroid_table.get(column).tolist() for column in MSPeakTable.centroid_columns)):
+            
+            # missing frequencies are stored as nan
+            exp_freq = None if isnan(freq_exp) else freq_exp
+            
+            self.add_mspeak(ion_charge, mz_exp, abundance, resolving_power, signal_to_noise, 
+                            (start_index, apex_index, final_index), exp_freq=exp_freq, ms_parent=self)
+
+        self.reset_indexes()
+
+        if self.mspeaks:
+            self._dynamic_range = self.max_abundance / self.min_abundance
+        else:
+            self._dynamic_range = 0
+
     def _set_parameters_objects(self, d_params):
 
         self._calibration_terms = (
@@ -274,17 +310,25 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
         else:
             raise Exception( "calibrated array (%i) is not of the same size of the data (%i)" % (len(mz_cal_list),  len(self.mz_exp_profile)))    
 
+    def get_mspeaks_rows(self):
+        '''return the peak table rows of the current mspeaks, rebuilt when mspeaks is reassigned or grows'''
+        if self._mspeaks_rows is None or self._mspeaks_rows[0] is not self.mspeaks or len(self._mspeaks_rows[1]) != len(self.mspeaks):
+
+            self._mspeaks_rows = (self.mspeaks, array([mspeak._row for mspeak in self.mspeaks], dtype=int64))
+
+        return self._mspeaks_rows[1]
+
     @property
     def mz_cal(self):
-        return array([mspeak.mz_cal for mspeak in self.mspeaks])
+        return self._peak_table.mz_cal[self.get_mspeaks_rows()]
 
     @mz_cal.setter
     def mz_cal(self, mz_cal_list):
 
             if  len(mz_cal_list) == len(self.mspeaks):
                 self.is_calibrated = True
-                for index, mz_cal in enumerate(mz_cal_list):
-                    self.mspeaks[index].mz_cal = mz_cal
+                self._peak_table.mz_cal[self.get_mspeaks_rows()] = array(mz_cal_list, dtype=float64)
+                self.clear_mz_index()
             else: 
                 raise Exception( "calibrated array (%i) is not of the same size of the data (%i)" % (len(mz_cal_list),  len(self._mspeaks)))    
 
@@ -292,14 +336,8 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
     def mz_exp(self):
 
         self.check_mspeaks()
-
-        if self.is_calibrated:
-
-            return array([mspeak.mz_cal for mspeak in self.mspeaks])
-
-        else:
-
-            return array([mspeak.mz_exp for mspeak in self.mspeaks])
+        # mz_cal for calibrated peaks, same as MSPeak.mz_exp
+        return self._peak_table.mz(self.get_mspeaks_rows())
 
     @property
     def mz_exp_profile(self): return self._mz_exp
@@ -316,21 +354,21 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
     @property
     def abundance(self):
         self.check_mspeaks()
-        return array([mspeak.abundance for mspeak in self.mspeaks])
+        return self._peak_table.abundance[self.get_mspeaks_rows()]
 
     def freq_exp(self):
         self.check_mspeaks()
-        return array([mspeak.freq_exp for mspeak in self.mspeaks])
+        return self._peak_table.freq_exp[self.get_mspeaks_rows()]
 
     @property
     def resolving_power(self):
         self.check_mspeaks()
-        return array([mspeak.resolving_power for mspeak in self.mspeaks])
+        return self._peak_table.resolving_power[self.get_mspeaks_rows()]
 
     @property
     def signal_to_noise(self):
         self.check_mspeaks()
-        return array([mspeak.signal_to_noise for mspeak in self.mspeaks])
+        return self._peak_table.signal_to_noise[self.get_mspeaks_rows()]
 
     @property
     def nominal_mz(self):
@@ -346,42 +384,42 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
     def get_mz_and_abundance_peaks_tuples(self):
 
         self.check_mspeaks()
-        return [(mspeak.mz_exp, mspeak.abundance) for mspeak in self.mspeaks]
+        return list(zip(self.mz_exp.tolist(), self.abundance.tolist()))
 
     @property
     def kmd(self):
         self.check_mspeaks()
-        return array([mspeak.kmd for mspeak in self.mspeaks])
+        return self._peak_table.kmd[self.get_mspeaks_rows()]
 
     @property
     def kendrick_mass(self):
         self.check_mspeaks()
-        return array([mspeak.kendrick_mass for mspeak in self.mspeaks])
+        return self._peak_table.kendrick_mass[self.get_mspeaks_rows()]
 
     @property
     def max_mz_exp(self):
-        return max([mspeak.mz_exp for mspeak in self.mspeaks])
+        return self.mz_exp.max()
 
     @property
     def min_mz_exp(self):
-        return min([mspeak.mz_exp for mspeak in self.mspeaks])
+        return self.mz_exp.min()
 
     @property
     def max_abundance(self):
         
-        return max([mspeak.abundance for mspeak in self.mspeaks])
+        return self.abundance.max()
 
     @property
     def max_signal_to_noise(self):
-        return max([mspeak.signal_to_noise for mspeak in self.mspeaks])
+        return self.signal_to_noise.max()
 
     @property
     def most_abundant_mspeak(self):
-        return max(self.mspeaks, key=lambda m: m.abundance)
+        return self.mspeaks[argmax(self.abundance)]
 
     @property
     def min_abundance(self):
-        return min([mspeak.abundance for mspeak in self.mspeaks])
+        return self.abundance.min()
 
     # takes too much cpu time 
     @property
@@ -455,8 +493,19 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
         for i in indexes: self.mspeaks[i].clear_molecular_formulas()
 
     def filter_by_index(self, list_indexes):
+        '''removes the mspeaks at list_indexes'''
+        indexes = array(list(list_indexes), dtype=int64)
+        indexes = indexes[(indexes >= 0) & (indexes < len(self.mspeaks))]
+
+        keep = ones(len(self.mspeaks), dtype=bool)
+        keep[indexes] = False
+
+        self.filter_by_mask(keep)
 
-        self.mspeaks = [self.mspeaks[i] for i in range(len(self.mspeaks)) if i not in list_indexes]
+    def filter_by_mask(self, keep):
+        '''keeps the mspeaks where the boolean array keep is True'''
+        mspeaks = self.mspeaks
+        self.mspeaks = [mspeaks[i] for i in flatnonzero(keep)]
 
         for i, mspeak in  enumerate(self.mspeaks): mspeak.index = i
 
@@ -465,8 +514,8 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
     def filter_by_mz(self, min_mz, max_mz):
 
         self.check_mspeaks_warning()
-        indexes = [index for index, mspeak in enumerate(self.mspeaks) if min_mz <= mspeak.mz_exp <= max_mz]
-        self.filter_by_index(indexes)
+        mz_exp = self._peak_table.mz(self.get_mspeaks_rows())
+        self.filter_by_mask(~((min_mz <= mz_exp) & (mz_exp <= max_mz)))
 
     def filter_by_s2n(self, min_s2n, max_s2n=False):
 
@@ -475,16 +524,16 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
             max_s2n = self.max_signal_to_noise
 
         self.check_mspeaks_warning()
-        indexes = [index for index, mspeak in enumerate(self.mspeaks) if min_s2n <= mspeak.signal_to_noise <= max_s2n ]
-        self.filter_by_index(indexes)
+        signal_to_noise = self._peak_table.signal_to_noise[self.get_mspeaks_rows()]
+        self.filter_by_mask(~((min_s2n <= signal_to_noise) & (signal_to_noise <= max_s2n)))
 
     def filter_by_abundance(self, min_abund, max_abund=False):
 
         self.check_mspeaks_warning()
         if not max_abund:
             max_abund = self.max_abundance
-        indexes = [index for index, mspeak in enumerate(self.mspeaks) if min_abund <= mspeak.abundance <= max_abund]
-        self.filter_by_index(indexes)
+        abundance = self._peak_table.abundance[self.get_mspeaks_rows()]
+        self.filter_by_mask(~((min_abund <= abundance) & (abundance <= max_abund)))
 
     def filter_by_max_resolving_power(self, B, T):
 
@@ -492,8 +541,9 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
 
         self.check_mspeaks_warning()
 
-        indexes_to_remove = [index for index, mspeak in enumerate(self.mspeaks) if  mspeak.resolving_power >= rpe(mspeak.mz_exp,mspeak.ion_charge)]
-        self.filter_by_index(indexes_to_remove)
+        rows = self.get_mspeaks_rows()
+        rpe_values = rpe(self._peak_table.mz(rows), self._peak_table.ion_charge[rows])
+        self.filter_by_mask(~(self._peak_table.resolving_power[rows] >= rpe_values))
 
     def filter_by_min_resolving_power(self, B, T):
 
@@ -501,8 +551,9 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
 
         self.check_mspeaks_warning()
 
-        indexes_to_remove = [index for index, mspeak in enumerate(self.mspeaks) if  mspeak.resolving_power <= rpe(mspeak.mz_exp,mspeak.ion_charge)]
-        self.filter_by_index(indexes_to_remove)
+        rows = self.get_mspeaks_rows()
+        rpe_values = rpe(self._peak_table.mz(rows), self._peak_table.ion_charge[rows])
+        self.filter_by_mask(~(self._peak_table.resolving_power[rows] <= rpe_values))
 
     def filter_by_noise_threshold(self):
         
@@ -510,13 +561,14 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
         
         self.check_mspeaks_warning()
         
-        indexes_to_remove = [index for index, mspeak in enumerate(self.mspeaks) if  mspeak.abundance <= threshold]
-        self.filter_by_index(indexes_to_remove)
+        abundance = self._peak_table.abundance[self.get_mspeaks_rows()]
+        self.filter_by_mask(~(abundance <= threshold))
 
     
     def find_peaks(self):
         """needs to clear previous results from peak_picking"""
         self._mspeaks = list()
+        self._peak_table = MSPeakTable()
         """then do peak picking"""
 
         self.do_peak_picking()
@@ -527,9 +579,7 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
 
         self.parameters.ms_peak.kendrick_base = kendrick_dict_base
 
-        for mspeak in self.mspeaks:
-
-            mspeak.change_kendrick_base(kendrick_dict_base)
+        self._peak_table.set_kendrick_base(self.get_mspeaks_rows(), kendrick_dict_base)
 
     def get_nominal_mz_first_last_indexes(self, nominal_mass):
 
@@ -589,23 +639,54 @@ class MassSpecBase(MassSpecCalc, KendrickGrouping):
         # indexes = (i for i in range(len(self.mspeaks)) if min_mz_to_look <= self.mspeaks[i].mz_exp <= max_mz_to_look)
         # return indexes
 
+    def clear_mz_index(self):
+        '''needs to be called every time the mspeaks m/z values change (filters and calibration)'''
+        self._mz_index = None
+
+    def get_mz_index(self):
+
+        '''return the mspeaks m/z sorted in ascending order and the mspeaks indexes for each sorted m/z,
+           the index is built once and reused until clear_mz_index() is called'''
+        if self._mz_index is None:
+
+            mz_exp = self._peak_table.mz(self.get_mspeaks_rows())
+            mspeaks_indexes = argsort(mz_exp, kind='mergesort')
+
+            self._mz_index = (mz_exp[mspeaks_indexes], mspeaks_indexes)
+
+        return self._mz_index
+
+    def get_mz_range_indexes(self, min_mzs, max_mzs):
+
+        '''return, for each min_mz <= m/z <= max_mz window, the mspeaks indexes inside it in ascending index order
+           min_mzs and max_mzs can be arrays, all windows are located at once with searchsorted'''
+        mz_sorted, mspeaks_indexes = self.get_mz_index()
+
+        first_indexes = searchsorted(mz_sorted, min_mzs, side='left')
+        last_indexes = searchsorted(mz_sorted, max_mzs, side='right')
+
+        return [sort(mspeaks_indexes[first:last]) for first, last in zip(first_indexes, last_indexes)]
+
     def _set_nominal_masses_start_final_indexes(self):
 
         '''return ms peaks objs indexes(start and end) on the mass spectrum for all nominal masses'''
+        self.clear_mz_index()
+
         dict_nominal_masses_indexes ={}
 
-        all_nominal_masses = set(i.nominal_mz_exp for i in self.mspeaks)
+        # same windows as get_nominal_mass_indexes(), located on the sorted m/z index
+        mz_sorted, mspeaks_indexes = self.get_mz_index()
 
-        for nominal_mass in all_nominal_masses:
+        all_nominal_masses = unique(mz_sorted.astype(int64))
+
+        first_positions = searchsorted(mz_sorted, all_nominal_masses - 0.1, side='left')
+        last_positions = searchsorted(mz_sorted, all_nominal_masses + 1.1, side='right')
 
-            indexes = self.get_nominal_mass_indexes(nominal_mass)
+        for nominal_mass, first_position, last_position in zip(all_nominal_masses, first_positions, last_positions):
 
-            defaultvalue = None
-            first = last = next(indexes, defaultvalue)
-            for last in indexes:
-                pass
+            indexes = mspeaks_indexes[first_position:last_position]
 
-            dict_nominal_masses_indexes[nominal_mass] = (first, last)
+            dict_nominal_masses_indexes[int(nominal_mass)] = (int(indexes.min()), int(indexes.max()))
 
         self._dict_nominal_masses_indexes = dict_nominal_masses_indexes
 
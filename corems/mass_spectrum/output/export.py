@@ -389,6 +389,9 @@ class HighResMassSpecExport(Thread):
         
         if selected_score_method in score_methods:
 
+            # confidence scores of all formulas calculated at once, used by the prob_score and the export columns
+            mass_spectrum.score_molecular_formulas()
+
             for index, ms_peak in enumerate(mass_spectrum):
                 
                 # print(ms_peak.mz_exp)
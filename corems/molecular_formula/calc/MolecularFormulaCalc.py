@@ -1,8 +1,11 @@
 __author__ = "Yuri E. Corilo"
 __date__ = "Jun 24, 2019"
 
+import threading
+from collections import OrderedDict
+
 from IsoSpecPy import IsoSpecPy
-from numpy import isnan, power, exp, nextafter
+from numpy import absolute, array, bincount, clip, errstate, isnan, power, exp, nextafter, flatnonzero, float64, int64, unique, zeros
 from pandas import DataFrame
 from scipy.stats import pearsonr, spearmanr, kendalltau
 
@@ -13,6 +16,9 @@ from corems.molecular_id.calc.SpectralSimilarity import SpectralSimilarity
 
 class MolecularFormulaCalc:
     
+    # MolecularFormula is slotted
+    __slots__ = ()
+
     def _calc_resolving_power_low_pressure(self, B, T):
         '''
         ## Parameters
@@ -90,8 +96,6 @@ class MolecularFormulaCalc:
               
         if self._mspeak_parent.mz_exp:
             
-            self._assignment_mass_error = ((self.mz_calc - self._mspeak_parent.mz_exp)/self.mz_calc)*multi_factor
-
             return ((self.mz_calc - self._mspeak_parent.mz_exp)/self.mz_calc)*multi_factor
         
         else:
@@ -386,25 +390,149 @@ class MolecularFormulaCalc:
         # updated it to reflect min possible mass peak abundance
         cut_off_to_IsoSpeccPy = 1-(1/ms_dynamic_range)
         
-        #print("cut_off_to_IsoSpeccPy", cut_off_to_IsoSpeccPy, current_abundance, min_abundance, ms_dynamic_range)
-        #print(cut_off_to_IsoSpeccPy)
-        atoms_labels = (atom for atom in formula_dict.keys() if atom != Labels.ion_type and atom != 'H')
-       
+        pattern = IsotopologuePatterns.get_pattern(formula_dict, cut_off_to_IsoSpeccPy)
+        
+        # check if monoisotopic is being returned
+        if pattern.index_mono is not None:
+            
+            # calculate ratio iso/mono
+            probs = pattern.probs / pattern.probs[pattern.index_mono]
+            
+            for index in flatnonzero(current_abundance * probs > min_abundance):
+                
+                # skip the monoisotopic
+                if index == pattern.index_mono: continue
+                
+                yield (pattern.formula_dict(index, formula_dict), probs[index])
+            #return zip(new_formulas, probs )
+    
+        #else:
+        #    return []    
+    
+
+class IsotopologuePattern:
+    
+    '''
+    IsoSpec fine structure of one elemental composition (hydrogen is not included)
+    
+    Attributes
+    ----------
+    masses : numpy array (float64)
+        mass of each isotopologue
+    probs : numpy array (float64)
+        probability of each isotopologue
+    isotopes_labels : tuple(str)
+        isotopes labels, columns of the isotopes_count matrix
+    isotopes_count : numpy array (int64)
+        number of atoms of each isotope label, one row per isotopologue
+    index_mono : int
+        row of the monoisotopic composition, None if it is not inside the pattern
+    '''
+    
+    __slots__ = ('masses', 'probs', 'isotopes_labels', 'isotopes_count', 'index_mono')
+
+    def __init__(self, masses, probs, isotopes_labels, isotopes_count, index_mono):
+        
+        self.masses = masses
+        self.probs = probs
+        self.isotopes_labels = isotopes_labels
+        self.isotopes_count = isotopes_count
+        self.index_mono = index_mono
+
+    def __len__(self):
+
+        return len(self.masses)
+
+    @property
+    def relative_abundances(self):
+        
+        '''ratio iso/mono'''
+
+        return self.probs / self.probs[self.index_mono]
+
+    def formula_dict(self, index, mono_formula_dict):
+        
+        '''molecular formula dict of the isotopologue at index, ion type and H are copied from the monoisotopic formula'''
+
+        new_formula_dict = dict(zip(self.isotopes_labels, self.isotopes_count[index].tolist()))
+        new_formula_dict[Labels.ion_type] = mono_formula_dict.get(Labels.ion_type)
+        if mono_formula_dict.get('H'):
+            new_formula_dict['H'] = mono_formula_dict.get('H')
+
+        return {x:y for x,y in new_formula_dict.items() if y!=0}
+
+class IsotopologuePatterns:
+    
+    '''
+    Memoized IsoSpec patterns by elemental composition and cut off, shared by all the molecular formulas of the process
+    Formulas that only differ by the number of hydrogens share the same pattern
+    '''
+    
+    # max number of patterns kept in memory, the least recently used are removed first
+    max_patterns = 50000
+
+    _patterns = OrderedDict()
+
+    # searches running in threads share the patterns, IsoSpec runs outside the lock
+    _lock = threading.Lock()
+
+    @classmethod
+    def clear(cls):
+
+        cls._patterns.clear()
+
+    @staticmethod
+    def get_composition(formula_dict):
+
+        return tuple((atom, formula_dict.get(atom)) for atom in formula_dict.keys() if atom != Labels.ion_type and atom != 'H')
+
+    @classmethod
+    def get_pattern(cls, formula_dict, cut_off):
+
+        key = (cls.get_composition(formula_dict), cut_off)
+
+        with cls._lock:
+            
+            pattern = cls._patterns.get(key)
+
+            if pattern is not None:
+                
+                cls._patterns.move_to_end(key)
+                
+                return pattern
+        
+        pattern = cls.calc_pattern(*key)
+        
+        with cls._lock:
+            
+            cls._patterns[key] = pattern
+            
+            if len(cls._patterns) > cls.max_patterns:
+                cls._patterns.popitem(last=False)
+
+        return pattern
+
+    @staticmethod
+    def calc_pattern(composition, cut_off):
+
         atoms_count = []
         masses_list_tuples = []
         props_list_tuples = []
         all_atoms_list = []
+        # count of each isotope label on the monoisotopic formula
+        mono_count = []
         
-        for atom_label in atoms_labels:
+        for atom_label, atom_count in composition:
             
             if not len(Atoms.isotopes.get(atom_label))>1:
                 'This atom_label has no heavy isotope'
-                atoms_count.append(formula_dict.get(atom_label))
+                atoms_count.append(atom_count)
                 mass = Atoms.atomic_masses.get(atom_label)
                 prop = Atoms.isotopic_abundance.get(atom_label)
                 masses_list_tuples.append([mass])
                 props_list_tuples.append([prop])
                 all_atoms_list.append(atom_label)
+                mono_count.append(atom_count)
                 
             else:
                 
@@ -417,67 +545,168 @@ class MolecularFormulaCalc:
                     'This atom_label only has one heavy isotope'
                     isotopos_labels = [isotopes_label_list[0]]
                 
-                #all_atoms_list.extend(isotopos_labels) 
                 isotopos_labels = [atom_label] + isotopos_labels
                 
                 all_atoms_list.extend(isotopos_labels)
-                
+                mono_count.extend([atom_count] + [0] * (len(isotopos_labels) - 1))
+
                 masses = [Atoms.atomic_masses.get(atom_label) for atom_label in isotopos_labels]
                 props = [Atoms.isotopic_abundance.get(atom_label) for atom_label in isotopos_labels]
                 
-                atoms_count.append(formula_dict.get(atom_label))
+                atoms_count.append(atom_count)
                 masses_list_tuples.append(masses)
                 props_list_tuples.append(props)
         
-        iso = IsoSpecPy.IsoSpec(atoms_count,masses_list_tuples,props_list_tuples, cut_off_to_IsoSpeccPy)
+        iso = IsoSpecPy.IsoSpec(atoms_count,masses_list_tuples,props_list_tuples, cut_off)
         
         conf = iso.getConfs()
-        masses = conf[0]
-        probs = exp(conf[1])
-        molecular_formulas = conf[2]
-        #print('conf', conf)
-        #print('probs', conf[1])
-        
-        new_formulas = []
-        
-        for isotopologue_index in range(len(iso)):
-            #skip_mono_isotopic 
-            
-            formula_list = molecular_formulas[isotopologue_index]
-            new_formula_dict = dict(zip(all_atoms_list, formula_list))
-            new_formula_dict[Labels.ion_type] = formula_dict.get(Labels.ion_type)
-            if formula_dict.get('H'):
-                new_formula_dict['H'] = formula_dict.get('H')
-
-            new_formulas.append({x:y for x,y in new_formula_dict.items() if y!=0})
-        
-        # formula_dict in new_formulas check if monoisotopic is being returned
-        if new_formulas:# and formula_dict in new_formulas:
-            
-            #print(conf)    
-            #print(new_formulas)    
-            #print(atoms_count)
-            #print(all_atoms_list)
-            #print(masses_list_tuples)
-            #print(props_list_tuples)
-            # find where monoisotopic is
-            index_mono = new_formulas.index(formula_dict)   
-            # calculate ratio iso/mono
-            probs = list(probs/probs[index_mono])
+        
+        masses = array(conf[0], dtype=float64)
+        probs = exp(array(conf[1], dtype=float64))
+        isotopes_count = array(conf[2], dtype=int64).reshape(len(masses), len(all_atoms_list))
+        
+        # find where monoisotopic is
+        index_mono = flatnonzero((isotopes_count == array(mono_count, dtype=int64)).all(axis=1))
+        index_mono = int(index_mono[0]) if index_mono.size else None
+
+        return IsotopologuePattern(masses, probs, tuple(all_atoms_list), isotopes_count, index_mono)
+
+
+class MolecularFormulaScores:
+
+    '''
+    confidence scores of many molecular formulas at once, same values as 
+    MolecularFormula.mz_error_score, isotopologue_similarity, average_mz_error_score and confidence_score,
+    the values are written to the formulas cache
+    '''
+
+    @staticmethod
+    def mono_isotopic_formula(molecular_formula):
+
+        if molecular_formula.is_isotopologue:
             
-            # delete the monoisotopic
-            del probs[index_mono]
-            del new_formulas[index_mono]
+            mspeak = molecular_formula._mspeak_parent._ms_parent[molecular_formula.mspeak_index_mono_isotopic]
             
-            #print('probs_exp', probs)
-            for formulas, prob in zip(new_formulas, probs):
+            return mspeak[molecular_formula.mono_isotopic_formula_index]
+        
+        return molecular_formula
+
+    @staticmethod
+    def calc_mz_error_scores(molecular_formulas):
+
+        mspeaks = [mf._mspeak_parent for mf in molecular_formulas]
+
+        for mspeak in mspeaks:
+            # predicted std not set, using 0.3
+            if not mspeak.predicted_std: mspeak.predicted_std = 0.3
+
+        mz_calc = array([mf.mz_calc for mf in molecular_formulas], dtype=float64)
+        mz_exp = array([mspeak.mz_exp for mspeak in mspeaks], dtype=float64)
+        predicted_std = array([mspeak.predicted_std for mspeak in mspeaks], dtype=float64)
+
+        mz_error = ((mz_calc - mz_exp)/mz_calc)*1000000
+
+        return exp( -1 * (power(mz_error, 2) / (2 * power(predicted_std, 2))))
+
+    @classmethod
+    def calc_isotopologue_similarities(cls, mono_formulas):
+
+        '''manhattan distance between the experimental and calculated isotopologue abundances, one group per mono isotopic formula'''
+        
+        groups, exp_abundances, ref_abundances = [], [], []
+
+        for group, mono_formula in enumerate(mono_formulas):
+
+            if not mono_formula.expected_isotopologues: continue
+
+            mono_mz = mono_formula.mz_calc
+            mono_abundance = mono_formula._mspeak_parent.abundance
+
+            # dicts by m/z, same as the SpectralSimilarity input
+            exp_by_mz, ref_by_mz = {mono_mz: mono_abundance}, {mono_mz: mono_abundance}
+
+            for mf in mono_formula.expected_isotopologues:
                 
-                theor_abundance = current_abundance* prob
-                if theor_abundance > min_abundance:
-                    #print(prob, theor_abundance, current_abundance)
-                    yield (formulas, prob)
-            #return zip(new_formulas, probs )
-    
-        #else:
-        #    return []    
-    
\ No newline at end of file
+                ref_by_mz[mf.mz_calc] = mf.abundance_calc
+                # missing peaks are filled with abundance 0
+                exp_by_mz[mf.mz_calc] = mf._mspeak_parent.abundance if mf._mspeak_parent else nextafter(0, 1)
+
+            groups.extend([group] * len(exp_by_mz))
+            exp_abundances.extend(exp_by_mz.values())
+            ref_abundances.extend(ref_by_mz[mz] for mz in exp_by_mz.keys())
+
+        # no isotopologue expected giving a correlation score of 0.0
+        correlation = zeros(len(mono_formulas), dtype=float64)
+
+        if not groups: return correlation
+
+        groups = array(groups, dtype=int64)
+        exp_abundances = array(exp_abundances, dtype=float64)
+        ref_abundances = array(ref_abundances, dtype=float64)
+
+        with errstate(divide='ignore', invalid='ignore'):
+            
+            exp_norm = exp_abundances / bincount(groups, exp_abundances)[groups]
+            ref_norm = ref_abundances / bincount(groups, ref_abundances)[groups]
+
+        distance = bincount(groups, absolute(exp_norm - ref_norm), minlength=len(mono_formulas))
+
+        scored = unique(groups)
+
+        scored_correlation = 1 - clip(distance[scored] / 2, 0, 1)
+        scored_correlation[isnan(scored_correlation)] = 0.00001
+
+        correlation[scored] = scored_correlation
+
+        return correlation
+
+    @classmethod
+    def calc(cls, molecular_formulas, mz_error_score_weight, isotopologue_score_weight):
+
+        molecular_formulas = [mf for mf in molecular_formulas if mf._mspeak_parent]
+
+        if not molecular_formulas: return
+
+        mono_formulas, mono_indexes = {}, []
+        
+        for mf in molecular_formulas:
+            mono_formula = cls.mono_isotopic_formula(mf)
+            mono_indexes.append(mono_formulas.setdefault(id(mono_formula), (len(mono_formulas), mono_formula))[0])
+
+        mono_indexes = array(mono_indexes, dtype=int64)
+        
+        mono_formulas = [mono_formula for _, mono_formula in mono_formulas.values()]
+
+        # the assigned expected isotopologues are part of the average m/z error score
+        scored_formulas = {id(mf): mf for mf in molecular_formulas}
+
+        for mono_formula in mono_formulas:
+            for mf in mono_formula.expected_isotopologues:
+                if mf._mspeak_parent: scored_formulas.setdefault(id(mf), mf)
+        
+        scored_formulas = list(scored_formulas.values())
+
+        mz_error_scores = cls.calc_mz_error_scores(scored_formulas)
+
+        for mf, mz_error_score in zip(scored_formulas, mz_error_scores.tolist()):
+            mf._mz_error_score = mz_error_score
+        
+        # sum and count of the expected isotopologues m/z error scores, 0 for the not assigned ones
+        iso_scores_sum = array([sum(mf._mz_error_score for mf in mono_formula.expected_isotopologues if mf._mspeak_parent) 
+                                for mono_formula in mono_formulas], dtype=float64)
+        
+        iso_count = array([len(mono_formula.expected_isotopologues) for mono_formula in mono_formulas], dtype=float64)
+
+        # molecular_formulas are the first scored formulas
+        average_mz_scores = (mz_error_scores[:len(molecular_formulas)] + iso_scores_sum[mono_indexes]) / (1 + iso_count[mono_indexes])
+        average_mz_scores[isnan(average_mz_scores)] = 0.0
+
+        isotopologue_similarities = cls.calc_isotopologue_similarities(mono_formulas)[mono_indexes]
+
+        confidence_scores = (isotopologue_similarities * isotopologue_score_weight) + (average_mz_scores * mz_error_score_weight)
+
+        for mf, similarity, average_mz_score, confidence_score in zip(molecular_formulas, isotopologue_similarities.tolist(), 
+                                                                     average_mz_scores.tolist(), confidence_scores.tolist()):
+            mf._isotopologue_similarity = similarity
+            mf._mass_error_average_score = average_mz_score
+            mf._confidence_score = confidence_score
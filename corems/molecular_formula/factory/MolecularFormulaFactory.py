@@ -11,7 +11,15 @@ __date__ = "Jun 24, 2019"
 class MolecularFormula(MolecularFormulaCalc):
     '''
     classdocs
+
+    slotted, the m/z, DBE and Kendrick values are calculated on first access and cached,
+    the isotopologues lists are created when first used
     '''
+    __slots__ = ('_d_molecular_formula', '_ion_charge', '_confidence_score', '_isotopologue_similarity', '_mz_error_score', 
+                 '_mass_error_average_score', 'is_isotopologue', '_mspeak_parent', '_expected_isotopologues', 
+                 '_mspeak_mf_isotopologues_indexes', '_kendrick_dict_base', '_kdm', '_kendrick_mass', '_nominal_km', 
+                 '_mz_calc', '_dbe')
+
     def __init__(self, molecular_formula, ion_charge, ion_type=None, adduct_atom=None, mspeak_parent=None):
         
         #clear dictionary of atoms with 0 value
@@ -38,15 +46,47 @@ class MolecularFormula(MolecularFormulaCalc):
         # parent mass spectrum peak obj instance
         self._mspeak_parent = mspeak_parent
 
-        self.expected_isotopologues = []
-        self.mspeak_mf_isotopologues_indexes = []
+        self._expected_isotopologues = None
+        self._mspeak_mf_isotopologues_indexes = None
         
+        self._mz_calc = None
+        self._dbe = None
+
+        # kendrick base at creation, the values are calculated at the first access
         if self._mspeak_parent:
-            kendrick_dict_base = self._mspeak_parent._ms_parent.kendrick_base
+            self._kendrick_dict_base = self._mspeak_parent._ms_parent.kendrick_base
         else:
-            kendrick_dict_base = {'C':1, 'H':2}
-        self._kdm, self._kendrick_mass, self._nominal_km = self._calc_kdm(
-            kendrick_dict_base)  
+            self._kendrick_dict_base = {'C':1, 'H':2}
+        
+        self._kdm = None
+        self._kendrick_mass = None
+        self._nominal_km = None
+        
+    @property
+    def expected_isotopologues(self):
+        
+        if self._expected_isotopologues is None:
+            self._expected_isotopologues = []
+        
+        return self._expected_isotopologues
+
+    @expected_isotopologues.setter
+    def expected_isotopologues(self, isotopologues):
+        
+        self._expected_isotopologues = isotopologues
+
+    @property
+    def mspeak_mf_isotopologues_indexes(self):
+        
+        if self._mspeak_mf_isotopologues_indexes is None:
+            self._mspeak_mf_isotopologues_indexes = []
+        
+        return self._mspeak_mf_isotopologues_indexes
+
+    @mspeak_mf_isotopologues_indexes.setter
+    def mspeak_mf_isotopologues_indexes(self, indexes):
+        
+        self._mspeak_mf_isotopologues_indexes = indexes
         
     def __repr__(self):
 
@@ -90,8 +130,8 @@ class MolecularFormula(MolecularFormulaCalc):
         
     @property
     def isotopologue_count_percentile(self, ):
-        if not len(self.expected_isotopologues) == 0:
-            return (len(self.mspeak_mf_isotopologues_indexes)/len(self.expected_isotopologues))*100
+        if self._expected_isotopologues:
+            return (len(self.mspeak_mf_isotopologues_indexes)/len(self._expected_isotopologues))*100
         else: 
             return 100
 
@@ -146,16 +186,26 @@ class MolecularFormula(MolecularFormulaCalc):
     def H_C(self): return self._d_molecular_formula.get("H")/self._d_molecular_formula.get("C")
     
     @property
-    def dbe(self): return self._calc_dbe()
+    def dbe(self): 
+        
+        if self._dbe is None:
+            self._dbe = self._calc_dbe()
+        
+        return self._dbe
     
     @property
-    def mz_nominal_calc(self): return int(self._calc_mz())
+    def mz_nominal_calc(self): return int(self.mz_calc)
 
     @property    
     def mz_error(self): return self._calc_assignment_mass_error()
 
     @property
-    def mz_calc(self): return self._calc_mz()
+    def mz_calc(self): 
+        
+        if self._mz_calc is None:
+            self._mz_calc = self._calc_mz()
+        
+        return self._mz_calc
 
     @property
     def ion_type(self): 
@@ -173,6 +223,8 @@ class MolecularFormula(MolecularFormulaCalc):
     def ion_type(self, ion_type):
         if  ion_type in [Labels.protonated_de_ion, Labels.adduct_ion, Labels.radical_ion]:
             self._d_molecular_formula[Labels.ion_type] = ion_type
+            # the cached values depend on the ion type
+            self._mz_calc, self._dbe, self._kdm = None, None, None
         else:
             raise TypeError("Ion type can only be: 'DE_OR_PROTONATED', 'RADICAL' or  'ADDUCT', not %s"%ion_type)   
 
@@ -219,17 +271,29 @@ class MolecularFormula(MolecularFormulaCalc):
         
         return self._mz_error_score
     
+    def _get_kdm(self):
+        
+        if self._kdm is None:
+            self._kdm, self._kendrick_mass, self._nominal_km = self._calc_kdm(self._kendrick_dict_base)
+
     @property
-    def kmd(self): return self._kdm
+    def kmd(self): 
+        self._get_kdm()
+        return self._kdm
 
     @property
-    def kendrick_mass(self): return self._kendrick_mass
+    def kendrick_mass(self): 
+        self._get_kdm()
+        return self._kendrick_mass
 
     @property
-    def knm(self): return self._nominal_km
+    def knm(self): 
+        self._get_kdm()
+        return self._nominal_km
 
     def change_kendrick_base(self, kendrick_dict_base):
         '''kendrick_dict_base = {"C": 1, "H": 2}'''
+        self._kendrick_dict_base = kendrick_dict_base
         self._kdm, self._kendrick_mass, self._nominal_km = self._calc_kdm(kendrick_dict_base)
                 
     def isotopologues(self, min_abundance, current_mono_abundance, dynamic_range): 
@@ -355,6 +419,8 @@ class MolecularFormulaIsotopologue(MolecularFormula):
     '''
     classdocs
     '''
+    __slots__ = ('prob_ratio', 'abundance_calc', 'mspeak_index_mono_isotopic', 'mono_isotopic_formula_index')
+
     def __init__(self, _d_molecular_formula, prob_ratio, mono_abundance, ion_charge, mspeak_parent=None):
         
         super().__init__(_d_molecular_formula,  ion_charge)
@@ -11,11 +11,12 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from sqlalchemy.pool import QueuePool
 from sqlalchemy import between
 
 from numpy import array, frombuffer
 
+from corems.molecular_id.factory.EngineRegistry import EngineRegistry
+
 Base = declarative_base()
 
 @dataclass
@@ -92,24 +93,20 @@ class LowResolutionEICompound(Base):
 
 class EI_LowRes_SQLite:
     
-    def __init__(self, url='sqlite://'):
+    def __init__(self, url='sqlite://', pool_size=5, max_overflow=10):
         
-        self.engine = self.init_engine(url)
-
-        Base.metadata.create_all(self.engine)
+        # engine and pool shared by all the EI_LowRes_SQLite objs of the process, see EngineRegistry
+        self.engine, session_factory = self.init_engine(url, pool_size, max_overflow)
 
-        Session = sessionmaker(bind=self.engine)
-        
-        self.session = Session()
+        self.session = session_factory()
         
     def __exit__(self, exc_type, exc_val, exc_tb):
         # make sure the db connection gets closed
         # 
         self.commit()
         self.session.close()
-        self.engine.dispose()
 
-    def init_engine(self, url):
+    def init_engine(self, url, pool_size=5, max_overflow=10):
         
         directory = os.getcwd()
         
@@ -121,7 +118,7 @@ class EI_LowRes_SQLite:
             
             url = 'sqlite:///{DB}/db/pnnl_lowres_gcms_compounds.sqlite'.format(DB=directory)
 
-        return create_engine(url, poolclass=QueuePool)
+        return EngineRegistry.get(url, Base.metadata, pool_size, max_overflow)
 
     def __enter__(self):
         
@@ -0,0 +1,139 @@
+import os
+import threading
+import warnings
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm.session import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+
+def add_engine_pidguard(engine):
+    """Add multiprocessing guards.
+
+    Forces a connection to be reconnected if it is detected
+    as having been shared to a sub-process.
+
+    """
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            # substitute log.debug() or similar here as desired
+            warnings.warn(
+                "Parent process %(orig)s forked (%(newproc)s) with an open "
+                "database connection, "
+                "which is being discarded and recreated." %
+                {"newproc": pid, "orig": connection_record.info['pid']})
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                "Connection record belongs to pid %s, "
+                "attempting to check out in pid %s" %
+                (connection_record.info['pid'], pid)
+            )
+
+
+class EngineRegistry:
+    '''
+    process wide engines and session factories, one per database url and process id
+
+    the engine, its connection pool and the create_all of the tables are shared by all the
+    MolForm_SQL and EI_LowRes_SQLite objs created in the process (classes chunks, searches and mass spectra),
+    closing a sql obj only returns its connection to the pool
+    a forked process does not use the engines inherited from the parent, new ones are created on first use
+    in memory sqlite databases are not shared
+    '''
+    _engines = {}
+
+    _lock = threading.Lock()
+
+    @staticmethod
+    def is_memory_url(url):
+
+        return url in ('sqlite://', 'sqlite:///') or ':memory:' in url
+
+    @classmethod
+    def engine_kwargs(cls, url, pool_size, max_overflow, isolation_level):
+
+        kwargs = {'echo': False}
+
+        if isolation_level:
+            kwargs['isolation_level'] = isolation_level
+
+        if url[0:6] == 'sqlite':
+
+            # in memory databases live in the connection of the default pool
+            if cls.is_memory_url(url): return kwargs
+
+            # the pooled connections are checked out by the search threads
+            kwargs['connect_args'] = {'check_same_thread': False}
+            kwargs['poolclass'] = QueuePool
+
+        kwargs['pool_size'] = pool_size
+        kwargs['max_overflow'] = max_overflow
+
+        return kwargs
+
+    @classmethod
+    def get(cls, url, metadata=None, pool_size=5, max_overflow=10, isolation_level=None):
+        '''returns the (engine, session_factory) of the url for the current process,
+           the pool size is set when the engine is first created, a different pool size for the same url raises a warning'''
+        if cls.is_memory_url(url):
+
+            # every in memory database is private to the sql obj that created it
+            engine = create_engine(url, **cls.engine_kwargs(url, pool_size, max_overflow, isolation_level))
+
+            if metadata is not None: metadata.create_all(engine)
+
+            return engine, sessionmaker(bind=engine)
+
+        pid = os.getpid()
+
+        key = (url, isolation_level, pid)
+
+        with cls._lock:
+
+            entry = cls._engines.get(key)
+
+            if entry is None:
+
+                # engines inherited from the parent process, their connections belong to it
+                for stale_key in [engine_key for engine_key in cls._engines if engine_key[2] != pid]:
+                    del cls._engines[stale_key]
+
+                engine = create_engine(url, **cls.engine_kwargs(url, pool_size, max_overflow, isolation_level))
+
+                add_engine_pidguard(engine)
+
+                entry = cls._engines[key] = (engine, sessionmaker(bind=engine), set(), (pool_size, max_overflow))
+
+            engine, session_factory, created_metadata, pool_settings = entry
+
+            if pool_settings != (pool_size, max_overflow):
+
+                warnings.warn("the engine of %s was created with pool_size=%s and max_overflow=%s, "
+                              "the requested pool_size=%s and max_overflow=%s are ignored" % (engine.url, *pool_settings, pool_size, max_overflow))
+
+            if metadata is not None and id(metadata) not in created_metadata:
+
+                metadata.create_all(engine)
+                created_metadata.add(id(metadata))
+
+        return engine, session_factory
+
+    @classmethod
+    def dispose_all(cls):
+        '''closes the pooled connections of this process, the engines are re-created on next use'''
+        with cls._lock:
+
+            pid = os.getpid()
+
+            for key, (engine, _, _, _) in list(cls._engines.items()):
+                if key[2] == pid:
+                    engine.dispose()
+
+            cls._engines.clear()
@@ -0,0 +1,367 @@
+import hashlib
+import json
+import os
+
+from numpy import array, arange, concatenate, float64, int16, int32, isin, load, searchsorted, unique, zeros
+from numpy.lib.format import open_memmap
+from sqlalchemy import func
+
+from corems.encapsulation.constant import Atoms, Labels
+from corems.molecular_id.factory.molecularSQL import CarbonHydrogen, HeteroAtoms, MolecularFormulaLink, calc_nominal_mz_columns, get_class_dict
+
+
+class IndexedFormula:
+
+    '''
+    light replacement for the MolecularFormulaLink ORM obj,
+    exposes the same attributes and mass methods used by the molecular formula search
+    '''
+
+    __slots__ = ('C', 'H', 'mass', 'DBE', 'classe', '_classe_dict')
+
+    def __init__(self, C, H, mass, DBE, classe, classe_dict):
+
+        self.C = C
+        self.H = H
+        self.mass = mass
+        self.DBE = DBE
+        self.classe = classe
+        self._classe_dict = classe_dict
+
+    @property
+    def formula_dict(self):
+
+        carbon = {'C': self.C, 'H': self.H}
+
+        if self.classe == '{"HC": ""}':
+            return {**carbon}
+        else:
+            return {**carbon, **self._classe_dict}
+
+    @property
+    def formula_string(self):
+        class_dict = self.formula_dict
+        class_str = ' '.join([atom + str(class_dict[atom]) for atom in class_dict.keys()])
+        return class_str.strip()
+
+    @property
+    def classe_string(self):
+        class_str = ' '.join([atom + str(self._classe_dict[atom]) for atom in self._classe_dict.keys()])
+        return class_str.strip()
+
+    def adduct_mass(self, ion_charge, adduct_atom):
+        return (self.mass + (Atoms.atomic_masses.get(adduct_atom)) + (ion_charge * -1 * Atoms.electron_mass))/ abs(ion_charge)
+
+    def protonated_mass(self, ion_charge):
+        return (self.mass + (ion_charge * Atoms.atomic_masses.get("H")) + (ion_charge * -1 * Atoms.electron_mass))/abs(ion_charge)
+
+    def radical_mass(self, ion_charge):
+        return (self.mass + (ion_charge * -1 * Atoms.electron_mass))/ abs(ion_charge)
+
+    def __repr__(self):
+
+        return '<IndexedFormula {}>'.format(self.formula_string)
+
+
+class MolecularFormulaIndex:
+
+    '''
+    Columnar copy of the molecular formula lookup tables (molecularformula, carbonHydrogen and heteroAtoms)
+    sorted by neutral mass and saved as a numpy file, it is loaded with memory mapping
+    so only the rows inside the requested mass ranges are read from disk
+
+    The index is built once from the sql database and rebuilt when the database stamp
+    written by MolecularCombinations changes
+
+    Columns
+    ----------
+    class_id : heteroAtoms.id
+    C, H : carbon and hydrogen count
+    mass : neutral mass
+    DBE : double bond equivalent
+    protonated_pos, protonated_neg, radical_pos, radical_neg : nominal m/z for ion charge +1 and -1
+
+    get_dict_by_classes() returns the same structure as MolForm_SQL.get_dict_by_classes()
+    '''
+
+    dtype = [('class_id', int32), ('C', int16), ('H', int16), ('mass', float64), ('DBE', float64),
+             ('protonated_pos', int32), ('protonated_neg', int32), ('radical_pos', int32), ('radical_neg', int32)]
+
+    # loaded indexes by file path, avoids reloading the index for every classes chunk
+    _loaded = {}
+
+    # tables count of databases without stamp by file path
+    _counted = {}
+
+    def __init__(self, index_path, table, classes):
+
+        self.index_path = index_path
+
+        self.table = table
+
+        self.class_id_by_name = {classe['name']: classe['id'] for classe in classes}
+
+        self.classe_by_id = {classe['id']: classe for classe in classes}
+
+        for classe in classes:
+            classe['dict'] = get_class_dict(classe['name'])
+
+        # per class columns indexed by class id, used to vectorize the H/C and O/C filters
+        max_id = max(self.classe_by_id.keys(), default=0) + 1
+
+        self.halogens_count = zeros(max_id, dtype=float64)
+        self.oxygen_count = zeros(max_id, dtype=float64)
+
+        for classe in classes:
+            self.halogens_count[classe['id']] = classe['halogensCount']
+            self.oxygen_count[classe['id']] = classe['dict'].get('O', 0) or 0
+
+    def __len__(self):
+
+        return len(self.table)
+
+    @staticmethod
+    def get_index_path(url):
+
+        url_hash = hashlib.md5(str(url).encode('utf-8')).hexdigest()[:12]
+
+        if url and str(url)[0:10] == 'sqlite:///' and len(str(url)) > 10:
+            directory = os.path.dirname(os.path.abspath(str(url)[10:]))
+        else:
+            directory = os.path.join(os.getcwd(), 'db')
+
+        if not os.path.isdir(directory):  os.mkdir(directory)
+
+        return os.path.join(directory, 'molformula_index_{}.npy'.format(url_hash))
+
+    @staticmethod
+    def get_tables_count(sql_db):
+
+        return {'molecularformula': sql_db.session.query(func.count(MolecularFormulaLink.heteroAtoms_id)).scalar(),
+                'heteroAtoms': sql_db.session.query(func.count(HeteroAtoms.id)).scalar(),
+                'carbonHydrogen': sql_db.session.query(func.count(CarbonHydrogen.id)).scalar()}
+
+    @classmethod
+    def get_stamp(cls, sql_db, index_path):
+
+        '''stamp written by MolecularCombinations on every lookup tables change,
+           databases created before the stamp use the tables count, counted once per process'''
+
+        stamp = sql_db.get_database_stamp()
+
+        if stamp: return stamp
+
+        if index_path not in cls._counted:
+            cls._counted[index_path] = json.dumps(cls.get_tables_count(sql_db), sort_keys=True)
+
+        return cls._counted[index_path]
+
+    @classmethod
+    def from_sql_db(cls, sql_db):
+
+        '''loads the index for the sql database, builds it if missing or outdated'''
+
+        index_path = cls.get_index_path(str(sql_db.engine.url))
+        metadata_path = index_path.replace('.npy', '.json')
+
+        stamp = cls.get_stamp(sql_db, index_path)
+
+        formula_index = cls._loaded.get(index_path)
+
+        if formula_index and formula_index.stamp == stamp:
+            return formula_index
+
+        metadata = None
+
+        if os.path.isfile(index_path) and os.path.isfile(metadata_path):
+
+            with open(metadata_path, 'r') as metadata_file:
+                metadata = json.load(metadata_file)
+
+        if not metadata or metadata.get('stamp') != stamp:
+
+            metadata = cls.build(sql_db, index_path, metadata_path, stamp)
+
+        formula_index = cls(index_path, load(index_path, mmap_mode='r'), metadata.get('classes'))
+
+        formula_index.stamp = stamp
+
+        cls._loaded[index_path] = formula_index
+
+        return formula_index
+
+    @classmethod
+    def build(cls, sql_db, index_path, metadata_path, stamp, chunk_size=500000):
+
+        '''the rows are sorted by the database and streamed in chunks to a memory mapped file,
+           only one chunk of rows is kept in memory, the index file uses 40 bytes per formula'''
+
+        count = sql_db.session.query(func.count(MolecularFormulaLink.heteroAtoms_id)).scalar()
+
+        query = sql_db.session.query(MolecularFormulaLink.heteroAtoms_id, CarbonHydrogen.C, CarbonHydrogen.H,
+                                     MolecularFormulaLink.mass, MolecularFormulaLink.DBE)\
+                                .filter(MolecularFormulaLink.carbonHydrogen_id == CarbonHydrogen.id)\
+                                .order_by(MolecularFormulaLink.mass, MolecularFormulaLink.heteroAtoms_id, MolecularFormulaLink.carbonHydrogen_id)
+
+        # write to a temp file first, other processes could be reading the old index
+        temp_path = index_path.replace('.npy', '.{}.tmp.npy'.format(os.getpid()))
+
+        table = open_memmap(temp_path, mode='w+', dtype=cls.dtype, shape=(count,))
+
+        table_chunk = None
+
+        size = 0
+
+        rows = iter(query.yield_per(chunk_size))
+
+        while True:
+
+            chunk = [row for _, row in zip(range(chunk_size), rows)]
+
+            if not chunk: break
+
+            if size + len(chunk) > count:
+                raise Exception('the molecular formula table changed while building the formula index')
+
+            columns = list(zip(*chunk))
+
+            table_chunk = table[size:size + len(chunk)]
+
+            for name, column in zip(('class_id', 'C', 'H', 'mass', 'DBE'), columns):
+                table_chunk[name] = column
+
+            # same values as the stored nominal m/z columns
+            for column, values in calc_nominal_mz_columns(table_chunk['mass']).items():
+                table_chunk[column] = values
+
+            size = size + len(chunk)
+
+        if size != count:
+            raise Exception('the molecular formula table changed while building the formula index')
+
+        table.flush()
+        del table, table_chunk
+
+        os.replace(temp_path, index_path)
+
+        classes = [{'id': classe.id, 'name': classe.name, 'halogensCount': classe.halogensCount} for classe in sql_db.session.query(HeteroAtoms)]
+
+        metadata = {'stamp': stamp, 'classes': classes}
+
+        with open(metadata_path + '.{}.tmp'.format(os.getpid()), 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(metadata_path + '.{}.tmp'.format(os.getpid()), metadata_path)
+
+        return metadata
+
+    def rows_by_nominal_mzs(self, nominal_mzs, ion_charge, mass_shift):
+
+        '''binary search of the rows with m/z inside the nominal m/z ranges, mass_shift is the ion m/z minus the neutral mass'''
+
+        nominal_mzs = unique(array(list(nominal_mzs), dtype=float64))
+
+        # 1 mDa margin for rounding errors, the exact nominal m/z is checked afterwards
+        start_masses = (nominal_mzs * abs(ion_charge)) - mass_shift - 0.001
+        end_masses = ((nominal_mzs + 1) * abs(ion_charge)) - mass_shift + 0.001
+
+        first_indexes = searchsorted(self.table['mass'], start_masses, side='left')
+        last_indexes = searchsorted(self.table['mass'], end_masses, side='right')
+
+        ranges = [arange(first, last) for first, last in zip(first_indexes, last_indexes) if last > first]
+
+        if not ranges: return arange(0)
+
+        # neighbour nominal masses overlap because of the margin
+        return unique(concatenate(ranges))
+
+    def get_dict_by_classes(self, classes, ion_type, nominal_mzs, ion_charge, molecular_search_settings, adducts=None):
+
+        '''same filters and output as MolForm_SQL.get_dict_by_classes()'''
+
+        if ion_type == Labels.protonated_de_ion:
+
+            return self.add_dict_formula(classes, ion_type, nominal_mzs, ion_charge, molecular_search_settings)
+
+        if ion_type == Labels.radical_ion:
+
+            return self.add_dict_formula(classes, ion_type, nominal_mzs, ion_charge, molecular_search_settings)
+
+        if ion_type == Labels.adduct_ion:
+            dict_res = {}
+            if adducts:
+                for atom in adducts:
+                    dict_res[atom] = self.add_dict_formula(classes, ion_type, nominal_mzs, ion_charge, molecular_search_settings, adduct_atom=atom)
+                return dict_res
+
+    def add_dict_formula(self, classes, ion_type, nominal_mzs, ion_charge, molecular_search_settings, adduct_atom=None):
+
+        "organize data by heteroatom classes"
+
+        if ion_type == Labels.protonated_de_ion:
+            mass_shift = (ion_charge * Atoms.atomic_masses.get("H")) + (ion_charge * -1 * Atoms.electron_mass)
+
+        elif ion_type == Labels.radical_ion:
+            mass_shift = ion_charge * -1 * Atoms.electron_mass
+
+        else:
+            mass_shift = Atoms.atomic_masses.get(adduct_atom) + (ion_charge * -1 * Atoms.electron_mass)
+
+        len_adduct = 1 if ion_type == Labels.adduct_ion else 0
+
+        class_ids = [self.class_id_by_name.get(classe) for classe in classes if classe in self.class_id_by_name]
+
+        dict_res = {}
+
+        if not class_ids or not len(self.table): return dict_res
+
+        rows = self.table[self.rows_by_nominal_mzs(nominal_mzs, ion_charge, mass_shift)]
+
+        rows = rows[isin(rows['class_id'], class_ids)]
+
+        if ion_type != Labels.adduct_ion and abs(ion_charge) == 1:
+
+            column = '{}_{}'.format('protonated' if ion_type == Labels.protonated_de_ion else 'radical', 'pos' if ion_charge > 0 else 'neg')
+            nominal_mz = rows[column]
+
+        else:
+            # same calculation as MolecularFormulaLink.adduct_mass
+            nominal_mz = ((rows['mass'] + mass_shift) / abs(ion_charge)).astype(int32)
+
+        carbon = rows['C'].astype(float64)
+
+        hc = (rows['H'] + self.halogens_count[rows['class_id']] - len_adduct) / carbon
+
+        oxygen = self.oxygen_count[rows['class_id']]
+
+        # same filters as MolForm_SQL.get_dict_by_classes
+        mask = isin(nominal_mz, list(nominal_mzs))
+        mask &= (rows['DBE'] >= molecular_search_settings.min_dbe) & (rows['DBE'] <= molecular_search_settings.max_dbe)
+        mask &= (hc >= molecular_search_settings.min_hc_filter) & (hc <= molecular_search_settings.max_hc_filter)
+        mask &= (carbon >= molecular_search_settings.usedAtoms.get("C")[0]) & (carbon <= molecular_search_settings.usedAtoms.get("C")[1])
+        mask &= (carbon >= molecular_search_settings.usedAtoms.get("H")[0]) & (carbon <= molecular_search_settings.usedAtoms.get("H")[1])
+        mask &= ~((oxygen > 0) & ((oxygen / carbon) >= molecular_search_settings.min_oc_filter))
+
+        rows, nominal_mz = rows[mask], nominal_mz[mask]
+
+        for class_id, C, H, mass, DBE, nominal in zip(rows['class_id'].tolist(), rows['C'].tolist(), rows['H'].tolist(),
+                                                      rows['mass'].tolist(), rows['DBE'].tolist(), nominal_mz.tolist()):
+
+            classe = self.classe_by_id.get(class_id)
+
+            formula_obj = IndexedFormula(C, H, mass, DBE, classe['name'], classe['dict'])
+
+            if classe['name'] in dict_res.keys():
+
+                if nominal in dict_res[classe['name']].keys():
+
+                    dict_res.get(classe['name']).get(nominal).append(formula_obj)
+
+                else:
+
+                    dict_res.get(classe['name'])[nominal] = [formula_obj]
+
+            else:
+
+                dict_res[classe['name']] = {nominal: [formula_obj]}
+
+        return dict_res
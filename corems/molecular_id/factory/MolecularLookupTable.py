@@ -4,6 +4,7 @@ __date__ = "Jul 02, 2019"
 from copy import deepcopy
 import itertools
 import multiprocessing
+import threading
 import json
 import cProfile
 import io
@@ -15,11 +16,12 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import load_only
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine, func
+from numpy import array, column_stack, concatenate, float64, full, int64, savetxt, unique
 from tqdm import tqdm
 
-from corems.encapsulation.factory.processingSetting  import MolecularLookupDictSettings
+from corems.encapsulation.factory.processingSetting  import MolecularLookupDictSettings, MolecularFormulaSearchSettings
 from corems.encapsulation.constant import Atoms
-from corems.molecular_id.factory.molecularSQL import CarbonHydrogen, HeteroAtoms, MolecularFormulaLink
+from corems.molecular_id.factory.molecularSQL import CarbonHydrogen, HeteroAtoms, MolecularFormulaLink, calc_nominal_mz_columns, existing_nominal_mz_columns, partition_name
 from corems.encapsulation.factory.parameters import MSParameters
 from corems import chunks, timeit
 from corems.molecular_id.factory.molecularSQL import MolForm_SQL
@@ -38,29 +40,106 @@ def profiled():
     # ps.print_callers()
     print(s.getvalue())
 
-def insert_database_worker(args):
+# state of the generate_database_worker processes, set once per process by init_generate_database_worker
+worker_state = {}
+
+def init_generate_database_worker(ch_columns, used_atom_valences, settings, partitioned, insert):
+        
+        # the class DBE uses the valences of the parent process
+        MSParameters.molecular_search.used_atom_valences = used_atom_valences
+
+        # the worker connection comes from the process wide engine of the url, see EngineRegistry
+        mol_combinations = MolecularCombinations(MolForm_SQL(url=settings.url_database))
         
-        results, url = args
+        for column, values in ch_columns.items():
+            setattr(mol_combinations, column, values)
         
-        if not url:
+        worker_state['mol_combinations'] = mol_combinations
+        worker_state['settings'] = settings
+        worker_state['partitioned'] = partitioned
+        worker_state['insert'] = insert
+
+def generate_database_worker(class_tuples):
+        
+        '''
+        generates the molecular formulas of the classes, returns the number of classes, rows and the columns to be inserted by the parent process, 
+        the worker inserts the rows itself (no columns returned) when worker_state['insert'] is set
+        '''
+        
+        mol_combinations = worker_state['mol_combinations']
+
+        settings = worker_state['settings']
+
+        if worker_state['insert']:
             
-            url = 'sqlite:///db/molformulas.sqlite'
+            return len(class_tuples), mol_combinations.insert_classes_mol_formulas(class_tuples, settings, worker_state['partitioned']), []
 
-        if url[0:6] == 'sqlite':
-            engine = create_engine(url, echo = False)
-        else:
-            engine = create_engine(url, echo = False, isolation_level="AUTOCOMMIT")
+        columns_list = list(mol_combinations.buffered_columns((mol_combinations.populate_combinations(class_tuple, settings) for class_tuple in class_tuples), settings.bulk_insert_rows))
+
+        return len(class_tuples), sum(len(columns[0]) for columns in columns_list), columns_list
+
+def bulk_insert_mol_formulas(engine, heteroAtoms_ids, carbonHydrogen_ids, masses, dbes, partitioned=False):
         
-        session_factory = sessionmaker(bind=engine)
-        session = session_factory()
-        insert_query = MolecularFormulaLink.__table__.insert().values(results)
-        session.execute(insert_query)
-        session.commit()
-        session.close()
-        engine.dispose()
+        '''
+        inserts the molecular formulas columns using the driver bulk path, 
+        COPY for PostgreSQL and executemany (with the dialect paramstyle) for the other databases
+        the stored nominal m/z columns are calculated here, databases without the columns (see MolForm_SQL.upgrade_nominal_mz_columns) get only the mass
+        partitioned: PostgreSQL table partitioned by class, the rows are copied straight into the class partitions
+        '''
+        
+        if not len(heteroAtoms_ids): return
+
+        table_columns = existing_nominal_mz_columns(engine)
+
+        nominal_mzs = {column: values for column, values in calc_nominal_mz_columns(masses).items() if column in table_columns}
+
+        column_names = ['heteroAtoms_id', 'carbonHydrogen_id', 'mass', 'DBE'] + list(nominal_mzs.keys())
+
+        if engine.dialect.name != 'postgresql':
+            
+            rows = [dict(zip(column_names, row)) for row in zip(heteroAtoms_ids.tolist(), carbonHydrogen_ids.tolist(), masses.tolist(), dbes.tolist(), 
+                                                                *(column.tolist() for column in nominal_mzs.values()))]
+            
+            with engine.begin() as connection:
+                connection.execute(MolecularFormulaLink.__table__.insert(), rows)
+            
+            return
+
+        columns_sql = ', '.join('"{}"'.format(name) for name in column_names)
+
+        connection = engine.raw_connection()
+        
+        try:
+            
+            cursor = connection.cursor()
+
+            rows = column_stack((heteroAtoms_ids, carbonHydrogen_ids, masses, dbes, *nominal_mzs.values()))
+
+            if partitioned:
+                tables_rows = [(partition_name(heteroAtoms_id), rows[heteroAtoms_ids == heteroAtoms_id]) for heteroAtoms_id in unique(heteroAtoms_ids)]
+            else:
+                tables_rows = [('molecularformula', rows)]
+
+            for table_name, table_rows in tables_rows:
+                
+                csv_buffer = io.StringIO()
+                # %.17g keeps the exact float64 value
+                savetxt(csv_buffer, table_rows, fmt=['%d', '%d', '%.17g', '%.17g'] + ['%d'] * len(nominal_mzs), delimiter=',')
+                csv_buffer.seek(0)
+                
+                cursor.copy_expert('COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(table_name, columns_sql), csv_buffer)
+            
+            connection.commit()
+        
+        finally:
+            
+            connection.close()
 
 class MolecularCombinations:
-     
+    
+    # incremented every time new entries are added to the database, used to invalidate cached candidates
+    database_version = 0
+
     def __init__(self, sql_db = None):
 
         if not sql_db:
@@ -108,6 +187,8 @@ class MolecularCombinations:
                 insert_query = HeteroAtoms.__table__.insert().values(insert_chunk)
                 self.sql_db.session.execute(insert_query)
             
+            self.sql_db.add_class_partitions([data_class.get("id") for data_class in data_classes])
+            
         for index, class_str in enumerate(class_to_create):
             
             class_tuple =  (class_str, classes_dict.get(class_str), class_count+ index + 1) 
@@ -195,6 +276,9 @@ class MolecularCombinations:
                     list_ch_obj_to_add.append(data_insert)
 
             if list_ch_obj_to_add:
+                
+                MolecularCombinations.database_version += 1
+                
                 # insert carbon hydrogen objs
                 list_insert_chunks = chunks(list_ch_obj_to_add, self.sql_db.chunks_count)
                 for insert_chunk in  list_insert_chunks:   
@@ -203,36 +287,155 @@ class MolecularCombinations:
                 self.sql_db.session.commit()    
             
                 
-                list_molecular_form= list()
-                for classe_obj in existing_classes_objs:
+                # formulas of the existing classes with the new carbon and hydrogen combinations
+                for label in ('odd', 'even'):
+                    
+                    ch_datalist = list(carbon_hydrogen_objs_to_create.get(label).values())
+                    
+                    self.set_carbonsHydrogens_columns(label, [ch_dict.get('id') for ch_dict in ch_datalist], 
+                                                             [ch_dict.get('mass') for ch_dict in ch_datalist], 
+                                                             [ch_dict.get('dbe') for ch_dict in ch_datalist])
 
-                    classe_dict = classe_obj.to_dict()  
-                    classe_mass = self.calc_mz(classe_dict)
-                    classe_dbe = self.calc_dbe_class(classe_dict)
+                classes_tuples = [(classe_obj.name, classe_obj.to_dict(), classe_obj.id) for classe_obj in existing_classes_objs]
+                
+                self.insert_mol_formulas(classes_tuples, settings)
 
-                    odd_even_label = self.get_h_odd_or_even(classe_dict)
+                self.sql_db.write_database_stamp()
+            
+    def set_carbonsHydrogens_columns(self, odd_even_tag, ch_ids, ch_masses, ch_dbes):
+        
+        '''stores the carbon and hydrogen combinations as arrays, used by get_mol_formulas'''
 
-                    ch_datalist = carbon_hydrogen_objs_to_create.get(odd_even_label).values()
+        setattr(self, odd_even_tag + '_ch_id', array(ch_ids, dtype=int64))
+        setattr(self, odd_even_tag + '_ch_mass', array(ch_masses, dtype=float64))
+        setattr(self, odd_even_tag + '_ch_dbe', array(ch_dbes, dtype=float64))
 
-                    for ch_dict in ch_datalist:
-                        mass = ch_dict.get('mass') + classe_mass
-                        dbe = ch_dict.get('dbe') + classe_dbe
+    @staticmethod
+    def buffered_columns(mol_formulas_columns, bulk_insert_rows):
+        
+        '''joins the (heteroAtoms_id, carbonHydrogen_id, mass, DBE) columns returned by get_mol_formulas in chunks of at least bulk_insert_rows rows'''
+        
+        buffered, buffered_rows = list(), 0
+        
+        for columns in mol_formulas_columns:
+            
+            buffered.append(columns)
+            buffered_rows = buffered_rows + len(columns[0])
+            
+            if buffered_rows >= bulk_insert_rows:
+                
+                yield tuple(concatenate(column) for column in zip(*buffered))
+                buffered, buffered_rows = list(), 0
+        
+        if buffered:
+            
+            yield tuple(concatenate(column) for column in zip(*buffered))
 
-                        if settings.min_mz <= mass <= settings.max_mz:
+    def insert_classes_mol_formulas(self, class_tuples, settings, partitioned):
+        
+        '''generates the classes molecular formulas and bulk inserts them, at most settings.bulk_insert_rows rows are kept in memory'''
+        
+        rows_count = 0
+
+        for columns in self.buffered_columns((self.populate_combinations(class_tuple, settings) for class_tuple in class_tuples), settings.bulk_insert_rows):
+            
+            bulk_insert_mol_formulas(self.sql_db.engine, *columns, partitioned=partitioned)
+            
+            rows_count = rows_count + len(columns[0])
+        
+        return rows_count
+
+    def insert_mol_formulas(self, class_tuples, settings):
+        
+        '''
+        generates the molecular formulas of the classes and streams them to the database
+        
+        with settings.db_jobs > 1 the worker processes generate chunks of settings.db_classes_per_task classes,
+        on PostgreSQL the workers insert their own chunks, on the other databases (SQLite allows one writer at a time)
+        the parent process inserts the rows returned by the workers
+        at most settings.db_jobs * settings.db_tasks_in_flight chunks are submitted before waiting for the results (back-pressure), 
+        the memory used does not depend on the number of classes 
+        '''
+        
+        class_tuples = list(class_tuples)
+
+        # the session has to release the database before the driver connection is used
+        partitioned = self.sql_db.is_partitioned()
+        
+        self.sql_db.session.commit()
+
+        progress = tqdm(total=len(class_tuples), unit='class')
+        
+        if settings.db_jobs > 1: 
+            
+            workers_insert = self.sql_db.engine.dialect.name == 'postgresql'
+
+            ch_columns = {odd_even_tag + column: getattr(self, odd_even_tag + column) 
+                          for odd_even_tag in ('odd', 'even') for column in ('_ch_id', '_ch_mass', '_ch_dbe')}
+            
+            initargs = (ch_columns, MSParameters.molecular_search.used_atom_valences, settings, partitioned, workers_insert)
+            
+            in_flight = threading.Semaphore(settings.db_jobs * settings.db_tasks_in_flight)
+            
+            stopped = threading.Event()
+
+            def class_chunks():
+                # runs in the pool task thread, waits for a result before submitting more chunks
+                for class_chunk in chunks(class_tuples, settings.db_classes_per_task):
+                    
+                    in_flight.acquire()
+                    
+                    if stopped.is_set(): return
+                    
+                    yield class_chunk
+
+            pool = multiprocessing.Pool(settings.db_jobs, initializer=init_generate_database_worker, initargs=initargs)
+            
+            rows_count = 0
+
+            try:
+                
+                for classes_count, task_rows_count, columns_list in pool.imap_unordered(generate_database_worker, class_chunks()):
+                    
+                    for columns in columns_list:
+                        bulk_insert_mol_formulas(self.sql_db.engine, *columns, partitioned=partitioned)
+                    
+                    in_flight.release()
+
+                    rows_count = rows_count + task_rows_count
+                    
+                    progress.update(classes_count)
+                    progress.set_postfix(rows=rows_count)
                 
-                            if settings.min_dbe <= dbe <= settings.max_dbe:
-                                
-                                list_molecular_form.append( {"heteroAtoms_id":classe_obj.id, 
-                                        "carbonHydrogen_id":ch_dict.get('id'), 
-                                        "mass":mass, "DBE":dbe})
+                pool.close()
+                pool.join()
+            
+            except Exception as error:
+                
+                raise Exception('molecular formulas database generation failed: {}'.format(error))
 
-                list_insert_chunks = chunks(list_molecular_form, self.sql_db.chunks_count)
-                for insert_chunk in  list_insert_chunks:   
-                    insert_query = MolecularFormulaLink.__table__.insert().values(insert_chunk)
-                    self.sql_db.session.execute(insert_query)
-                self.sql_db.session.commit()    
+            finally:
+                
+                # unblocks the task thread
+                stopped.set()
+                in_flight.release()
+                
+                pool.terminate()
+                progress.close()
+        
+        else:
             
+            rows_count = 0
+
+            for class_chunk in chunks(class_tuples, settings.db_classes_per_task):
                 
+                rows_count = rows_count + self.insert_classes_mol_formulas(class_chunk, settings, partitioned)
+                
+                progress.update(len(class_chunk))
+                progress.set_postfix(rows=rows_count)
+            
+            progress.close()
+
     @timeit
     def runworker(self, molecular_search_settings):
         
@@ -247,6 +450,8 @@ class MolecularCombinations:
         
         if class_to_create:
             
+            MolecularCombinations.database_version += 1
+
             settings = MolecularLookupDictSettings()
             settings.usedAtoms = deepcopy(molecular_search_settings.usedAtoms)
             settings.url_database = molecular_search_settings.url_database
@@ -254,40 +459,15 @@ class MolecularCombinations:
             
             self.sql_db.session.commit()
             odd_ch_obj = self.get_carbonsHydrogens(settings,'odd')
-            self.odd_ch_id = [obj.id for obj in odd_ch_obj]
-            self.odd_ch_dict = [{'C':obj.C, 'H':obj.H} for obj in odd_ch_obj]
-            self.odd_ch_mass = [obj.mass for obj in odd_ch_obj]
-            self.odd_ch_dbe = [obj.dbe for obj in odd_ch_obj]
+            self.set_carbonsHydrogens_columns('odd', [obj.id for obj in odd_ch_obj], [obj.mass for obj in odd_ch_obj], [obj.dbe for obj in odd_ch_obj])
             
             even_ch_obj = self.get_carbonsHydrogens(settings, 'even')
-            self.even_ch_id = [obj.id for obj in even_ch_obj]
-            self.even_ch_dict = [{'C':obj.C, 'H':obj.H} for obj in even_ch_obj]
-            self.even_ch_mass = [obj.mass for obj in even_ch_obj]
-            self.even_ch_dbe = [obj.dbe for obj in even_ch_obj]
+            self.set_carbonsHydrogens_columns('even', [obj.id for obj in even_ch_obj], [obj.mass for obj in even_ch_obj], [obj.dbe for obj in even_ch_obj])
 
-            all_results= list()
-            for class_tuple in tqdm(class_to_create):
-                
-                results = self.populate_combinations(class_tuple, settings)
-                all_results.extend(results)
-                if settings.db_jobs == 1: 
-                    #if len(all_results) >= self.sql_db.chunks_count:
-                        list_insert_chunks = list(chunks(results, self.sql_db.chunks_count))
-                        for chunk in list_insert_chunks:
-                            insert_query = MolecularFormulaLink.__table__.insert().values(chunk)
-                            self.sql_db.session.execute(insert_query)
-                        #all_results = list()
-            self.sql_db.session.commit()
-            # each chunk takes ~600Mb of memory, so if using 8 processes the total free memory needs to be 5GB
-            if settings.db_jobs > 1: 
-                list_insert_chunks = list(chunks(all_results, self.sql_db.chunks_count))
-                print( "Started database insert using {} iterations for a total of {} rows".format(len(list_insert_chunks), len(all_results)))
-                worker_args = [(chunk, settings.url_database) for chunk in list_insert_chunks]
-                p = multiprocessing.Pool(settings.db_jobs)
-                for class_list in tqdm(p.imap_unordered(insert_database_worker, worker_args)):
-                    pass
-                p.close()
-                p.join()
+            # the formulas are generated per class and streamed to the database
+            self.insert_mol_formulas(class_to_create, settings)
+
+            self.sql_db.write_database_stamp()
         
         return classes_list
     
@@ -451,8 +631,6 @@ class MolecularCombinations:
         class_dict = classe_tuple[1]
         classe_id = classe_tuple[2]
         
-        results = list()
-        
         if 'HC' in class_dict:
             del class_dict['HC']
             
@@ -463,23 +641,14 @@ class MolecularCombinations:
         carbonHydrogen_dbe = self.odd_ch_dbe if odd_even_tag == 'odd' else self.even_ch_dbe 
         carbonHydrogen_id = self.odd_ch_id if odd_even_tag == 'odd' else self.even_ch_id 
         
-        for index, carbonHydrogen_obj in enumerate(carbonHydrogen_id):
-            
-            mass = carbonHydrogen_mass[index] + class_mass
-            dbe =  carbonHydrogen_dbe[index] + class_dbe
-    
-            if settings.min_mz <= mass <= settings.max_mz:
-                
-                if settings.min_dbe <= dbe <= settings.max_dbe:
-                    
-                    molecularFormula=  {"heteroAtoms_id":classe_id, 
-                            "carbonHydrogen_id":carbonHydrogen_id[index], 
-                            "mass":mass, "DBE":dbe}
-                    
-                    results.append(molecularFormula)
+        # all the carbon and hydrogen combinations at once
+        mass = carbonHydrogen_mass + class_mass
+        dbe =  carbonHydrogen_dbe + class_dbe
         
-        return results
+        mask = (settings.min_mz <= mass) & (mass <= settings.max_mz) & (settings.min_dbe <= dbe) & (dbe <= settings.max_dbe)
         
+        # columns: heteroAtoms_id, carbonHydrogen_id, mass, DBE
+        return full(mask.sum(), classe_id, dtype=int64), carbonHydrogen_id[mask], mass[mask], dbe[mask]
         
     def get_h_odd_or_even(self, class_dict):
 
@@ -2,29 +2,44 @@ import sys
 sys.path.append(".")
 import os
 
-from sqlalchemy import create_engine, ForeignKey, Column, Integer, String, Float, SMALLINT
-from sqlalchemy.orm import backref, column_property, relationship
+from sqlalchemy import ForeignKey, Column, Integer, String, Float, SMALLINT
+from sqlalchemy.orm import backref, column_property, deferred, relationship
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.sql.schema import UniqueConstraint
-from sqlalchemy import exc
+from sqlalchemy.schema import CreateIndex, CreateTable
 
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy.sql.operators import exists
-from sqlalchemy import event, and_
+from sqlalchemy import and_, select, inspect, Index, MetaData, Table
 from sqlalchemy import func
 
 from corems.encapsulation.constant import Atoms, Labels
 import json
+import uuid
+import weakref
+from types import MappingProxyType
+from numpy import int64
 from corems.encapsulation.factory.processingSetting import MolecularFormulaSearchSettings
-from sqlalchemy.orm.scoping import scoped_session
+from corems.molecular_id.factory.EngineRegistry import EngineRegistry
 from corems import chunks
 import tqdm
 
 Base = declarative_base()
 
+# parsed heteroatom classes, one read only mapping per class name shared by all the formulas of the class
+_class_dicts = {}
+
+def get_class_dict(classe):
+    '''the class name (json serialized dict) as a read only mapping, parsed once per class'''
+    class_dict = _class_dicts.get(classe)
+    
+    if class_dict is None:
+        class_dict = _class_dicts.setdefault(sys.intern(classe), MappingProxyType(json.loads(classe)))
+    
+    return class_dict
+
 class HeteroAtoms(Base):
    
     __tablename__ = 'heteroAtoms'
@@ -47,8 +62,8 @@ class HeteroAtoms(Base):
         return cls.halogensCount.cast(Float)
 
     def to_dict(self):
-        
-        return json.loads(self.name)
+        # a copy, the callers can change it
+        return dict(get_class_dict(self.name))
         
 
 class CarbonHydrogen(Base):
@@ -87,11 +102,28 @@ class CarbonHydrogen(Base):
     def dbe(cls):
         return float(cls.C) - float(cls.H/2) + 1
 
+# stored nominal m/z columns by ion type and ion charge
+nominal_mz_columns = {(Labels.protonated_de_ion, 1): 'protonated_pos', (Labels.protonated_de_ion, -1): 'protonated_neg',
+                      (Labels.radical_ion, 1): 'radical_pos', (Labels.radical_ion, -1): 'radical_neg'}
+
+def calc_nominal_mz_columns(masses):
+    '''nominal m/z of the neutral masses array for ion charge +1 and -1, 
+       same calculation as MolecularFormulaLink.protonated_mass and radical_mass'''
+    columns = {}
+    
+    for ion_charge, label in ((1, 'pos'), (-1, 'neg')):
+        columns['protonated_' + label] = ((masses + (ion_charge * Atoms.atomic_masses.get("H")) + (ion_charge * -1 * Atoms.electron_mass))/abs(ion_charge)).astype(int64)
+        columns['radical_' + label] = ((masses + (ion_charge * -1 * Atoms.electron_mass))/ abs(ion_charge)).astype(int64)
+    
+    return columns
+
 #264888.88 ms
 class MolecularFormulaLink(Base):
     
     __tablename__ = 'molecularformula'
-    __table_args__ = ( UniqueConstraint('heteroAtoms_id', 'carbonHydrogen_id', name='unique_molform'), )
+    # the nominal m/z queries of one class are index scans
+    __table_args__ = ( UniqueConstraint('heteroAtoms_id', 'carbonHydrogen_id', name='unique_molform'), 
+                       *(Index('ix_molformula_{}'.format(column), 'heteroAtoms_id', column) for column in nominal_mz_columns.values()) )
     
     #id = Column(Integer, primary_key=True,
     #                    unique=True,
@@ -111,6 +143,16 @@ class MolecularFormulaLink(Base):
     
     DBE = Column(Float)
     
+    # nominal m/z for ion charge +1 and -1, filled by MolecularCombinations, see calc_nominal_mz_columns
+    # deferred, databases created before these columns have to be upgraded with MolForm_SQL.upgrade_nominal_mz_columns()
+    protonated_pos = deferred(Column(Integer))
+    
+    protonated_neg = deferred(Column(Integer))
+    
+    radical_pos = deferred(Column(Integer))
+    
+    radical_neg = deferred(Column(Integer))
+
     carbonHydrogen = relationship(CarbonHydrogen, backref=backref("heteroAtoms_assoc"))
     
     heteroAtoms = relationship(HeteroAtoms, backref=backref("carbonHydrogen_assoc"))
@@ -124,12 +166,11 @@ class MolecularFormulaLink(Base):
     @property
     def formula_dict(self):
         
-        carbon = {'C': self.C, 'H': self.H}
-        classe = json.loads(self.classe)
-        if self.classe == '{"HC": ""}':
-            return {**carbon}
+        classe = self.classe
+        if classe == '{"HC": ""}':
+            return {'C': self.C, 'H': self.H}
         else:
-            return {**carbon, **classe}
+            return {'C': self.C, 'H': self.H, **get_class_dict(classe)}
 
     @property
     def formula_string(self):
@@ -139,7 +180,7 @@ class MolecularFormulaLink(Base):
 
     @property
     def classe_string(self):
-        class_dict = json.loads(self.classe)
+        class_dict = get_class_dict(self.classe)
         class_str = ' '.join([atom + str(class_dict[atom]) for atom in class_dict.keys()])
         return class_str.strip()
 
@@ -160,30 +201,135 @@ class MolecularFormulaLink(Base):
         return '<MolecularFormulaLink Model {}>'.format(self.formula_string)       
 
 
-class MolForm_SQL:
-    
-    def __init__(self, url=None, echo=False):
+# stored nominal m/z columns found in the molecularformula table by engine, see existing_nominal_mz_columns()
+_existing_nominal_mz_columns = weakref.WeakKeyDictionary()
+
+def existing_nominal_mz_columns(engine):
+    '''stored nominal m/z columns of the molecularformula table, checked once per engine'''
+    if engine not in _existing_nominal_mz_columns:
         
-        self.engine = self.init_engine(url)
+        table_columns = [column['name'] for column in inspect(engine).get_columns(MolecularFormulaLink.__tablename__)]
         
-        self.add_engine_pidguard(self.engine)
+        _existing_nominal_mz_columns[engine] = [column for column in nominal_mz_columns.values() if column in table_columns]
+
+    return _existing_nominal_mz_columns[engine]
+
+def partition_name(heteroAtoms_id):
+    '''molecularformula partition of one heteroatom class, see MolForm_SQL partition_by_class'''
+    return 'molecularformula_{}'.format(int(heteroAtoms_id))
+
+def partitioned_table_ddl(dialect):
+    '''PostgreSQL statements creating the molecularformula table partitioned by heteroatom class and its indexes,
+       the shared MolecularFormulaLink table is compiled as is and the partition clause appended'''
+    table = MolecularFormulaLink.__table__
+    
+    create_table = str(CreateTable(table).compile(dialect=dialect)).strip()
+    
+    statements = [create_table.replace('CREATE TABLE ', 'CREATE TABLE IF NOT EXISTS ', 1) + ' PARTITION BY LIST ("heteroAtoms_id")']
+    
+    for index in table.indexes:
+        statements.append(str(CreateIndex(index).compile(dialect=dialect)).strip().replace('CREATE INDEX ', 'CREATE INDEX IF NOT EXISTS ', 1))
+
+    return statements
+
+def class_partition_ddl(heteroAtoms_id):
+    '''PostgreSQL statement creating the molecularformula partition of one heteroatom class'''
+    return 'CREATE TABLE IF NOT EXISTS "{}" PARTITION OF "{}" FOR VALUES IN ({})'.format(partition_name(heteroAtoms_id), MolecularFormulaLink.__tablename__, int(heteroAtoms_id))
+
+# per connection temporary tables holding the classes and nominal m/z of a query,
+# SQLite limits the number of bound parameters of a statement (999), so long lists can not use in_()
+temp_metadata = MetaData()
+
+TempClasses = Table('temp_classes', temp_metadata, Column('name', String, primary_key=True), prefixes=['TEMPORARY'])
+
+TempNominalMzs = Table('temp_nominal_mzs', temp_metadata, Column('nominal_mz', Integer, primary_key=True), prefixes=['TEMPORARY'])
+
+# one row, a new stamp is written every time MolecularCombinations adds entries to the lookup tables,
+# used to check if data derived from the database (MolecularFormulaIndex) is outdated
+stamp_metadata = MetaData()
+
+DatabaseStamp = Table('databaseStamp', stamp_metadata, Column('id', Integer, primary_key=True), Column('stamp', String, nullable=False))
+
+class MolForm_SQL:
+    
+    # True when the stored nominal m/z columns exist and are filled, by engine, see use_nominal_mz_columns()
+    _nominal_mz_columns_filled = weakref.WeakKeyDictionary()
+
+    def __init__(self, url=None, echo=False, pool_size=None, max_overflow=None, partition_by_class=None):
         
-        session_factory = sessionmaker(bind=self.engine)
+        # engine and pool shared by all the MolForm_SQL objs of the process, see EngineRegistry
+        self.engine, session_factory = self.init_engine(url, pool_size, max_overflow, partition_by_class)
         
-        Session = scoped_session(session_factory)
+        self._partitioned = None
         
         self.session = session_factory()
         
-        Base.metadata.create_all(self.engine)
+    def use_nominal_mz_columns(self):
+        '''the stored nominal m/z columns are only queried when all of them exist and have no missing values, 
+           otherwise the nominal m/z is calculated from the mass'''
+        if self.engine not in MolForm_SQL._nominal_mz_columns_filled:
+            
+            filled = len(existing_nominal_mz_columns(self.engine)) == len(nominal_mz_columns)
+            
+            for column in nominal_mz_columns.values():
+                
+                if not filled: break
+                
+                filled = self.session.query(MolecularFormulaLink.heteroAtoms_id).filter(getattr(MolecularFormulaLink, column).is_(None)).first() is None
+            
+            MolForm_SQL._nominal_mz_columns_filled[self.engine] = filled
+
+        return MolForm_SQL._nominal_mz_columns_filled[self.engine]
 
+    def upgrade_nominal_mz_columns(self):
+        '''
+        databases created before the stored nominal m/z columns, adds, fills and indexes them, 
+        runs once on a database with write access, the search works without it but the nominal m/z is calculated for every row
+        only the rows with missing values are filled, an interrupted upgrade continues where it stopped
+        '''
+        table = MolecularFormulaLink.__table__
+        
         self.session.commit()
+
+        with self.engine.connect() as connection:
+            
+            if self.engine.dialect.name == 'postgresql':
+                # the engine is AUTOCOMMIT, the upgrade runs in one transaction
+                connection = connection.execution_options(isolation_level='READ COMMITTED')
+
+            with connection.begin():
+                
+                table_columns = [column['name'] for column in inspect(connection).get_columns(table.name)]
+                
+                table_indexes = [index['name'] for index in inspect(connection).get_indexes(table.name)]
+
+                for (ion_type, ion_charge), column in nominal_mz_columns.items():
+                    
+                    if column not in table_columns:
+                        connection.execute('ALTER TABLE "{}" ADD COLUMN "{}" INTEGER'.format(table.name, column))
+                    
+                    if ion_type == Labels.protonated_de_ion:
+                        mz = MolecularFormulaLink.protonated_mass(ion_charge)
+                    else:
+                        mz = MolecularFormulaLink.radical_mass(ion_charge)
+                    
+                    # int() truncation, the same as the search, PostgreSQL rounds on cast
+                    if self.type != 'sqlite': mz = func.floor(mz)
+                    
+                    connection.execute(table.update().where(table.c[column].is_(None)).values({column: mz.cast(Integer)}))
+
+                for index in table.indexes:
+                    if index.name not in table_indexes:
+                        index.create(connection)
         
+        _existing_nominal_mz_columns.pop(self.engine, None)
+        MolForm_SQL._nominal_mz_columns_filled.pop(self.engine, None)
+
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         # make sure the dbconnection gets closed
         
-        self.commit()
-        self.session.close()
-        self.engine.dispose()
+        self.close()
 
     def initiate_database(self, url, database_name): #CREATION
         
@@ -202,7 +348,7 @@ class MolForm_SQL:
             self.session.rollback()
             print(str(e))
 
-    def init_engine(self, url):
+    def init_engine(self, url, pool_size=None, max_overflow=None, partition_by_class=None):
         
         if not url or url == 'None' or url == 'False':
             directory = os.getcwd()
@@ -211,31 +357,154 @@ class MolForm_SQL:
             
             url = 'sqlite:///{DB}/db/molformulas.sqlite'.format(DB=directory)
 
+        if pool_size is None: pool_size = MolecularFormulaSearchSettings.db_pool_size
+        
+        if max_overflow is None: max_overflow = MolecularFormulaSearchSettings.db_max_overflow
+
+        if partition_by_class is None: partition_by_class = MolecularFormulaSearchSettings.db_partition_by_class
+
+        isolation_level = None
+
         if url[0:6] == 'sqlite':
             self.type = 'sqlite'
+            self.chunks_count = 50
+        
         else:
             self.type = 'normal'
             
-        if url[0:6] == 'sqlite':
-            engine = create_engine(url, echo = False)
-            self.chunks_count = 50
+            if url[0:10] == 'postgresql' or url[0:8] == 'postgres':
+                #postgresql
+                self.chunks_count = 50000
+                isolation_level = "AUTOCOMMIT"
+        
+        if partition_by_class and self.type != 'sqlite':
+            
+            # the partitioned table has to exist before the create_all of the other tables
+            engine, _ = EngineRegistry.get(url, None, pool_size, max_overflow, isolation_level)
+            
+            self.create_partitioned_table(engine)
+
+        return EngineRegistry.get(url, Base.metadata, pool_size, max_overflow, isolation_level)
+
+    @staticmethod
+    def is_partitioned_table(connection):
+        
+        query = 'SELECT count(*) FROM pg_partitioned_table JOIN pg_class ON pg_class.oid = pg_partitioned_table.partrelid WHERE pg_class.relname = \'{}\''
+        
+        return bool(connection.execute(query.format(MolecularFormulaLink.__tablename__)).scalar())
+
+    def create_partitioned_table(self, engine):
+        '''creates the PostgreSQL molecularformula table partitioned by heteroatom class, the partitions are added by add_class_partitions
+           raises an Exception when the table already exists without partitions'''
+        if engine.dialect.name != 'postgresql':
+            raise Exception('molecularformula partitions by class are only supported by PostgreSQL, not {}'.format(engine.dialect.name))
+
+        with engine.connect() as connection:
+            
+            if not engine.dialect.has_table(connection, MolecularFormulaLink.__tablename__):
+                
+                Base.metadata.create_all(connection, tables=[HeteroAtoms.__table__, CarbonHydrogen.__table__])
+                
+                for statement in partitioned_table_ddl(engine.dialect):
+                    connection.execute(statement)
+            
+            if not self.is_partitioned_table(connection):
+                raise Exception('partition_by_class is set but the existing molecularformula table of {} is not partitioned, '
+                                'use a new database or set db_partition_by_class to False'.format(engine.url))
+
+    def is_partitioned(self):
+        '''True when the molecularformula table is a PostgreSQL table partitioned by heteroatom class'''
+        if self._partitioned is None:
+            
+            self._partitioned = False
+            
+            if self.engine.dialect.name == 'postgresql':
+                
+                self._partitioned = self.is_partitioned_table(self.session)
+
+        return self._partitioned
+
+    def add_class_partitions(self, heteroAtoms_ids):
+        '''creates the molecularformula partitions of the new heteroatom classes, before their formulas are inserted'''
+        if not self.is_partitioned(): return
+
+        with self.engine.connect() as connection:
+            
+            for heteroAtoms_id in heteroAtoms_ids:
+                
+                connection.execute(class_partition_ddl(heteroAtoms_id))
+
+    def get_database_stamp(self):
+        '''the stamp of the last lookup tables change, None for databases written before the stamp'''
+        connection = self.session.connection()
         
-        elif url[0:10] == 'postgresql' or url[0:8] == 'postgres':
-            #postgresql
-            self.chunks_count = 50000
-            engine = create_engine(url, echo = False, isolation_level="AUTOCOMMIT")
+        if not self.engine.dialect.has_table(connection, DatabaseStamp.name): return None
+        
+        return connection.execute(select([DatabaseStamp.c.stamp]).where(DatabaseStamp.c.id == 1)).scalar()
+
+    def write_database_stamp(self):
+        '''new stamp, called after the lookup tables changed'''
+        self.session.commit()
         
-        return engine# poolclass=NullPool
+        with self.engine.begin() as connection:
+            
+            DatabaseStamp.create(connection, checkfirst=True)
+            connection.execute(DatabaseStamp.delete())
+            connection.execute(DatabaseStamp.insert().values(id=1, stamp=uuid.uuid4().hex))
 
     def __enter__(self):
         
         return self
     
+    def fill_temp_tables(self, classes, nominal_mzs):
+        '''loads the query lists into the temporary tables of the session connection, one row per bound parameter set'''
+        connection = self.session.connection()
+        
+        for table in (TempClasses, TempNominalMzs):
+            table.create(connection, checkfirst=True)
+            connection.execute(table.delete())
+
+        if classes:
+            connection.execute(TempClasses.insert(), [{'name': classe} for classe in set(classes)])
+        
+        if nominal_mzs:
+            connection.execute(TempNominalMzs.insert(), [{'nominal_mz': int(nominal_mz)} for nominal_mz in set(nominal_mzs)])
+
     def get_dict_by_classes(self, classes, ion_type, nominal_mzs, ion_charge, molecular_search_settings, adducts=None):
                                     
-        '''Known issue, when using SQLite:
-         if the number of classes and nominal_m/zs are higher than 999 the query will fail
-         Solution: use postgres or split query''' 
+        '''SQLite allows at most 999 bound parameters per query, 
+           the classes and nominal m/z are joined from temporary tables instead''' 
+        
+        if self.type == 'sqlite':
+            
+            self.fill_temp_tables(classes, nominal_mzs)
+
+        def in_classes(class_list):
+            
+            if self.type == 'sqlite':
+                return HeteroAtoms.name.in_(select([TempClasses.c.name]))
+            
+            if self.is_partitioned():
+                # constant class ids, the planner only scans the partitions of the classes
+                class_ids = [class_id for (class_id,) in self.session.query(HeteroAtoms.id).filter(HeteroAtoms.name.in_(class_list))]
+                return and_(HeteroAtoms.name.in_(class_list), MolecularFormulaLink.heteroAtoms_id.in_(class_ids))
+            
+            return HeteroAtoms.name.in_(class_list)
+
+        def in_nominal_mzs(nominal_expression):
+            
+            if self.type == 'sqlite':
+                return nominal_expression.in_(select([TempNominalMzs.c.nominal_mz]))
+            
+            return nominal_expression.in_(nominal_mzs)
+
+        def nominal_mz(ion_type, mass_expression):
+            # stored and indexed for ion charge +1 and -1
+            if (ion_type, ion_charge) in nominal_mz_columns and self.use_nominal_mz_columns():
+                return getattr(MolecularFormulaLink, nominal_mz_columns.get((ion_type, ion_charge)))
+            
+            return mass_expression.cast(Integer)
+
         def query_normal(class_list, len_adduct):
             
             base_query = self.session.query(MolecularFormulaLink, CarbonHydrogen, HeteroAtoms)\
@@ -244,7 +513,7 @@ class MolForm_SQL:
             
             return base_query.filter(
                 and_(
-                    HeteroAtoms.name.in_(class_list), 
+                    in_classes(class_list), 
                     and_(
                         MolecularFormulaLink.DBE >= molecular_search_settings.min_dbe, 
                         MolecularFormulaLink.DBE <= molecular_search_settings.max_dbe, 
@@ -282,9 +551,6 @@ class MolForm_SQL:
                 
                 nominal_mz = nominal_mass_by_ion_type(formula_obj)
                 
-                if self.type != 'normal':
-                    if not nominal_mz in nominal_mzs:
-                        continue
                 classe = classe_obj.name
 
                 #classe_str = formula.classe_string
@@ -328,24 +594,20 @@ class MolForm_SQL:
         query = query_normal(classes, len_adducts)
 
         if ion_type == Labels.protonated_de_ion:
-            if self.type == 'normal':
-                query = query.filter(and_(
-                                MolecularFormulaLink.protonated_mass(ion_charge).cast(Integer).in_(nominal_mzs)
-                                ))
+            query = query.filter(in_nominal_mzs(nominal_mz(ion_type, MolecularFormulaLink.protonated_mass(ion_charge))))
             return add_dict_formula(query, ion_type, ion_charge)
         
         if ion_type == Labels.radical_ion:
-            if self.type == 'normal':
-                query = query.filter(MolecularFormulaLink.radical_mass(ion_charge).cast(Integer).in_(nominal_mzs))    
+            query = query.filter(in_nominal_mzs(nominal_mz(ion_type, MolecularFormulaLink.radical_mass(ion_charge))))    
             return add_dict_formula(query, ion_type, ion_charge)
         
         if ion_type == Labels.adduct_ion:
             dict_res = {}
             if adducts: 
                 for atom in adducts:
-                    if self.type == 'normal':
-                        query = query.filter(MolecularFormulaLink.adduct_mass(ion_charge, atom).cast(Integer).in_(nominal_mzs))    
-                    dict_res[atom] = add_dict_formula(query, ion_type, ion_charge, adduct_atom=atom)
+                    # each adduct filters the base query, not the previous adduct query
+                    adduct_query = query.filter(in_nominal_mzs(MolecularFormulaLink.adduct_mass(ion_charge, atom).cast(Integer)))    
+                    dict_res[atom] = add_dict_formula(adduct_query, ion_type, ion_charge, adduct_atom=atom)
                 return dict_res
         # dump all objs to memory
         self.session.expunge_all()
@@ -394,42 +656,11 @@ class MolForm_SQL:
         self.session.commit()
 
     def close(self, commit=True):
-        # make sure the dbconnection gets closed
+        # make sure the dbconnection gets closed, the engine stays in the registry for the next sql obj
         
         if commit: self.commit()
         self.session.close()
-        self.engine.dispose()    
    
-    def add_engine_pidguard(self, engine):
-        import os, warnings
-        """Add multiprocessing guards.
-
-        Forces a connection to be reconnected if it is detected
-        as having been shared to a sub-process.
-
-        """
-
-        @event.listens_for(engine, "connect")
-        def connect(dbapi_connection, connection_record):
-            connection_record.info['pid'] = os.getpid()
-
-        @event.listens_for(engine, "checkout")
-        def checkout(dbapi_connection, connection_record, connection_proxy):
-            pid = os.getpid()
-            if connection_record.info['pid'] != pid:
-                # substitute log.debug() or similar here as desired
-                warnings.warn(
-                    "Parent process %(orig)s forked (%(newproc)s) with an open "
-                    "database connection, "
-                    "which is being discarded and recreated." %
-                    {"newproc": pid, "orig": connection_record.info['pid']})
-                connection_record.connection = connection_proxy.connection = None
-                raise exc.DisconnectionError(
-                    "Connection record belongs to pid %s, "
-                    "attempting to check out in pid %s" %
-                    (connection_record.info['pid'], pid)
-                )    
-
 if __name__ == "__main__":
     
     sql = MolForm_SQL(url='sqlite:///')
@@ -23,7 +23,9 @@ class LowResMassSpectralMatch(Thread):
         self.calibration = calibration
         # reading local file for now, 
         if not sql_obj:
-            self.sql_obj = EI_LowRes_SQLite(url=self.gcms_obj.molecular_search_settings.url_database)
+            search_settings = self.gcms_obj.molecular_search_settings
+            self.sql_obj = EI_LowRes_SQLite(url=search_settings.url_database, 
+                                            pool_size=search_settings.db_pool_size, max_overflow=search_settings.db_max_overflow)
         else:
             self.sql_obj = sql_obj
 
@@ -125,5 +127,5 @@ class LowResMassSpectralMatch(Thread):
                         gc_peak.add_compound(ref_obj, spectral_similarity_scores, ri_score, similarity_score)
                 
             
-        self.sql_obj.session.close()
-        self.sql_obj.engine.dispose()
\ No newline at end of file
+        # the engine is kept for the next gcms obj
+        self.sql_obj.session.close()
\ No newline at end of file
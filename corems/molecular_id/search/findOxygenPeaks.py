@@ -55,7 +55,9 @@ class FindOxygenPeaks(Thread):
         
         if not sql_db:
             
-            self.sql_db = MolForm_SQL(mass_spectrum_obj.molecular_search_settings.url_database)
+            search_settings = mass_spectrum_obj.molecular_search_settings
+            self.sql_db = MolForm_SQL(search_settings.url_database, pool_size=search_settings.db_pool_size, max_overflow=search_settings.db_max_overflow, 
+                                      partition_by_class=search_settings.db_partition_by_class)
         else:
 
             self.sql_db = sql_db    
@@ -1,28 +1,167 @@
 __author__ = "Yuri E. Corilo"
 __date__ = "Jul 29, 2019"
 
+import hashlib
+import json
 import multiprocessing
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from types import BuiltinFunctionType, FunctionType, MethodType, ModuleType
 
 import tqdm
+from numpy import append, array, argsort, searchsorted, float64, int64, ndarray, unique
 from sqlalchemy.types import Binary
 from sqlalchemy.sql.sqltypes import Integer
 
 
 from corems import chunks, timeit
 from corems.encapsulation.constant import Atoms, Labels
-from corems.molecular_formula.factory.MolecularFormulaFactory import MolecularFormula
+from corems.molecular_formula.factory.MolecularFormulaFactory import MolecularFormula, MolecularFormulaIsotopologue
 from corems.molecular_id.factory.molecularSQL import MolForm_SQL, MolecularFormulaLink
 from corems.molecular_id.calc.ClusterFilter import ClusteringFilter
 from corems.molecular_id.calc.MolecularFilter import MolecularFormulaSearchFilters
 from corems.molecular_id.factory.MolecularLookupTable import MolecularCombinations
+from corems.molecular_id.factory.MolecularFormulaIndex import MolecularFormulaIndex
 import cProfile
 
 
-last_error = 0
-last_dif = 0
-closest_error = 0
-error_average = 0
-nbValues = 0
+def deep_getsizeof(obj, seen, max_depth=4):
+    
+    '''size of obj plus the objects it references (containers, __dict__ and __slots__) up to max_depth levels, 
+       the objects in seen {id: obj} are not counted again, classes, modules, functions and weakrefs are skipped'''
+
+    size, stack = 0, [(obj, 0)]
+
+    while stack:
+
+        obj, depth = stack.pop()
+
+        if id(obj) in seen or isinstance(obj, (type, ModuleType, FunctionType, BuiltinFunctionType, MethodType, weakref.ref)):
+            continue
+
+        # keeps a reference, the id of a freed obj can be reused
+        seen[id(obj)] = obj
+
+        size = size + sys.getsizeof(obj)
+
+        if depth == max_depth: continue
+
+        references = []
+
+        if isinstance(obj, dict):
+            references.extend(obj.keys())
+            references.extend(obj.values())
+
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            references.extend(obj)
+
+        obj_dict = getattr(obj, '__dict__', None)
+        
+        if isinstance(obj_dict, dict):
+            references.append(obj_dict)
+
+        for obj_type in type(obj).__mro__:
+            
+            slots = obj_type.__dict__.get('__slots__', ())
+            
+            for slot in ((slots,) if isinstance(slots, str) else slots):
+                
+                descriptor = obj_type.__dict__.get(slot)
+                
+                # the slot descriptor does not trigger __getattr__ of lazy attributes
+                if slot not in ('__dict__', '__weakref__') and descriptor is not None:
+                    try:
+                        references.append(descriptor.__get__(obj, obj_type))
+                    except AttributeError:
+                        pass
+
+        stack.extend((reference, depth + 1) for reference in references)
+
+    return size
+
+# per process state of the parallel search, set by init_search_worker
+worker_search = None
+worker_ms_peaks = None
+
+def init_search_worker(peaks_shm_name, n_peaks, indexes_shm_name, n_searched, ion_charge, 
+                       baselise_noise, baselise_noise_std, dynamic_range, molecular_search_settings, find_isotopologues):
+    
+    '''rebuilds the mass spectrum from the shared memory arrays, once per process'''
+    
+    from corems.mass_spectrum.factory.MassSpectrumClasses import MassSpecCentroid
+    from corems.mass_spectrum.input.numpyArray import get_output_parameters
+
+    global worker_search, worker_ms_peaks
+
+    peaks_shm = shared_memory.SharedMemory(name=peaks_shm_name)
+    indexes_shm = shared_memory.SharedMemory(name=indexes_shm_name)
+    
+    peak_table = ndarray((4, n_peaks), dtype=float64, buffer=peaks_shm.buf)
+    searched_indexes = ndarray((n_searched,), dtype=int64, buffer=indexes_shm.buf).tolist()
+
+    data_dict = {Labels.mz: peak_table[0].tolist(), Labels.abundance: peak_table[1].tolist(), 
+                 Labels.rp: peak_table[2].tolist(), Labels.s2n: peak_table[3].tolist()}
+    
+    # the buffer can only be released after all the views are gone
+    del peak_table
+    peaks_shm.close()
+    indexes_shm.close()
+
+    # the noise was already calculated on the parent mass spectrum
+    d_params = get_output_parameters(ion_charge, 'search worker')
+    d_params[Labels.label] = Labels.thermo_centroid
+    d_params["baselise_noise"] = baselise_noise
+    d_params["baselise_noise_std"] = baselise_noise_std
+    
+    mass_spectrum = MassSpecCentroid(data_dict, d_params)
+    mass_spectrum.molecular_search_settings = molecular_search_settings
+    mass_spectrum._dynamic_range = dynamic_range
+
+    worker_search = SearchMolecularFormulas(mass_spectrum, find_isotopologues=find_isotopologues)
+    worker_ms_peaks = [mass_spectrum[index] for index in searched_indexes]
+
+def search_classes_worker(args):
+    
+    '''
+    searches one chunk of heteroatom classes and returns the assignments as
+    (mspeak index, formula dict, [(isotopologue formula dict, prob_ratio, [isotopologue mspeak indexes])])
+    the assignments are removed from the worker mspeaks so the next chunk starts clean
+    '''
+    
+    classe_chunk, nominal_mzs, min_abundance, ion_charge = args
+    
+    mass_spectrum = worker_search.mass_spectrum_obj
+    
+    classes_str_list = [class_tuple[0] for class_tuple in classe_chunk]
+    
+    dict_res = worker_search.database_to_dict(classes_str_list, nominal_mzs, mass_spectrum.molecular_search_settings, ion_charge)
+    
+    assigned_indexes = worker_search.search_classes(worker_ms_peaks, classe_chunk, dict_res, min_abundance, ion_charge, progress=False)
+
+    assignments = []
+    
+    for ms_peak_index, molecular_formula in assigned_indexes:
+        
+        expected_isotopologues = []
+        
+        for isotopologue_formula in molecular_formula.expected_isotopologues:
+            
+            ms_peak_iso_indexes = [ms_peak_iso_index for ms_peak_iso_index, x in molecular_formula.mspeak_mf_isotopologues_indexes if x is isotopologue_formula]
+            
+            expected_isotopologues.append((isotopologue_formula.to_dict(), isotopologue_formula.prob_ratio, ms_peak_iso_indexes))
+        
+        assignments.append((ms_peak_index, molecular_formula.to_dict(), expected_isotopologues))
+
+        mass_spectrum[ms_peak_index].molecular_formulas.clear()
+        
+        for ms_peak_iso_index, x in molecular_formula.mspeak_mf_isotopologues_indexes:
+            
+            mass_spectrum[ms_peak_iso_index].molecular_formulas.clear()
+    
+    return assignments
 
 class SearchMolecularFormulas:
      
@@ -39,12 +178,17 @@ class SearchMolecularFormulas:
         
         if not sql_db:
 
-            self.sql_db = MolForm_SQL(url=mass_spectrum_obj.molecular_search_settings.url_database)
+            search_settings = mass_spectrum_obj.molecular_search_settings
+            self.sql_db = MolForm_SQL(url=search_settings.url_database, pool_size=search_settings.db_pool_size, max_overflow=search_settings.db_max_overflow, 
+                                      partition_by_class=search_settings.db_partition_by_class)
         
         else:
             
             self.sql_db = sql_db
 
+        # ppm window and running errors of this search, used by the dynamic error methods
+        self.error_state = SearchErrorState(mass_spectrum_obj.molecular_search_settings)
+
     def __enter__(self):
 
         return self
@@ -72,16 +216,76 @@ class SearchMolecularFormulas:
             list_formulas_candidates = []
             
             for nominal_mass in nominal_masses:
-                if nominal_mass in query.keys():   
-                    list_formulas_candidates.extend(query.get(nominal_mass))
+                if nominal_mass in nominal_query.keys():   
+                    list_formulas_candidates.extend(nominal_query.get(nominal_mass))
 
             return list_formulas_candidates
             
         all_assigned_indexes = list()
 
-        # molecular_search_settings = self.mass_spectrum_obj.molecular_search_settings
+        # query is a dict {nominal m/z : [formulas]} or MolecularFormulaCandidates from the formula cache 
+        nominal_query = query.query if isinstance(query, MolecularFormulaCandidates) else query
+
+        molecular_search_settings = self.mass_spectrum_obj.molecular_search_settings
+        
+        search_molfrom = SearchMolecularFormulaWorker(find_isotopologues=self.find_isotopologues, error_state=self.error_state)
+
+        fixed_window = molecular_search_settings.error_method not in SearchMolecularFormulaWorker.dynamic_error_methods
         
-        search_molfrom = SearchMolecularFormulaWorker(find_isotopologues=self.find_isotopologues)
+        use_batch_search = molecular_search_settings.use_batch_search and fixed_window
+
+        if use_batch_search or molecular_search_settings.use_mass_defect_buckets:
+            
+            if isinstance(query, MolecularFormulaCandidates):
+                candidates = query
+            else:
+                candidates = MolecularFormulaCandidates(query, ion_type, ion_charge, adduct_atom=adduct_atom)
+            
+            if not candidates: return all_assigned_indexes
+
+            mspeaks = list(mspeaks)
+
+        # the ppm window is fixed during the search, all peaks can be matched at once
+        if use_batch_search:
+            
+            mz_exp = array([ms_peak.mz_exp for ms_peak in mspeaks], dtype=float64)
+
+            first_indexes, last_indexes = candidates.match(mz_exp, self.error_state.min_ppm_error, self.error_state.max_ppm_error)
+            
+            for ms_peak, first_index, last_index in zip(mspeaks, first_indexes, last_indexes):
+                
+                if first_index == last_index: continue
+
+                if self.first_hit: 
+                
+                    if ms_peak.is_assigned: continue
+                
+                ms_peak_indexes = search_molfrom.find_formulas(candidates[first_index:last_index], min_abundance, self.mass_spectrum_obj, ms_peak, ion_type, ion_charge, adduct_atom)    
+
+                all_assigned_indexes.extend(ms_peak_indexes)
+            
+            return all_assigned_indexes
+
+        # the ppm window can move after every match, each peak only gets the candidates of the mass defect buckets around its current window
+        if molecular_search_settings.use_mass_defect_buckets:
+            
+            n_buckets, buckets = candidates.get_mass_defect_buckets(molecular_search_settings.min_ppm_error, molecular_search_settings.max_ppm_error)
+
+            for ms_peak in mspeaks:
+
+                if self.first_hit: 
+                
+                    if ms_peak.is_assigned: continue
+
+                first_index, last_index = candidates.match_by_buckets(ms_peak.mz_exp, self.error_state.min_ppm_error, self.error_state.max_ppm_error, n_buckets, buckets)
+                
+                if first_index == last_index: continue
+
+                ms_peak_indexes = search_molfrom.find_formulas(candidates[first_index:last_index], min_abundance, self.mass_spectrum_obj, ms_peak, ion_type, ion_charge, adduct_atom)    
+
+                all_assigned_indexes.extend(ms_peak_indexes)
+            
+            return all_assigned_indexes
 
         for ms_peak in mspeaks:
 
@@ -100,6 +304,8 @@ class SearchMolecularFormulas:
 
         #MolecularFormulaSearchFilters().check_min_peaks(all_assigned_indexes, self.mass_spectrum_obj)
         #filter per min peaks per mono isotopic class
+
+        return all_assigned_indexes
     
                             
     def run_worker_mass_spectrum(self):
@@ -113,31 +319,40 @@ class SearchMolecularFormulas:
     @staticmethod
     def database_to_dict(classe_str_list, nominal_mzs, mf_search_settings, ion_charge):
         
-        sql_db = MolForm_SQL(url=mf_search_settings.url_database)
+        # the classes chunks reuse the process wide engine of the database url
+        sql_db = MolForm_SQL(url=mf_search_settings.url_database, pool_size=mf_search_settings.db_pool_size, max_overflow=mf_search_settings.db_max_overflow, 
+                             partition_by_class=mf_search_settings.db_partition_by_class)
         
+        if mf_search_settings.use_formula_index:
+            # memory mapped copy of the lookup tables, avoids the sql join for every classes chunk
+            formula_index = MolecularFormulaIndex.from_sql_db(sql_db)
+            sql_db.close()
+            sql_db = formula_index
+
         dict_res = {}
 
-        if mf_search_settings.isProtonated:
-            dict_res[Labels.protonated_de_ion] = sql_db.get_dict_by_classes(classe_str_list, Labels.protonated_de_ion, nominal_mzs, ion_charge, mf_search_settings)    
+        try:
             
-        if mf_search_settings.isRadical:
-            dict_res[Labels.radical_ion] = sql_db.get_dict_by_classes(classe_str_list, Labels.radical_ion, nominal_mzs, ion_charge,  mf_search_settings)    
+            if mf_search_settings.isProtonated:
+                dict_res[Labels.protonated_de_ion] = sql_db.get_dict_by_classes(classe_str_list, Labels.protonated_de_ion, nominal_mzs, ion_charge, mf_search_settings)    
+                
+            if mf_search_settings.isRadical:
+                dict_res[Labels.radical_ion] = sql_db.get_dict_by_classes(classe_str_list, Labels.radical_ion, nominal_mzs, ion_charge,  mf_search_settings)    
 
-        if mf_search_settings.isAdduct:
-            
-            adduct_list = mf_search_settings.adduct_atoms_neg if ion_charge < 0 else mf_search_settings.adduct_atoms_pos
-            dict_res[Labels.adduct_ion] = sql_db.get_dict_by_classes(classe_str_list, Labels.adduct_ion, nominal_mzs, ion_charge, mf_search_settings, adducts=adduct_list)    
+            if mf_search_settings.isAdduct:
+                
+                adduct_list = mf_search_settings.adduct_atoms_neg if ion_charge < 0 else mf_search_settings.adduct_atoms_pos
+                dict_res[Labels.adduct_ion] = sql_db.get_dict_by_classes(classe_str_list, Labels.adduct_ion, nominal_mzs, ion_charge, mf_search_settings, adducts=adduct_list)    
+        
+        finally:
+            # returns the connection to the pool, an open SQLite read transaction blocks the writers
+            if not mf_search_settings.use_formula_index: sql_db.close(commit=False)
             
         return dict_res
 
     @timeit                    
     def run_molecular_formula(self, ms_peaks):
 
-        #number_of_process = multiprocessing.cpu_count()
-
-        '''loading this on a shared memory would be better than having to serialize it for every process
-            waiting for python 3.8 release'''
-       
         # ion charge for all the ion in the mass spectrum
         # under the current structure is possible to search for individual m/z but it takes longer than allow all the m/z to be search against
         ion_charge = self.mass_spectrum_obj.polarity
@@ -147,84 +362,199 @@ class SearchMolecularFormulas:
 
         # only query the database for formulas with the nominal m/z matching the mass spectrum data
         # default m/z overlay is m/z 0.3 unit
-        # needs to improve to bin by mass defect instead, faster db creation and faster search execution time 
+        # the candidates are then matched by m/z window (run_search), or by mass defect bucket when the window moves
         nominal_mzs = self.mass_spectrum_obj.nominal_mz
 
         # reset average error, only relevant is average mass error method is being used
-        SearchMolecularFormulaWorker(find_isotopologues=self.find_isotopologues).reset_error(self.mass_spectrum_obj)
+        self.error_state.reset()
 
         # check database for all possible molecular formula combinations based on the setting passed to self.mass_spectrum_obj.molecular_search_settings
-        classes = MolecularCombinations(self.sql_db).runworker(self.mass_spectrum_obj.molecular_search_settings)
+        molecular_search_settings = self.mass_spectrum_obj.molecular_search_settings
         
-        # split the database load to not blowout the memory
-        # TODO add to the settings
+        use_cache = molecular_search_settings.formula_cache_bytes > 0
+
+        if use_cache:
+            classes = formula_cache.get_classes(self.sql_db, molecular_search_settings)
+        else:
+            classes = MolecularCombinations(self.sql_db).runworker(molecular_search_settings)
         
-        def run():
+        # the dynamic error methods and first_hit depend on the assignments of the previous classes, they can only run serially
+        if molecular_search_settings.search_jobs > 1 and not self.first_hit and molecular_search_settings.error_method not in SearchMolecularFormulaWorker.dynamic_error_methods:
+            
+            self.run_molecular_formula_parallel(ms_peaks, classes, nominal_mzs, min_abundance, ion_charge)
+        
+        else:
             
+            # split the database load to not blowout the memory
+            # TODO add to the settings
             for classe_chunk in chunks(classes, 300): 
                 
                 classes_str_list = [class_tuple[0] for class_tuple in classe_chunk]
                 
                 # load the molecular formula objs binned by ion type and heteroatoms classes, {ion type:{classe:[list_formula]}}
                 # for adduct ion type a third key is added {atoms:{ion type:{classe:[list_formula]}}} 
-                dict_res = self.database_to_dict(classes_str_list, nominal_mzs, self.mass_spectrum_obj.molecular_search_settings, ion_charge)
+                if use_cache:
+                    dict_res = formula_cache.get_dict_by_classes(classes_str_list, nominal_mzs, molecular_search_settings, ion_charge)
+                else:
+                    dict_res = self.database_to_dict(classes_str_list, nominal_mzs, molecular_search_settings, ion_charge)
                 
-                pbar = tqdm.tqdm(classe_chunk)
+                self.search_classes(ms_peaks, classe_chunk, dict_res, min_abundance, ion_charge)
+
+        self.sql_db.close()     
+
+    def search_classes(self, ms_peaks, classe_chunk, dict_res, min_abundance, ion_charge, progress=True):
+        
+        '''returns the (mspeak index, molecular formula obj) of all the assignments in the order they were made'''
+
+        all_assigned_indexes = list()
+        
+        pbar = tqdm.tqdm(classe_chunk, disable=not progress)
+        
+        for classe_tuple in pbar:
+            
+            # class string is a json serialized dict
+            classe_str  = classe_tuple[0]
+            classe_dict = classe_tuple[1]
+            
+            if self.mass_spectrum_obj.molecular_search_settings.isProtonated:
+                    
+                ion_type = Labels.protonated_de_ion
+
+                pbar.set_description_str(desc="Started molecular formula search for class %s, (de)protonated " % classe_str, refresh=True)
                 
-                for classe_tuple in pbar:
+                candidate_formulas = dict_res.get(ion_type).get(classe_str)
+
+                if candidate_formulas:
                     
-                    # class string is a json serialized dict
-                    classe_str  = classe_tuple[0]
-                    classe_dict = classe_tuple[1]
+                    all_assigned_indexes.extend(self.run_search(ms_peaks, candidate_formulas,
+                                min_abundance, ion_type, ion_charge))
+
+            if self.mass_spectrum_obj.molecular_search_settings.isRadical:
                     
-                    if self.mass_spectrum_obj.molecular_search_settings.isProtonated:
-                            
-                        ion_type = Labels.protonated_de_ion
+                pbar.set_description_str(desc="Started molecular formula search for class %s, radical " % classe_str, refresh=True)
+                
+                ion_type = Labels.radical_ion
+                
+                candidate_formulas = dict_res.get(ion_type).get(classe_str)
 
-                        pbar.set_description_str(desc="Started molecular formula search for class %s, (de)protonated " % classe_str, refresh=True)
-                        
-                        candidate_formulas = dict_res.get(ion_type).get(classe_str)
+                if candidate_formulas:
 
-                        if candidate_formulas:
-                            
-                            self.run_search(ms_peaks, candidate_formulas,
-                                        min_abundance, ion_type, ion_charge)
+                    all_assigned_indexes.extend(self.run_search(ms_peaks, candidate_formulas,
+                                min_abundance, ion_type, ion_charge))
+            # looks for adduct, used_atom_valences should be 0 
+            # this code does not support H exchance by halogen atoms
+            if self.mass_spectrum_obj.molecular_search_settings.isAdduct:
+                
+                pbar.set_description_str(desc="Started molecular formula search for class %s, adduct " % classe_str, refresh=True)
+                
+                ion_type = Labels.adduct_ion
+                dict_atoms_formulas =  dict_res.get(ion_type)
+                
+                for adduct_atom, dict_by_class in dict_atoms_formulas.items():
+                    
+                    candidate_formulas = dict_by_class.get(classe_str)
+                    
+                    if candidate_formulas:
+                        all_assigned_indexes.extend(self.run_search(ms_peaks, candidate_formulas,
+                                    min_abundance, ion_type, ion_charge, adduct_atom=adduct_atom))
+        
+        return all_assigned_indexes
 
-                    if self.mass_spectrum_obj.molecular_search_settings.isRadical:
-                            
-                        pbar.set_description_str(desc="Started molecular formula search for class %s, radical " % classe_str, refresh=True)
-                        
-                        ion_type = Labels.radical_ion
-                        
-                        candidate_formulas = dict_res.get(ion_type).get(classe_str)
+    def run_molecular_formula_parallel(self, ms_peaks, classes, nominal_mzs, min_abundance, ion_charge):
+        
+        '''
+        fans out the heteroatom classes chunks to a process pool, 
+        the peaks m/z, abundance, resolving power and s/n are shared with the workers using shared memory
+        the workers return the assignments as plain dicts and they are added back to the mspeaks in the chunk order, 
+        so the result is the same as the serial search and does not depend on which worker finishes first
+        '''
 
-                        if candidate_formulas:
+        molecular_search_settings = self.mass_spectrum_obj.molecular_search_settings
 
-                            self.run_search(ms_peaks, candidate_formulas,
-                                        min_abundance, ion_type, ion_charge)
-                    # looks for adduct, used_atom_valences should be 0 
-                    # this code does not support H exchance by halogen atoms
-                    if self.mass_spectrum_obj.molecular_search_settings.isAdduct:
-                        
-                        pbar.set_description_str(desc="Started molecular formula search for class %s, adduct " % classe_str, refresh=True)
-                        
-                        ion_type = Labels.adduct_ion
-                        dict_atoms_formulas =  dict_res.get(ion_type)
+        mspeaks = self.mass_spectrum_obj.mspeaks
+        
+        searched_indexes = array([ms_peak.index for ms_peak in ms_peaks], dtype=int64)
+        
+        if molecular_search_settings.use_formula_index:
+            # builds the index before forking, so the workers don't race to build it
+            MolecularFormulaIndex.from_sql_db(self.sql_db)
+
+        peaks_shm = shared_memory.SharedMemory(create=True, size=max(4 * len(mspeaks) * 8, 1))
+        indexes_shm = shared_memory.SharedMemory(create=True, size=max(searched_indexes.nbytes, 1))
+        
+        try:
+            
+            peak_table = ndarray((4, len(mspeaks)), dtype=float64, buffer=peaks_shm.buf)
+            peak_table[0] = [ms_peak.mz_exp for ms_peak in mspeaks]
+            peak_table[1] = [ms_peak.abundance for ms_peak in mspeaks]
+            peak_table[2] = [ms_peak.resolving_power for ms_peak in mspeaks]
+            peak_table[3] = [ms_peak.signal_to_noise for ms_peak in mspeaks]
+            
+            ndarray(searched_indexes.shape, dtype=int64, buffer=indexes_shm.buf)[:] = searched_indexes
+            
+            del peak_table
+            
+            initargs = (peaks_shm.name, len(mspeaks), indexes_shm.name, len(searched_indexes), 
+                        ion_charge, self.mass_spectrum_obj.baselise_noise, self.mass_spectrum_obj.baselise_noise_std, 
+                        self.mass_spectrum_obj.dynamic_range, molecular_search_settings, self.find_isotopologues)
+            
+            # smaller chunks than the serial search to keep all the workers busy
+            jobs_args = [(classe_chunk, nominal_mzs, min_abundance, ion_charge) for classe_chunk in chunks(classes, 30)]
+            
+            pool = multiprocessing.Pool(molecular_search_settings.search_jobs, initializer=init_search_worker, initargs=initargs)
+            
+            try:
+                
+                # imap keeps the chunk order
+                for chunk_assignments in tqdm.tqdm(pool.imap(search_classes_worker, jobs_args), total=len(jobs_args)):
+                    
+                    for assignment in chunk_assignments:
                         
-                        for adduct_atom, dict_by_class in dict_atoms_formulas.items():
-                            
-                            candidate_formulas = dict_by_class.get(classe_str)
-                            
-                            if candidate_formulas:
-                                self.run_search(ms_peaks, candidate_formulas,
-                                            min_abundance, ion_type, ion_charge, adduct_atom=adduct_atom)
+                        self.add_assignment(assignment, ion_charge)
+            
+            finally:
+                
+                pool.close()
+                pool.join()
+        
+        finally:
+            
+            peaks_shm.close()
+            peaks_shm.unlink()
+            indexes_shm.close()
+            indexes_shm.unlink()
 
-        run()
-        self.sql_db.close()     
+    def add_assignment(self, assignment, ion_charge):
+        
+        '''recreates the molecular formula and isotopologues returned by search_classes_worker and adds them to the mspeaks'''
+
+        ms_peak_index, formula_dict, expected_isotopologues = assignment
+        
+        ms_peak = self.mass_spectrum_obj[ms_peak_index]
+
+        molecular_formula = MolecularFormula(formula_dict, ion_charge)
+
+        for isotopologue_dict, prob_ratio, ms_peak_iso_indexes in expected_isotopologues:
+            
+            isotopologue_formula = MolecularFormulaIsotopologue(isotopologue_dict, prob_ratio, ms_peak.abundance, ion_charge)
+            
+            molecular_formula.expected_isotopologues.append(isotopologue_formula)
+            
+            for ms_peak_iso_index in ms_peak_iso_indexes:
+                
+                isotopologue_formula.mspeak_index_mono_isotopic = ms_peak.index
+                
+                isotopologue_formula.mono_isotopic_formula_index = len(ms_peak)
+                
+                x = self.mass_spectrum_obj[ms_peak_iso_index].add_molecular_formula(isotopologue_formula)
+                
+                molecular_formula.mspeak_mf_isotopologues_indexes.append((ms_peak_iso_index, x))
+
+        ms_peak.add_molecular_formula(molecular_formula)
 
     def search_mol_formulas(self,  possible_formulas_list, find_isotopologues=True):
 
-        SearchMolecularFormulaWorker(find_isotopologues=find_isotopologues).reset_error(self.mass_spectrum_obj)
+        self.error_state.reset()
 
         initial_min_peak_bool = self.mass_spectrum_obj.molecular_search_settings.use_min_peaks_filter
         initial_runtime_kendrick_filter = self.mass_spectrum_obj.molecular_search_settings.use_runtime_kendrick_filter
@@ -260,65 +590,472 @@ class SearchMolecularFormulas:
         return mspeaks
     
             
-class SearchMolecularFormulaWorker:
+class MolecularFormulaCandidates:
     
-    #TODO add reset error function
-    # needs this warper to pass the class to multiprocessing
+    '''
+    Holds the candidates of one heteroatom class and ion type sorted by the calculated m/z, 
+    so all peaks of a mass spectrum can be matched against the ppm window in a single searchsorted pass 
     
-    def __init__(self, find_isotopologues=True):
-        self.find_isotopologues = find_isotopologues
+    Parameters
+    ----------
+    query : dict{int: list(MolecularFormulaLink)}
+        candidates binned by nominal m/z, as returned by MolForm_SQL.get_dict_by_classes
+    ion_type : str
+        Labels.protonated_de_ion, Labels.radical_ion, Labels.adduct_ion or 'unknown' for formulas with m/z set as mass
+    '''
     
-    def __call__(self, args):
+    # widens the window to avoid losing candidates at the boundaries due floating point rounding, 
+    # the exact error is checked again inside find_formulas
+    window_tolerance = 1e-9
 
-        return self.find_formulas(*args)  # ,args[1]
+    # estimated bytes per formula obj by formula type, see formula_nbytes()
+    _formula_nbytes = {}
 
-    def reset_error(self, mass_spectrum_obj):
-        global last_error, last_dif, closest_error, error_average, nbValues  
-        last_error, last_dif, closest_error, nbValues  = 0.0, 0.0, 0.0, 0.0
+    def __init__(self, query, ion_type, ion_charge, adduct_atom=None, nominal_range=None):
+        
+        formulas = [possible_formula for nominal_mz in sorted(query.keys()) for possible_formula in query.get(nominal_mz) if possible_formula]
         
-        error_average = 0
+        mz_calc = array([self.mass_by_ion_type(possible_formula, ion_type, ion_charge, adduct_atom) for possible_formula in formulas], dtype=float64)
+        
+        # stable sort keeps the database order for candidates with the same m/z
+        sorted_indexes = argsort(mz_calc, kind='mergesort')
+        
+        self.mz_calc = mz_calc[sorted_indexes]
+        
+        self.formulas = [formulas[index] for index in sorted_indexes]
 
-    def set_last_error(self, error, mass_spectrum_obj ):
+        # keeps the nominal m/z bins for the serial search
+        self.query = query
+
+        # mass defect buckets by number of buckets per m/z unit, see get_mass_defect_buckets()
+        self._buckets = {}
+
+        # (first, last) nominal m/z loaded from the database, used by MolecularFormulaCache
+        self.nominal_range = nominal_range
+
+    def __len__(self):
+
+        return len(self.formulas)
+
+    def __getitem__(self, position):
+
+        return self.formulas[position]
+
+    def covers(self, nominal_range):
+
+        return self.nominal_range is not None and self.nominal_range[0] <= nominal_range[0] and nominal_range[1] <= self.nominal_range[1]
+
+    @classmethod
+    def formula_nbytes(cls, formulas, sample_size=8):
+        
+        '''
+        estimated memory of one formula obj including its attributes (boxed floats, __dict__, ORM instance state), 
+        measured once per formula type as the size added by a second sample, so the objects shared by all the formulas are not counted
+        '''
         
-        #set the changes to the global variables, not internal ones
-        global last_error, last_dif, closest_error, error_average, nbValues  
+        formula_type = type(formulas[0])
+
+        if formula_type not in cls._formula_nbytes:
+
+            sample_size = min(sample_size, len(formulas) // 2)
+            
+            seen = {}
+            
+            if sample_size:
+            
+                deep_getsizeof(formulas[:sample_size], seen)
+                
+                cls._formula_nbytes[formula_type] = deep_getsizeof(formulas[sample_size:2 * sample_size], seen) // sample_size
+            
+            else:
+                # one formula, the shared objects are counted as well
+                return deep_getsizeof(formulas[0], seen)
+
+        return cls._formula_nbytes[formula_type]
+
+    @property
+    def nbytes(self):
+        
+        '''approximated memory used by the candidates, formula objs plus the references of self.formulas and self.query lists'''
+        
+        if not self.formulas: return self.mz_calc.nbytes
+
+        return self.mz_calc.nbytes + len(self.formulas) * (self.formula_nbytes(self.formulas) + 16)
+
+    @staticmethod
+    def mass_by_ion_type(possible_formula, ion_type, ion_charge, adduct_atom=None):
+
+        if ion_type == Labels.protonated_de_ion:
+            
+            return possible_formula.protonated_mass(ion_charge)
+            
+        elif ion_type == Labels.radical_ion:
+            
+            return possible_formula.radical_mass(ion_charge)
+
+        elif ion_type == Labels.adduct_ion and adduct_atom:
+            
+            return possible_formula.adduct_mass(ion_charge, adduct_atom)
+        
+        else:
+            
+            return possible_formula.mass
+
+    def get_mass_defect_buckets(self, min_ppm_error, max_ppm_error):
+        
+        '''
+        bins the candidates by nominal mass and mass defect bucket, 
+        the bucket width is the ppm window at the highest candidate m/z, so one peak window spans one or two buckets
+        
+        returns the number of buckets per m/z unit and a dict {nominal mass * buckets per unit + mass defect bucket: (first index, last index)}
+        '''
+
+        if not self.formulas: return 1, {}
+
+        window_width = self.mz_calc[-1] * abs(max_ppm_error - min_ppm_error) / 1000000
+        
+        n_buckets = max(1, int(1 / window_width)) if window_width > 0 else 1000000
         
-        if mass_spectrum_obj.molecular_search_settings.error_method == 'distance':
+        if n_buckets not in self._buckets:
             
-            dif = error - last_error
-            if dif < last_dif:
-                last_dif = dif
-                closest_error = error
-                mass_spectrum_obj.molecular_search_settings.min_ppm_error  = closest_error - mass_spectrum_obj.molecular_search_settings.mz_error_range
-                mass_spectrum_obj.molecular_search_settings.max_ppm_error = closest_error + mass_spectrum_obj.molecular_search_settings.mz_error_range
+            bucket_keys = (self.mz_calc * n_buckets).astype(int64)
+            
+            # mz_calc is sorted, each bucket is a contiguous slice
+            keys, first_indexes = unique(bucket_keys, return_index=True)
+            last_indexes = append(first_indexes[1:], len(bucket_keys))
+            
+            self._buckets[n_buckets] = dict(zip(keys.tolist(), zip(first_indexes.tolist(), last_indexes.tolist())))
+        
+        return n_buckets, self._buckets.get(n_buckets)
 
-        elif mass_spectrum_obj.molecular_search_settings.error_method == 'lowest':
+    def match_by_buckets(self, mz_exp, min_ppm_error, max_ppm_error, n_buckets, buckets):
+        
+        '''first and last candidate indexes of the buckets covering the ppm window of one experimental m/z, 
+           the window can move between calls, find_formulas checks the exact error'''
+        
+        min_mz_calc = (mz_exp / (1 - (min_ppm_error / 1000000))) * (1 - self.window_tolerance)
+        max_mz_calc = (mz_exp / (1 - (max_ppm_error / 1000000))) * (1 + self.window_tolerance)
+
+        first_index, last_index = None, 0
+        
+        for key in range(int(min_mz_calc * n_buckets), int(max_mz_calc * n_buckets) + 1):
+            
+            bucket = buckets.get(key)
             
-            if error < last_error:
-                mass_spectrum_obj.molecular_search_settings.min_ppm_error  = error - mass_spectrum_obj.molecular_search_settings.mz_error_range
-                mass_spectrum_obj.molecular_search_settings.max_ppm_error = error + mass_spectrum_obj.molecular_search_settings.mz_error_range
-                last_error = error
+            if bucket:
+                
+                if first_index is None: first_index = bucket[0]
                 
+                last_index = bucket[1]
         
-        elif mass_spectrum_obj.molecular_search_settings.error_method == 'symmetrical':
-               
-               mass_spectrum_obj.molecular_search_settings.min_ppm_error  = mass_spectrum_obj.molecular_search_settings.mz_error_average - mass_spectrum_obj.molecular_search_settings.mz_error_range
-               mass_spectrum_obj.molecular_search_settings.max_ppm_error = mass_spectrum_obj.molecular_search_settings.mz_error_average + mass_spectrum_obj.molecular_search_settings.mz_error_range
+        if first_index is None: return 0, 0
+        
+        return first_index, last_index
+
+    def match(self, mz_exp, min_ppm_error, max_ppm_error):
+        
+        '''
+        returns the first and last candidate indexes inside the ppm window for each experimental m/z
+        
+        error = ((mz_calc - mz_exp)/mz_calc)*1000000, therefore 
+        min_ppm_error <= error <= max_ppm_error when mz_exp/(1 - min_ppm_error/1000000) <= mz_calc <= mz_exp/(1 - max_ppm_error/1000000)
+        '''
+        
+        min_mz_calc = (mz_exp / (1 - (min_ppm_error / 1000000))) * (1 - self.window_tolerance)
+        max_mz_calc = (mz_exp / (1 - (max_ppm_error / 1000000))) * (1 + self.window_tolerance)
+
+        first_indexes = searchsorted(self.mz_calc, min_mz_calc, side='left')
+        last_indexes = searchsorted(self.mz_calc, max_mz_calc, side='right')
+
+        return first_indexes, last_indexes
+
+class MolecularFormulaCache:
+
+    '''
+    Process wide cache of the candidates loaded from the database, so the next mass spectra searched with the same settings skip the database
+
+    The candidates are stored by heteroatom class as MolecularFormulaCandidates (sorted m/z arrays), 
+    the key is a hash of the settings that change the database query plus ion charge, ion type and adduct atom
+    The least recently used classes are evicted when the memory used goes over molecular_search_settings.formula_cache_bytes
+
+    The cache is cleared when MolecularCombinations adds new entries to the database
+    get_classes and get_dict_by_classes hold a lock, so concurrent searches in threads load each class once
+    '''
+    
+    # settings used by MolecularCombinations.runworker and MolForm_SQL.get_dict_by_classes 
+    query_settings = ('url_database', 'usedAtoms', 'used_atom_valences', 'min_dbe', 'max_dbe', 
+                      'min_hc_filter', 'max_hc_filter', 'min_oc_filter', 'use_formula_index')
+
+    def __init__(self):
+        
+        self.candidates = OrderedDict()
+        
+        self.classes = dict()
+
+        self.nbytes = 0
+        
+        self.database_version = MolecularCombinations.database_version
+
+        # searches running in threads share the cache
+        self.lock = threading.RLock()
+
+    def __len__(self):
+
+        return len(self.candidates)
+
+    def clear(self):
+
+        self.candidates.clear()
+        self.classes.clear()
+        self.nbytes = 0
+
+    def check_database_version(self):
+        
+        if self.database_version != MolecularCombinations.database_version:
+            
+            self.clear()
+            self.database_version = MolecularCombinations.database_version
+
+    @classmethod
+    def settings_key(cls, molecular_search_settings, *args):
+        
+        settings_dict = {name: getattr(molecular_search_settings, name) for name in cls.query_settings}
+        
+        settings_str = json.dumps([settings_dict, args], sort_keys=True, default=str)
+        
+        return hashlib.sha1(settings_str.encode('utf-8')).hexdigest()
+
+    def get_classes(self, sql_db, molecular_search_settings):
+        
+        '''cached MolecularCombinations.runworker, it only checks the database for the first mass spectrum'''
+
+        with self.lock:
+            
+            self.check_database_version()
+        
+            key = self.settings_key(molecular_search_settings)
+        
+            if key not in self.classes:
+            
+                classes = MolecularCombinations(sql_db).runworker(molecular_search_settings)
+
+                # runworker could have added entries to the database
+                self.check_database_version()
+
+                self.classes[key] = classes
+        
+            return self.classes.get(key)
+
+    def add(self, key, candidates, max_bytes):
+
+        if key in self.candidates:
+            
+            self.nbytes = self.nbytes - self.candidates.pop(key).nbytes
+
+        self.candidates[key] = candidates
+        
+        self.nbytes = self.nbytes + candidates.nbytes
+
+        self.trim(max_bytes)
+
+    def trim(self, max_bytes):
         
-        elif mass_spectrum_obj.molecular_search_settings.error_method == 'average':
+        '''evicts the least recently used candidates until the memory used is under max_bytes'''
 
-                nbValues += 1
-                error_average = error_average + ((error - error_average) / nbValues)
-                mass_spectrum_obj.molecular_search_settings.min_ppm_error  =  error_average - mass_spectrum_obj.molecular_search_settings.mz_error_range
-                mass_spectrum_obj.molecular_search_settings.max_ppm_error =  error_average + mass_spectrum_obj.molecular_search_settings.mz_error_range    
+        while self.nbytes > max_bytes and self.candidates:
+            
+            _, evicted = self.candidates.popitem(last=False)
+            
+            self.nbytes = self.nbytes - evicted.nbytes
+
+    def get(self, key):
+
+        candidates = self.candidates.get(key)
+        
+        if candidates is not None:
+            
+            self.candidates.move_to_end(key)
+        
+        return candidates
+
+    def get_dict_by_classes(self, classe_str_list, nominal_mzs, molecular_search_settings, ion_charge):
+        
+        '''
+        same structure as SearchMolecularFormulas.database_to_dict but each class has a MolecularFormulaCandidates 
+        with all the nominal m/z between the first and last of nominal_mzs, 
+        the classes missing or loaded for a narrower nominal m/z range are loaded from the database
+        '''
+
+        with self.lock:
+        
+            self.check_database_version()
+
+            # the budget could have changed since the last mass spectrum
+            self.trim(molecular_search_settings.formula_cache_bytes)
+
+            ion_types = []
+        
+            if molecular_search_settings.isProtonated: ion_types.append((Labels.protonated_de_ion, None))
+        
+            if molecular_search_settings.isRadical: ion_types.append((Labels.radical_ion, None))
+        
+            if molecular_search_settings.isAdduct:
+            
+                adduct_list = molecular_search_settings.adduct_atoms_neg if ion_charge < 0 else molecular_search_settings.adduct_atoms_pos
+            
+                ion_types.extend((Labels.adduct_ion, adduct_atom) for adduct_atom in adduct_list)
+
+            keys = {ion_type_atom: self.settings_key(molecular_search_settings, ion_charge, *ion_type_atom) for ion_type_atom in ion_types}
+
+            nominal_range = (min(nominal_mzs), max(nominal_mzs)) if len(nominal_mzs) else (0, 0)
+
+            dict_candidates = {ion_type_atom: {} for ion_type_atom in ion_types}
+        
+            missing_classes = []
+
+            # the reloaded classes keep the nominal m/z range loaded before
+            load_range = nominal_range
+        
+            for classe_str in classe_str_list:
+            
+                for ion_type_atom, key in keys.items():
+                
+                    candidates = self.get((key, classe_str))
+                
+                    if candidates is None or not candidates.covers(nominal_range):
+                    
+                        if candidates is not None:
+                            load_range = (min(load_range[0], candidates.nominal_range[0]), max(load_range[1], candidates.nominal_range[1]))
+                        
+                        missing_classes.append(classe_str)
+                        break
                 
+                    dict_candidates[ion_type_atom][classe_str] = candidates
+
+            if missing_classes:
+            
+                # the whole nominal m/z range, so the candidates can be used by the next mass spectra with peaks inside the range
+                dict_res = SearchMolecularFormulas.database_to_dict(missing_classes, range(load_range[0], load_range[1] + 1), molecular_search_settings, ion_charge)
+            
+                for (ion_type, adduct_atom), key in keys.items():
+                
+                    dict_by_class = dict_res.get(ion_type).get(adduct_atom, {}) if adduct_atom else dict_res.get(ion_type)
+
+                    for classe_str in missing_classes:
+                    
+                        candidates = MolecularFormulaCandidates(dict_by_class.get(classe_str, {}), ion_type, ion_charge, adduct_atom=adduct_atom, nominal_range=load_range)
+                    
+                        dict_candidates[(ion_type, adduct_atom)][classe_str] = candidates
+
+                        self.add((key, classe_str), candidates, molecular_search_settings.formula_cache_bytes)
+
+            dict_res = {}
+
+            for (ion_type, adduct_atom), dict_by_class in dict_candidates.items():
+            
+                if adduct_atom:
+                    dict_res.setdefault(ion_type, {})[adduct_atom] = dict_by_class
+                else:
+                    dict_res[ion_type] = dict_by_class
+
+            if molecular_search_settings.isAdduct and Labels.adduct_ion not in dict_res:
+                dict_res[Labels.adduct_ion] = {}
+
+            return dict_res
+
+# shared by all the SearchMolecularFormulas instances of the process
+formula_cache = MolecularFormulaCache()
+
+class SearchErrorState:
+    
+    '''
+    ppm window and running errors of one molecular formula search
+
+    the dynamic error methods (distance, lowest, symmetrical, average) move the window after every match,
+    the window is kept here instead of the module globals and the shared settings, 
+    so concurrent searches do not change each other window
+    '''
+    
+    def __init__(self, molecular_search_settings):
+        
+        self.molecular_search_settings = molecular_search_settings
+        
+        self.reset()
+    
+    def reset(self):
+        
+        self.last_error, self.last_dif, self.closest_error, self.nbValues = 0.0, 0.0, 0.0, 0.0
+        
+        self.error_average = 0
+
+        # starts from the window set at the settings
+        self.min_ppm_error = self.molecular_search_settings.min_ppm_error
+        self.max_ppm_error = self.molecular_search_settings.max_ppm_error
+
+    def set_last_error(self, error):
+        
+        molecular_search_settings = self.molecular_search_settings
+        
+        if molecular_search_settings.error_method == 'distance':
+            
+            dif = error - self.last_error
+            if dif < self.last_dif:
+                self.last_dif = dif
+                self.closest_error = error
+                self.min_ppm_error  = self.closest_error - molecular_search_settings.mz_error_range
+                self.max_ppm_error = self.closest_error + molecular_search_settings.mz_error_range
+
+        elif molecular_search_settings.error_method == 'lowest':
+            
+            if error < self.last_error:
+                self.min_ppm_error  = error - molecular_search_settings.mz_error_range
+                self.max_ppm_error = error + molecular_search_settings.mz_error_range
+                self.last_error = error
+        
+        elif molecular_search_settings.error_method == 'symmetrical':
+               
+               self.min_ppm_error  = molecular_search_settings.mz_error_average - molecular_search_settings.mz_error_range
+               self.max_ppm_error = molecular_search_settings.mz_error_average + molecular_search_settings.mz_error_range
+        
+        elif molecular_search_settings.error_method == 'average':
+
+                self.nbValues += 1
+                self.error_average = self.error_average + ((error - self.error_average) / self.nbValues)
+                self.min_ppm_error  =  self.error_average - molecular_search_settings.mz_error_range
+                self.max_ppm_error =  self.error_average + molecular_search_settings.mz_error_range    
                 
         else:
-            #using set mass_spectrum_obj.molecular_search_settings.min_ppm_error  and max_ppm_error range
+            #using set molecular_search_settings.min_ppm_error  and max_ppm_error range
             pass
 
-        '''returns the error based on the selected method at mass_spectrum_obj.molecular_search_settings.method
-        '''    
+class SearchMolecularFormulaWorker:
+    
+    # needs this warper to pass the class to multiprocessing
+    
+    # these methods update the ppm window after every match, the batch search can not be used 
+    dynamic_error_methods = ('distance', 'lowest', 'symmetrical', 'average')
+
+    def __init__(self, find_isotopologues=True, error_state=None):
+        self.find_isotopologues = find_isotopologues
+        # SearchErrorState shared by all the find_formulas calls of one search, created at the first call if not set
+        self.error_state = error_state
+    
+    def __call__(self, args):
+
+        return self.find_formulas(*args)  # ,args[1]
+
+    def reset_error(self, mass_spectrum_obj):
+        
+        self.error_state = SearchErrorState(mass_spectrum_obj.molecular_search_settings)
+
+    def set_last_error(self, error, mass_spectrum_obj ):
+        
+        '''updates the ppm window based on the selected method at mass_spectrum_obj.molecular_search_settings.error_method'''
+        
+        if self.error_state is None:
+            self.reset_error(mass_spectrum_obj)
+        
+        self.error_state.set_last_error(error)
         
     @staticmethod
     def calc_error(mz_exp, mz_calc, method='ppm'):
@@ -360,8 +1097,11 @@ class SearchMolecularFormulaWorker:
         
         mspeak_assigned_index = list()
 
-        min_ppm_error  = mass_spectrum_obj.molecular_search_settings.min_ppm_error 
-        max_ppm_error = mass_spectrum_obj.molecular_search_settings.max_ppm_error
+        if self.error_state is None:
+            self.reset_error(mass_spectrum_obj)
+
+        min_ppm_error  = self.error_state.min_ppm_error 
+        max_ppm_error = self.error_state.max_ppm_error
         
         min_abun_error = mass_spectrum_obj.molecular_search_settings.min_abun_error
         max_abun_error = mass_spectrum_obj.molecular_search_settings.max_abun_error
@@ -416,19 +1156,29 @@ class SearchMolecularFormulaWorker:
                     if self.find_isotopologues:
                         
                         # calculates isotopologues
-                        isotopologues = molecular_formula.isotopologues(min_abundance, ms_peak_abundance, mass_spectrum_obj.dynamic_range)
+                        isotopologues = list(molecular_formula.isotopologues(min_abundance, ms_peak_abundance, mass_spectrum_obj.dynamic_range))
                         
-                        # search for isotopologues
-                        for isotopologue_formula in isotopologues:
+                        molecular_formula.expected_isotopologues.extend(isotopologues)
+
+                        # locate the mspeaks inside the ppm window of all isotopologues at once
+                        # error = (mz_calc - mz_exp)/mz_calc*1e6, the window is widened a bit and the error checked below
+                        iso_peaks_indexes = []
+                        
+                        if isotopologues:
                             
+                            iso_mz_calc = array([isotopologue_formula.mz_calc for isotopologue_formula in isotopologues], dtype=float64)
                             
-                            molecular_formula.expected_isotopologues.append(isotopologue_formula)
-                            #move this outside to improve preformace
-                            #we need to increase the search space to -+1 m_z 
-                            first_index, last_index = mass_spectrum_obj.get_nominal_mz_first_last_indexes(isotopologue_formula.mz_nominal_calc)
+                            iso_peaks_indexes = mass_spectrum_obj.get_mz_range_indexes(
+                                iso_mz_calc * (1 - (max_ppm_error / 1000000)) * (1 - MolecularFormulaCandidates.window_tolerance),
+                                iso_mz_calc * (1 - (min_ppm_error / 1000000)) * (1 + MolecularFormulaCandidates.window_tolerance))
+                        
+                        # search for isotopologues
+                        for isotopologue_formula, ms_peak_iso_indexes in zip(isotopologues, iso_peaks_indexes):
                             
-                            for ms_peak_iso in mass_spectrum_obj[first_index:last_index]:
+                            for ms_peak_iso_index in ms_peak_iso_indexes:
                                 
+                                ms_peak_iso = mass_spectrum_obj[ms_peak_iso_index]
+
                                 error = self.calc_error(ms_peak_iso.mz_exp, isotopologue_formula.mz_calc)
                                 
                                 if  min_ppm_error  <= error <= max_ppm_error:
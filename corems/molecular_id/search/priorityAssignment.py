@@ -32,7 +32,9 @@ class OxygenPriorityAssignment(Thread):
         
         if not sql_db:
 
-            self.sql_db = MolForm_SQL(url=mass_spectrum_obj.molecular_search_settings.url_database)
+            search_settings = mass_spectrum_obj.molecular_search_settings
+            self.sql_db = MolForm_SQL(url=search_settings.url_database, pool_size=search_settings.db_pool_size, max_overflow=search_settings.db_max_overflow, 
+                                      partition_by_class=search_settings.db_partition_by_class)
         
         else:
             
@@ -141,6 +143,9 @@ class OxygenPriorityAssignment(Thread):
             
             all_assigned_indexes = list()
             
+            # one worker for all peaks, the ppm window is kept between the peaks
+            search_molfrom = SearchMolecularFormulaWorker()
+
             for ms_peak in mass_spectrum_obj.sort_by_abundance():
 
                 if ms_peak: continue
@@ -155,7 +160,7 @@ class OxygenPriorityAssignment(Thread):
                 
                 if possible_formulas_nominal:
 
-                    ms_peak_indexes = SearchMolecularFormulaWorker().find_formulas(possible_formulas_nominal, min_abundance, mass_spectrum_obj, ms_peak)    
+                    ms_peak_indexes = search_molfrom.find_formulas(possible_formulas_nominal, min_abundance, mass_spectrum_obj, ms_peak)    
 
                     all_assigned_indexes.extend(ms_peak_indexes)
             
@@ -251,7 +256,8 @@ class OxygenPriorityAssignment(Thread):
         mf_search_settings = self.mass_spectrum_obj.molecular_search_settings
         ion_charge = self.mass_spectrum_obj.polarity
 
-        sql_db = MolForm_SQL(url=mf_search_settings.url_database)
+        sql_db = MolForm_SQL(url=mf_search_settings.url_database, pool_size=mf_search_settings.db_pool_size, max_overflow=mf_search_settings.db_max_overflow, 
+                             partition_by_class=mf_search_settings.db_partition_by_class)
         
         dict_res = {}
 
@@ -223,6 +223,10 @@ class MSPeakCalculation(object):
 
     def molecular_formula_highest_prob_score(self):
        
+       # scores all the formulas of the mass spectrum in one pass
+       if self._ms_parent and any(m._confidence_score is None for m in self.molecular_formulas):
+           self._ms_parent.score_molecular_formulas()
+       
        return max(self.molecular_formulas, key=lambda m: abs(m.confidence_score))
 
     def molecular_formula_earth_filter(self, lowest_error=True):
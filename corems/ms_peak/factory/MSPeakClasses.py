@@ -5,46 +5,53 @@ __date__ = "Jun 12, 2019"
 
 from copy import deepcopy
 from corems.ms_peak.calc.MSPeakCalc import MSPeakCalculation
+from corems.ms_peak.factory.MSPeakTable import MSPeakColumn, MSPeakTable
 
 class _MSPeak(MSPeakCalculation):
     '''
-    classdocs
+    view over one row of the mass spectrum MSPeakTable, 
+    the centroid values live in the table columns, assignments live in the obj
     '''
+    ion_charge = MSPeakColumn('ion_charge', int)
+    _mz_exp = MSPeakColumn('mz_exp')
+    abundance = MSPeakColumn('abundance')
+    resolving_power = MSPeakColumn('resolving_power')
+    signal_to_noise = MSPeakColumn('signal_to_noise')
+    # profile indexes
+    start_index = MSPeakColumn('start_index', int)
+    apex_index = MSPeakColumn('apex_index', int)
+    final_index = MSPeakColumn('final_index', int)
+    # updated after calibration'
+    mz_cal = MSPeakColumn('mz_cal', optional=True)
+    freq_exp = MSPeakColumn('freq_exp', optional=True)
+    
     def __init__(self, ion_charge, mz_exp, abundance, resolving_power, 
-                    signal_to_noise, massspec_indexes, index, ms_parent=None, exp_freq=None):
+                    signal_to_noise, massspec_indexes, index, ms_parent=None, exp_freq=None, peak_table=None):
+
+        # parent mass spectrum obj instance
+        self._ms_parent = ms_parent
+        
+        if self._ms_parent is not None:
+            kendrick_dict_base = self._ms_parent.mspeaks_settings.kendrick_base
+        else:
+            kendrick_dict_base = {'C':1, 'H':2}
 
+        # isolated peaks get their own one row table
+        if peak_table is None:
+            peak_table = MSPeakTable(capacity=1)
+        
         # needed to create the object
-        self.ion_charge = int(ion_charge)
-        self._mz_exp = float(mz_exp)
-        self.mass = float(mz_exp) / float(ion_charge)
-        self.abundance = float(abundance)
-        self.resolving_power = float(resolving_power)
-        self.signal_to_noise = float(signal_to_noise)
-        # profile indexes
-        self.start_index = int(massspec_indexes[0]) 
-        self.apex_index = int(massspec_indexes[1])
-        self.final_index = int(massspec_indexes[2]) 
+        self._peak_table = peak_table
+        self._row = peak_table.add_row(ion_charge, mz_exp, abundance, resolving_power, 
+                                       signal_to_noise, massspec_indexes, exp_freq=exp_freq, 
+                                       kendrick_dict_base=kendrick_dict_base)
         #centroid index
         self.index = int(index)
-        # parent mass spectrum obj instance
-        self._ms_parent = ms_parent
         
         # updated after mass error prediction'
         self.predicted_std = None
-        # updated after calibration'
-        self.mz_cal = None
         # updated individual calculation'
         self.baseline_noise = None
-        
-        if exp_freq:
-            self.freq_exp = float(exp_freq)
-
-        if self._ms_parent is not None:
-            kendrick_dict_base = self._ms_parent.mspeaks_settings.kendrick_base
-        else:
-            kendrick_dict_base = {'C':1, 'H':2}
-        self._kdm, self._kendrick_mass, self._nominal_km = self._calc_kdm(
-            kendrick_dict_base)
  
         'updated after molecular formula ID'
 
@@ -69,8 +76,7 @@ class _MSPeak(MSPeakCalculation):
 
     def change_kendrick_base(self, kendrick_dict_base):
         '''kendrick_dict_base = {"C": 1, "H": 2}'''
-        self._kdm, self._kendrick_mass, self._nominal_km = self._calc_kdm(
-            kendrick_dict_base)
+        self._peak_table.set_kendrick_base([self._row], kendrick_dict_base)
 
     def add_molecular_formula(self, molecular_formula_obj):
         
@@ -108,17 +114,20 @@ class _MSPeak(MSPeakCalculation):
     @property
     def area(self): return self.calc_area()
 
+    @property
+    def mass(self): return self._mz_exp / self.ion_charge
+
     @property
     def nominal_mz_exp(self): return int(self.mz_exp)
 
     @property
-    def kmd(self): return self._kdm
+    def kmd(self): return float(self._peak_table.kmd[self._row])
 
     @property
-    def kendrick_mass(self): return self._kendrick_mass
+    def kendrick_mass(self): return float(self._peak_table.kendrick_mass[self._row])
 
     @property
-    def knm(self): return self._nominal_km
+    def knm(self): return int(self._peak_table.nominal_km[self._row])
     
     @property
     def is_assigned(self):
@@ -196,9 +205,9 @@ class _MSPeak(MSPeakCalculation):
 
 class ICRMassPeak(_MSPeak):
 
-    def __init__(self, *args, ms_parent=None, exp_freq=None):
+    def __init__(self, *args, ms_parent=None, exp_freq=None, peak_table=None):
 
-        super().__init__(*args,exp_freq=exp_freq, ms_parent=ms_parent)
+        super().__init__(*args,exp_freq=exp_freq, ms_parent=ms_parent, peak_table=peak_table)
 
     def resolving_power_calc(self, B, T):
         
@@ -221,18 +230,18 @@ class ICRMassPeak(_MSPeak):
         
 class TOFMassPeak(_MSPeak):
 
-    def __init__(self, *args, exp_freq=None):
+    def __init__(self, *args, exp_freq=None, ms_parent=None, peak_table=None):
 
-        super().__init__(*args,exp_freq=exp_freq)
+        super().__init__(*args,exp_freq=exp_freq, ms_parent=ms_parent, peak_table=peak_table)
 
     def set_calc_resolving_power(self):
         return 0
 
 class OrbiMassPeak(_MSPeak):
 
-    def __init__(self, *args, exp_freq=None):
+    def __init__(self, *args, exp_freq=None, ms_parent=None, peak_table=None):
 
-        super().__init__(*args,exp_freq=exp_freq)
+        super().__init__(*args,exp_freq=exp_freq, ms_parent=ms_parent, peak_table=peak_table)
 
     def set_calc_resolving_power(self):
         return 0       
@@ -0,0 +1,144 @@
+from numpy import full, int64, isnan, nan, where, zeros
+
+from corems.encapsulation.constant import Atoms
+
+
+class MSPeakTable:
+    '''
+    struct-of-arrays storage for the centroid values of all mspeaks of a mass spectrum
+
+    each _MSPeak obj is a view over one row (_MSPeak._row),
+    the mass spectrum properties and filters work directly on the columns
+    missing mz_cal and freq_exp values are stored as nan
+    '''
+    float_columns = ('mz_exp', 'mz_cal', 'abundance', 'resolving_power', 'signal_to_noise', 'freq_exp',
+                     'kmd', 'kendrick_mass')
+
+    int_columns = ('ion_charge', 'start_index', 'apex_index', 'final_index', 'nominal_km')
+
+    # the values given to add_row, enough to recreate the mspeaks in another process
+    centroid_columns = ('ion_charge', 'mz_exp', 'abundance', 'resolving_power', 'signal_to_noise', 
+                        'start_index', 'apex_index', 'final_index', 'freq_exp')
+
+    def __init__(self, capacity=64):
+
+        self.size = 0
+
+        for column in self.float_columns:
+            setattr(self, column, full(capacity, nan))
+
+        for column in self.int_columns:
+            setattr(self, column, zeros(capacity, dtype=int64))
+
+    def __len__(self):
+
+        return self.size
+
+    def _grow(self):
+
+        capacity = max(2 * len(self.mz_exp), 64)
+
+        for column in self.float_columns + self.int_columns:
+
+            old_values = getattr(self, column)
+
+            if column in self.float_columns:
+                new_values = full(capacity, nan)
+            else:
+                new_values = zeros(capacity, dtype=int64)
+
+            new_values[:self.size] = old_values[:self.size]
+
+            setattr(self, column, new_values)
+
+    def add_row(self, ion_charge, mz_exp, abundance, resolving_power, signal_to_noise,
+                massspec_indexes, exp_freq=None, kendrick_dict_base=None):
+        '''returns the row number of the new mspeak'''
+        if self.size == len(self.mz_exp):
+            self._grow()
+
+        row = self.size
+
+        self.ion_charge[row] = int(ion_charge)
+        self.mz_exp[row] = float(mz_exp)
+        self.abundance[row] = float(abundance)
+        self.resolving_power[row] = float(resolving_power)
+        self.signal_to_noise[row] = float(signal_to_noise)
+        # profile indexes
+        self.start_index[row] = int(massspec_indexes[0])
+        self.apex_index[row] = int(massspec_indexes[1])
+        self.final_index[row] = int(massspec_indexes[2])
+
+        if exp_freq:
+            self.freq_exp[row] = float(exp_freq)
+
+        self.size += 1
+
+        if kendrick_dict_base is None:
+            kendrick_dict_base = {'C': 1, 'H': 2}
+
+        # same as MSPeakCalculation._calc_kdm, kept scalar here as it runs once per peak
+        kendrick_factor = self.kendrick_factor(kendrick_dict_base)
+        kendrick_mass = kendrick_factor * self.mz_exp[row]
+        nominal_km = int(kendrick_mass)
+
+        self.kendrick_mass[row] = kendrick_mass
+        self.nominal_km[row] = nominal_km
+        self.kmd[row] = nominal_km - kendrick_mass
+
+        return row
+
+    @staticmethod
+    def kendrick_factor(kendrick_dict_base):
+
+        mass = 0
+        for atom in kendrick_dict_base.keys():
+            mass += Atoms.atomic_masses.get(atom) * kendrick_dict_base.get(atom)
+
+        return int(mass) / mass
+
+    def mz(self, rows):
+        '''mz_cal when the peak was calibrated, mz_exp otherwise, same as _MSPeak.mz_exp'''
+        mz_cal = self.mz_cal[rows]
+
+        return where(isnan(mz_cal), self.mz_exp[rows], mz_cal)
+
+    def set_kendrick_base(self, rows, kendrick_dict_base):
+        '''kendrick_dict_base = {"C": 1, "H": 2}'''
+        kendrick_mass = self.kendrick_factor(kendrick_dict_base) * self.mz(rows)
+
+        nominal_km = kendrick_mass.astype(int64)
+
+        self.kendrick_mass[rows] = kendrick_mass
+        self.nominal_km[rows] = nominal_km
+        self.kmd[rows] = nominal_km - kendrick_mass
+
+
+class MSPeakColumn:
+    '''exposes one MSPeakTable column as an attribute of the _MSPeak view'''
+
+    def __init__(self, column, cast=float, optional=False):
+
+        self.column = column
+        self.cast = cast
+        # optional values return None when not set (stored as nan)
+        self.optional = optional
+
+    def __get__(self, mspeak, owner):
+
+        if mspeak is None:
+            return self
+
+        value = getattr(mspeak._peak_table, self.column)[mspeak._row]
+
+        if self.optional and isnan(value):
+            return None
+
+        return self.cast(value)
+
+    def __set__(self, mspeak, value):
+
+        if value is None:
+            value = nan
+
+        getattr(mspeak._peak_table, self.column)[mspeak._row] = value
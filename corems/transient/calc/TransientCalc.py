@@ -1,10 +1,100 @@
-import gc
+import threading
+from functools import lru_cache
 
-from numpy import hamming, hanning, blackman, zeros, fft, sqrt, arange, where, power, absolute
+from numpy import hamming, hanning, blackman, zeros, arange, where, hypot, float64
+from scipy import fft
 
 __author__ = "Yuri E. Corilo"
 __date__ = "Jun 12, 2019"
 
+# zero filled time domain buffer reused by the transients of the same length, one per thread
+_zero_filled_buffer = threading.local()
+
+@lru_cache(maxsize=2)
+def get_apodization_window(apodi_method, length):
+    '''read only window shared by all the transients of the same length'''
+    if apodi_method == "Hamming":
+        window = hamming(length)
+    elif apodi_method == "Hanning":
+        window = hanning(length)
+    elif apodi_method == "Blackman":
+        window = blackman(length)
+    else:
+        raise Exception("apodization method %s not implemented" % apodi_method)
+    
+    window.flags.writeable = False
+    
+    return window
+
+def get_zero_filled_buffer(data_count, buffer_length, rows=None):
+    '''float64 buffer of buffer_length points (rows x buffer_length when rows is set), the points after data_count are always zero'''
+    key = (data_count, buffer_length, rows)
+    
+    if getattr(_zero_filled_buffer, 'key', None) != key:
+        
+        # the previous buffer is released before allocating the new one
+        _zero_filled_buffer.buffer = None
+        _zero_filled_buffer.buffer = zeros(buffer_length if rows is None else (rows, buffer_length))
+        _zero_filled_buffer.key = key
+    
+    return _zero_filled_buffer.buffer
+
+def batch_magnitude_mode_ft(transients, workers=1):
+    
+    '''
+    frequency domain of transients with the same number of data points and processing parameters,
+    the apodized and zero filled time domains are stacked in one buffer and transformed by a single multi-row rfft
+    returns the (frequency domain, magnitude) of each transient, in the same order
+    '''
+    
+    first_transient = transients[0]
+    
+    parameters = first_transient.parameters
+    
+    processing = (parameters.apodization_method, parameters.number_of_truncations, parameters.number_of_zero_fills)
+
+    for transient in transients:
+        
+        if len(transient._transient_data) != len(first_transient._transient_data):
+            raise Exception("batch transform needs transients with the same number of data points")
+        
+        if (transient.parameters.apodization_method, transient.parameters.number_of_truncations, transient.parameters.number_of_zero_fills) != processing:
+            raise Exception("batch transform needs transients with the same processing parameters")
+
+    data_count = len(first_transient.truncation(first_transient._transient_data))
+
+    buffer_length = data_count * (parameters.number_of_zero_fills + 1)
+
+    time_domain_y_zero_filled = get_zero_filled_buffer(data_count, buffer_length, rows=len(transients))
+
+    time_domain = time_domain_y_zero_filled[:, 0:data_count]
+
+    for row, transient in enumerate(transients):
+        
+        time_domain[row] = first_transient.truncation(transient._transient_data)
+
+    if parameters.apodization_method is not None:
+        
+        # the window is broadcasted to all the rows
+        time_domain *= get_apodization_window(parameters.apodization_method, data_count)
+
+    A = fft.rfft(time_domain_y_zero_filled, axis=1, workers=workers)
+
+    frequency_domains = list()
+
+    for row, transient in enumerate(transients):
+
+        transient.transient_time = transient.transient_time * (parameters.number_of_zero_fills + 1)
+        
+        # one magnitude array per transient, the mass spectra do not keep the batch alive
+        magnitude_Y = hypot(A[row].real, A[row].imag)
+
+        freqdomain_X = transient.calculate_frequency_domain(len(magnitude_Y))
+
+        frequency_domains.append(transient.cut_freq_domain(freqdomain_X, magnitude_Y))
+
+    return frequency_domains
+
 class TransientCalculations(object):
     
     '''
@@ -21,10 +111,6 @@ class TransientCalculations(object):
                 
         zeros_filled_transient[0:len(transient)] = transient    
         
-        del transient
-        
-        gc.collect()
-        
         return  zeros_filled_transient 
     
     def truncation(self, transient):
@@ -34,47 +120,50 @@ class TransientCalculations(object):
         for _ in range(self.parameters.number_of_truncations):
         
             data_count = int(data_count / 2)
-         
-        time_domain_truncated = transient[0:data_count]
-        
-        del transient
-                
-        gc.collect()  
         
-        return time_domain_truncated
+        # view of the transient, no copy
+        return transient[0:data_count]
     
     def apodization(self, transient):
         
-        apodi_method = self.parameters.apodization_method
+        return transient * get_apodization_window(self.parameters.apodization_method, len(transient))
+    
+    def apodized_zero_filled(self, transient, reuse_buffer=True):
         
-        length = len(transient)
-            
-        if apodi_method == "Hamming":
-                H_function = hamming(length)
-        elif apodi_method == "Hanning":
-                H_function = hanning(length)
-        elif apodi_method == "Blackman":
-                H_function = blackman(length)
+        '''
+        truncation, apodization and zero fill written in place to one float64 buffer,
+        with reuse_buffer the buffer is overwritten by the next transient of the same length processed in the thread
+        '''
+        
+        if self.parameters.number_of_truncations > 0:
             
-        S_x = transient * H_function
+            transient = self.truncation(transient)
+
+        data_count = len(transient)
+
+        buffer_length = data_count * (self.parameters.number_of_zero_fills + 1)
+        
+        if reuse_buffer:
+            time_domain_y_zero_filled = get_zero_filled_buffer(data_count, buffer_length)
+        else:
+            time_domain_y_zero_filled = zeros(buffer_length)
         
-        del transient
-        gc.collect()  
+        time_domain = time_domain_y_zero_filled[0:data_count]
+        
+        time_domain[:] = transient
+
+        if self.parameters.apodization_method is not None:
             
-        return S_x
-    
+            time_domain *= get_apodization_window(self.parameters.apodization_method, data_count)
+
+        return time_domain_y_zero_filled
+
     def calculate_frequency_domain(self, number_data_points):
         
-        qntpoints = arange(0,(number_data_points))
+        frequency_domain = arange(0, number_data_points, dtype=float64)
         
-        factor_distancy = (self.bandwidth)/(number_data_points)  
+        frequency_domain *= (self.bandwidth)/(number_data_points)  
                 
-        frequency_domain = qntpoints * factor_distancy
-        
-        del qntpoints   
-        del factor_distancy
-        gc.collect()  
-        
         return frequency_domain  
     
     def cut_freq_domain(self, freqdomain_X, freqdomain_Y):
@@ -100,39 +189,22 @@ class TransientCalculations(object):
             
     def perform_magniture_mode_ft(self, transient):
         
-        A = fft.rfft(transient)
+        # scipy keeps the plan of the last transform sizes, reused by the scans of the same length
+        A = fft.rfft(transient, workers=self.parameters.fft_workers)
         
         #A = fft.fft(transient)
         #A = A[0:int(len(A)/2)]
 
-        factor = int(self.parameters.number_of_zero_fills-1)
-        if self.parameters.number_of_zero_fills:
-            if self.parameters.number_of_zero_fills == 1:
-                factor = 1/2
-                
-            else:
-                factor = int(1/self.parameters.number_of_zero_fills+1)
-                
-            Max_index = int(len(A)/factor)    
-        
-        else:
-            Max_index = int(len(A))
-        
-        A = A[0:Max_index]
-        
         datapoints = len(A)
         
         freqdomain_X = self.calculate_frequency_domain(datapoints)
         
-        magnitude_Y = sqrt((power(A.real,2)) + (power(A.imag,2)))
+        magnitude_Y = hypot(A.real, A.imag)
         
+        del A
+
         freqdomain_X_cut, magnitude_Y_cut = self.cut_freq_domain(freqdomain_X, magnitude_Y)  
         
-        del transient 
-        #del freqdomain_X
-        #del magnitude_Y
-        gc.collect()
-        
         return freqdomain_X_cut, magnitude_Y_cut
     
     def correct_dc_offset(self):
@@ -111,25 +111,14 @@ class Transient(TransientCalculations):
     
     def get_frequency_domain(self, plot_result=True):
 
-        if self.parameters.number_of_truncations > 0:
-
-            new_time_domain = self.truncation(self._transient_data)
-
-        else:
-
-            new_time_domain = self._transient_data
-
-        if self.parameters.apodization_method is not None:
-
-            new_time_domain = self.apodization(new_time_domain)
+        # the plots keep a reference to the time domain data, a new buffer is used
+        time_domain_y_zero_filled = self.apodized_zero_filled(self._transient_data, reuse_buffer=not plot_result)
 
         if plot_result:
 
             self._plot_transient(self._transient_data)
 
-            self._plot_transient(new_time_domain)
-
-        time_domain_y_zero_filled = self.zero_fill(new_time_domain)
+            self._plot_transient(time_domain_y_zero_filled[0:int(len(time_domain_y_zero_filled) / (self.parameters.number_of_zero_fills + 1))])
 
         self.transient_time = self.transient_time * (
             self.parameters.number_of_zero_fills + 1
@@ -153,6 +142,15 @@ class Transient(TransientCalculations):
 
             self._plot_frequency_domain(frequency_domain, magnitude)
 
+        return self.get_mass_spectrum_from_frequency_domain(frequency_domain, magnitude, auto_process=auto_process,
+                                                            keep_profile=keep_profile, auto_noise=auto_noise, 
+                                                            noise_bayes_est=noise_bayes_est)
+    
+    def get_mass_spectrum_from_frequency_domain(self, frequency_domain, magnitude, auto_process=True,
+                                                keep_profile=True, auto_noise=True, noise_bayes_est=False):
+        
+        '''mass spectrum of a frequency domain already calculated, i.e. by batch_magnitude_mode_ft'''
+        
         self.d_params["filename"] = self.filename
         self.d_params["dir_location"] = self.dir_location
         
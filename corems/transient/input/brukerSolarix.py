@@ -3,7 +3,7 @@ __date__ = "Jun 12, 2019"
 from copy import deepcopy
 from pathlib import Path
 
-from numpy import genfromtxt, fromstring, dtype, fromfile, frombuffer
+from numpy import genfromtxt, fromstring, dtype, fromfile, frombuffer, memmap, zeros, float64
 from s3path import S3Path
 from xml.dom import minidom
 
@@ -13,6 +13,99 @@ from corems.encapsulation.factory.parameters import default_parameters
 
 
 
+class BrukerSerScans(object):
+    
+    """
+    Random access to the scans of a Bruker ser file without reading the whole file
+    
+    Local files are memory mapped, all the scans are exposed as a read only zero-copy view 
+    with shape (scans_count, data_points), S3Path files are read one scan at a time with byte range requests
+
+    Parameters
+    ----------
+    ser_path : pathlib.Path or s3path.S3Path
+        the ser file location
+    data_points : int
+        number of data points of each scan (TD)
+    data_type : numpy.dtype
+        32 bits int of the platform
+    
+    Methods
+    -------
+    scan(scan_number)
+        the time domain data of the scan, scan numbers start at 1
+    """
+
+    def __init__(self, ser_path, data_points, data_type):
+
+        self.ser_path = ser_path
+
+        self.data_points = data_points
+
+        self.data_type = dtype(data_type)
+
+        self.scan_size = self.data_type.itemsize * data_points
+
+        # incomplete scans at the end of the file are ignored
+        self.scans_count = ser_path.stat().st_size // self.scan_size
+
+        self._s3_stream = None
+
+        if isinstance(ser_path, S3Path):
+            
+            self.data = None
+        
+        elif self.scans_count:
+            
+            self.data = memmap(str(ser_path), dtype=self.data_type, mode='r', shape=(self.scans_count, data_points))
+        
+        else:
+            
+            self.data = zeros((0, data_points), dtype=self.data_type)
+
+    def __len__(self):
+
+        return self.scans_count
+
+    def __iter__(self):
+
+        for scan_number in range(1, self.scans_count + 1):
+            yield self.scan(scan_number)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        self.close()
+        
+        return False
+
+    def scan(self, scan_number):
+        
+        if not 1 <= scan_number <= self.scans_count:
+            raise Exception("scan number %s out of range, %s has %s scans" % (scan_number, self.ser_path, self.scans_count))
+
+        if self.data is not None:
+            
+            return self.data[scan_number - 1]
+        
+        # the stream is kept open, seek and read only request the scan bytes
+        if self._s3_stream is None:
+            self._s3_stream = self.ser_path.open('rb')
+        
+        self._s3_stream.seek((scan_number - 1) * self.scan_size)
+        
+        return frombuffer(self._s3_stream.read(self.scan_size), dtype=self.data_type)
+
+    def close(self):
+
+        if self._s3_stream is not None:
+            
+            self._s3_stream.close()
+            self._s3_stream = None
+
 class ReadBrukerSolarix(object):
     
     """
@@ -49,6 +142,13 @@ class ReadBrukerSolarix(object):
         
         self.file_location = d_directory_location
         
+        # parsed once, reused by all the scans
+        self._file_d_params = None
+
+        self._dict_scan_rt_tic = None
+
+        self._ser_scans = None
+        
         try:
 
             self.parameter_filename_location = self.locate_file(
@@ -90,19 +190,50 @@ class ReadBrukerSolarix(object):
         return dict_scan_rt_tic
        
         
-    def get_transient(self, scan_number=1):
-
-        file_d_params = self.parse_parameters(self.parameter_filename_location)
-
-        self.fix_freq_limits(file_d_params)
-
+    def get_data_type(self):
+        
         from sys import platform
         
         if platform == "win32":
             # Windows...
-            dt = dtype("l")
+            return dtype("l")
         else:
-            dt = dtype("i")
+            return dtype("i")
+
+    def get_file_d_params(self):
+        
+        if self._file_d_params is None:
+
+            file_d_params = self.parse_parameters(self.parameter_filename_location)
+
+            self.fix_freq_limits(file_d_params)
+
+            self._file_d_params = file_d_params
+        
+        return self._file_d_params
+
+    def get_ser_scans(self):
+        
+        '''returns the BrukerSerScans of the ser file, opened once'''
+        
+        if self._ser_scans is None:
+
+            data_points = int(self.get_file_d_params().get("TD"))
+
+            self._ser_scans = BrukerSerScans(self.transient_data_path, data_points, self.get_data_type())
+        
+        return self._ser_scans
+
+    def get_dict_scan_rt_tic(self):
+        
+        if self._dict_scan_rt_tic is None:
+            self._dict_scan_rt_tic = self.get_scan_attr()
+        
+        return self._dict_scan_rt_tic
+
+    def get_output_parameters(self, scan_number=1):
+
+        file_d_params = self.get_file_d_params()
 
         # get rt, scan, and tic from scan.xml file, otherwise  using 0 defaults values 
         
@@ -112,7 +243,7 @@ class ReadBrukerSolarix(object):
             
             if self.scan_attr.exists():
                 
-                dict_scan_rt_tic = self.get_scan_attr()
+                dict_scan_rt_tic = self.get_dict_scan_rt_tic()
 
                 output_parameters["scan_number"] = scan_number
 
@@ -140,21 +271,18 @@ class ReadBrukerSolarix(object):
 
         output_parameters["polarity"] = str(file_d_params.get("Polarity"))
 
-        data_points = int(file_d_params.get("TD"))
+        return output_parameters
+
+    def get_transient(self, scan_number=1):
+
+        dt = self.get_data_type()
+
+        output_parameters = self.get_output_parameters(scan_number)
 
-        scan = output_parameters["scan_number"]
-        from io import BytesIO
         if self.transient_data_path.name == 'ser':
             
-            if isinstance(self.transient_data_path, S3Path):
-                databin = BytesIO(self.transient_data_path.open('rb').read())
-            
-            else:
-                databin = self.transient_data_path.open('rb')
-               
-            databin.seek((scan-1)*4*data_points)
-            #read scan data and parse to 32int struct
-            data = frombuffer(databin.read(4*data_points), dtype=dt)
+            # zero-copy view of the memory mapped scan, or a byte range read for S3Path 
+            data = self.get_ser_scans().scan(scan_number)
         
         else:
             
@@ -165,6 +293,68 @@ class ReadBrukerSolarix(object):
         
         return Transient(data, output_parameters)
 
+    def get_coadded_transient(self, scans_numbers=None, rt_range=None):
+        
+        '''
+        time domain co-addition of ser scans, the scans are accumulated in one float64 buffer as they are read 
+        and averaged, returns one Transient
+        
+        scans_numbers: list of scan numbers, or
+        rt_range: (min_rt, max_rt) in minutes, the scans are selected using scan.xml
+        all the scans are used when both are None
+        '''
+        
+        if self.transient_data_path.name != 'ser':
+            raise Exception("co-addition needs a ser file, %s has a single transient" % self.d_directory_location)
+        
+        ser_scans = self.get_ser_scans()
+
+        if rt_range is not None:
+            
+            if not self.scan_attr.exists():
+                raise Exception("scan.xml not found, the scans can not be selected by retention time")
+            
+            min_rt, max_rt = rt_range
+
+            scans_numbers = [scan_number for scan_number, (rt, tic) in sorted(self.get_dict_scan_rt_tic().items()) if min_rt <= rt <= max_rt]
+        
+        elif scans_numbers is None:
+            
+            scans_numbers = list(range(1, len(ser_scans) + 1))
+        
+        if not scans_numbers:
+            raise Exception("no scans selected for co-addition")
+
+        accumulated_data = zeros(ser_scans.data_points, dtype=float64)
+
+        for scan_number in scans_numbers:
+            
+            accumulated_data += ser_scans.scan(scan_number)
+
+        accumulated_data /= len(scans_numbers)
+
+        output_parameters = self.get_output_parameters(scans_numbers[0])
+
+        if self.scan_attr.exists():
+            
+            dict_scan_rt_tic = self.get_dict_scan_rt_tic()
+            
+            # average retention time and tic of the co-added scans
+            output_parameters["rt"] = sum(dict_scan_rt_tic.get(scan_number)[0] for scan_number in scans_numbers) / len(scans_numbers)
+            
+            output_parameters["tic"] = sum(dict_scan_rt_tic.get(scan_number)[1] for scan_number in scans_numbers) / len(scans_numbers)
+        
+        return Transient(accumulated_data, output_parameters)
+
+    def get_coadded_mass_spectrum(self, scans_numbers=None, rt_range=None, auto_process=True, keep_profile=True, auto_noise=True):
+        
+        '''mass spectrum of the co-added scans, one FFT and one peak picking, see get_coadded_transient'''
+
+        coadded_transient = self.get_coadded_transient(scans_numbers=scans_numbers, rt_range=rt_range)
+
+        return coadded_transient.get_mass_spectrum(plot_result=False, auto_process=auto_process, 
+                                                   keep_profile=keep_profile, auto_noise=auto_noise)
+
     """
         for key, values in default_parameters.items():
             print(key, values)
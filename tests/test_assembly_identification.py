@@ -307,7 +307,7 @@ def plot_error_distribution():
                         
                     #off_set +=  0.1
                     molecular_formula.mz_error
-                    pyplot.plot(mspeak.mz_exp, molecular_formula._assignment_mass_error, "o")
+                    pyplot.plot(mspeak.mz_exp, molecular_formula.mz_error, "o")
 
     pyplot.ylabel("m/z Error (ppm)")
     pyplot.xlabel('m/z')
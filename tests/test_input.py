@@ -19,6 +19,185 @@ from corems.mass_spectrum.input.massList import ReadCoremsMasslist, ReadMassList
 from corems.transient.input.brukerSolarix import ReadBrukerSolarix
 from corems.encapsulation.factory.parameters import MSParameters
 
+def create_ser_experiment(d_directory_location, scans_count=3, data_points=2**15):
+    
+    '''synthetic Solarix ser experiment, scan n has one ion at m/z 400 + n, abundance n'''
+    
+    from numpy import arange, int32, sin, pi
+    
+    method_directory = d_directory_location / "test.m"
+    method_directory.mkdir(parents=True)
+
+    params = {"ML1": 1.5e8, "ML2": 0, "ML3": 0, "EXC_Freq_High": 1e6, "EXC_Freq_Low": 1e5, "SW_h": 1e6, "TD": data_points}
+
+    params_xml = ''.join('<param name="{}"><value>{}</value></param>'.format(name, value) for name, value in params.items())
+    
+    (method_directory / "apexAcquisition.method").write_text(
+        '<method>\n<reportinfo>\n<section title="Main">\n<section title="Polarity">\n<param value="Negative"/>\n</section>\n</section>\n</reportinfo>\n'
+        '<paramlist>{}</paramlist>\n</method>'.format(params_xml))
+
+    time = arange(data_points) / (2 * params["SW_h"])
+    
+    scans = [(1e6 * scan_number * sin(2 * pi * (params["ML1"] / (400 + scan_number)) * time)).astype(int32) for scan_number in range(1, scans_count + 1)]
+    
+    with (d_directory_location / "ser").open('wb') as ser_file:
+        for scan in scans:
+            ser_file.write(scan.tobytes())
+
+    (d_directory_location / "scan.xml").write_text('<?xml version="1.0" encoding="UTF-8"?>\n<scanlist>\n{}</scanlist>'.format(''.join(
+        '<scan><count>{}</count><minutes>{}</minutes><tic>{}</tic></scan>\n'.format(scan_number, scan_number * 0.5, scan_number * 1e6) 
+        for scan_number in range(1, scans_count + 1))))
+
+    return scans
+
+def test_ser_scans(tmp_path):
+    
+    from numpy import memmap
+    
+    d_directory_location = tmp_path / "ser_experiment.d"
+    
+    scans = create_ser_experiment(d_directory_location)
+
+    bruker_reader = ReadBrukerSolarix(d_directory_location)
+    
+    with bruker_reader.get_ser_scans() as ser_scans:
+
+        assert len(ser_scans) == 3
+        
+        # zero-copy view of the file
+        assert isinstance(ser_scans.data, memmap)
+        assert ser_scans.data.shape == (3, 2**15)
+        
+        for scan_data, scan in zip(ser_scans, scans):
+            assert (scan_data == scan).all()
+
+        with pytest.raises(Exception):
+            ser_scans.scan(4)
+    
+    transient = bruker_reader.get_transient(2)
+
+    assert (transient._transient_data == scans[1]).all()
+    assert transient.d_params["scan_number"] == 2 and transient.d_params["rt"] == 1.0
+    
+    # the ser file is opened once by the lc reader
+    lcms_reader = ReadBruker_SolarixTransientMassSpectra(d_directory_location)
+    assert lcms_reader.get_ser_scans() is lcms_reader.get_ser_scans()
+
+def test_transient_processing(tmp_path):
+    
+    from numpy import abs, concatenate, fft, hanning, zeros
+
+    d_directory_location = tmp_path / "ser_experiment.d"
+    
+    create_ser_experiment(d_directory_location)
+
+    bruker_reader = ReadBrukerSolarix(d_directory_location)
+
+    # the zero filled buffer is reused, scan 3 is processed before scan 1
+    for scan_number in (3, 1):
+
+        transient = bruker_reader.get_transient(scan_number)
+
+        transient.set_processing_parameter('Hanning', 0, 1)
+
+        frequency_domain, magnitude = transient.get_frequency_domain(plot_result=False)
+
+        time_domain = transient._transient_data * hanning(len(transient._transient_data))
+        
+        expected_magnitude = abs(fft.rfft(concatenate((time_domain, zeros(len(time_domain))))))
+        
+        first_index = int(round(frequency_domain[0] / (transient.bandwidth / len(expected_magnitude))))
+
+        # round off of the transform relative to the highest magnitude
+        assert magnitude == pytest.approx(expected_magnitude[first_index:first_index + len(magnitude)], abs=expected_magnitude.max() * 1e-12)
+
+        mass_spectrum = transient.get_mass_spectrum(plot_result=False, auto_process=True)
+
+        assert len(mass_spectrum) == 1
+    
+def test_batch_transient_processing(tmp_path):
+    
+    d_directory_location = tmp_path / "ser_experiment.d"
+    
+    create_ser_experiment(d_directory_location, scans_count=5)
+
+    mass_spectra = []
+
+    # the last batch has one scan
+    for fft_batch_size in (1, 2, 4):
+
+        MSParameters.transient.fft_batch_size = fft_batch_size
+        
+        lcms_reader = ReadBruker_SolarixTransientMassSpectra(d_directory_location)
+        lcms_reader.run()
+        
+        lcms = lcms_reader.get_lcms_obj()
+        
+        mass_spectra.append([[(mspeak.mz_exp, mspeak.abundance) for mspeak in lcms[scan_number]] for scan_number in lcms.scans_number])
+    
+    MSParameters.transient.fft_batch_size = 1
+
+    assert lcms.scans_number == [1, 2, 3, 4, 5]
+    
+    for batch_mass_spectra in mass_spectra[1:]:
+        
+        for batch_peaks, peaks in zip(batch_mass_spectra, mass_spectra[0]):
+            
+            assert len(batch_peaks) == len(peaks) == 1
+            assert batch_peaks[0] == pytest.approx(peaks[0])
+
+def test_parallel_scan_processing(tmp_path):
+    
+    d_directory_location = tmp_path / "ser_experiment.d"
+    
+    create_ser_experiment(d_directory_location, scans_count=5)
+
+    mass_spectra = []
+
+    for scan_jobs, fft_batch_size in ((1, 1), (2, 1), (2, 2)):
+
+        MSParameters.transient.scan_jobs = scan_jobs
+        MSParameters.transient.fft_batch_size = fft_batch_size
+        
+        lcms_reader = ReadBruker_SolarixTransientMassSpectra(d_directory_location)
+        lcms_reader.run()
+        
+        lcms = lcms_reader.get_lcms_obj()
+        
+        mass_spectra.append([(mass_spec.scan_number, mass_spec.rt, mass_spec.baselise_noise, 
+                              [(mspeak.mz_exp, mspeak.abundance, mspeak.resolving_power, mspeak.signal_to_noise, mspeak.freq_exp) for mspeak in mass_spec]) 
+                             for mass_spec in lcms])
+    
+    MSParameters.transient.scan_jobs = 1
+    MSParameters.transient.fft_batch_size = 1
+
+    assert lcms.scans_number == [1, 2, 3, 4, 5]
+    assert mass_spectra[0][0][3]
+    assert mass_spectra[1] == mass_spectra[0]
+    assert [mass_spec[:2] for mass_spec in mass_spectra[2]] == [mass_spec[:2] for mass_spec in mass_spectra[0]]
+
+def test_coadded_transient(tmp_path):
+    
+    d_directory_location = tmp_path / "ser_experiment.d"
+    
+    scans = create_ser_experiment(d_directory_location)
+
+    bruker_reader = ReadBrukerSolarix(d_directory_location)
+
+    # scans 1 and 2 by retention time
+    coadded_transient = bruker_reader.get_coadded_transient(rt_range=(0.5, 1.0))
+
+    assert coadded_transient._transient_data == pytest.approx((scans[0] + scans[1].astype(float)) / 2)
+    assert coadded_transient.d_params["rt"] == 0.75
+
+    mass_spectrum = bruker_reader.get_coadded_mass_spectrum(scans_numbers=[1, 2, 3])
+
+    # one ion per scan
+    assert len(mass_spectrum) == 3
+    
+    with pytest.raises(Exception):
+        bruker_reader.get_coadded_transient(rt_range=(10, 20))
+
 def test_andi_netcdf_gcms():
 
     file_path = Path.cwd() / "tests/tests_data/gcms/" / "GCMS_FAMES_01_GCMS-01_20191023.cdf"
@@ -7,11 +7,14 @@ import time
 from pathlib import Path
 sys.path.append('.')
 
-from numpy import array
+from numpy import array, exp, linspace, random, where
 import pytest
 
 from corems.transient.input.brukerSolarix import ReadBrukerSolarix
+from corems.mass_spectrum.input.numpyArray import ms_from_array_centroid, ms_from_array_profile
 from corems.encapsulation.factory.processingSetting  import MassSpectrumSetting, TransientSetting
+from corems.encapsulation.factory.parameters import MSParameters
+from corems.encapsulation.constant import Labels
 
 def test_create_mass_spectrum():
     
@@ -65,6 +68,123 @@ def test_create_mass_spectrum():
     
     return mass_spectrum_obj, kendrick_group_index
     
+def test_mz_index():
+
+    mz = [301.5, 215.09269, 216.09604, 255.1, 215.09280]
+    abundance = [1, 100, 11, 50, 20]
+    rp, s2n = [1] * 5, [1] * 5
+    mass_spectrum_obj = ms_from_array_centroid(mz, abundance, rp, s2n, 'mz index')
+
+    assert list(mass_spectrum_obj.get_mz_index()[0]) == sorted(mass_spectrum_obj.mz_exp)
+
+    indexes = mass_spectrum_obj.get_mz_range_indexes(array([215.09, 216.0, 400]), array([215.1, 216.1, 401]))
+    assert [list(mspeak_indexes) for mspeak_indexes in indexes] == [[1, 4], [2], []]
+
+    # index follows the filters
+    mass_spectrum_obj.filter_by_mz(0, 216)
+    assert [list(i) for i in mass_spectrum_obj.get_mz_range_indexes(array([216.0]), array([216.1]))] == [[1]]
+
+    # and the calibration
+    mass_spectrum_obj.reset_indexes()
+    mass_spectrum_obj.mz_cal = mass_spectrum_obj.mz_exp + 1
+    assert [list(i) for i in mass_spectrum_obj.get_mz_range_indexes(array([302.4]), array([302.6]))] == [[0]]
+
+def test_peak_table():
+
+    mz = [301.5, 215.09269, 216.09604, 255.1]
+    abundance = [1, 100, 11, 50]
+    rp, s2n = [1] * 4, [5, 10, 15, 20]
+    mass_spectrum_obj = ms_from_array_centroid(mz, abundance, rp, s2n, 'peak table')
+
+    # mspeak objs are views over the peak table rows
+    mass_spectrum_obj[1].abundance = 200
+    assert mass_spectrum_obj.abundance[1] == 200
+    assert mass_spectrum_obj.most_abundant_mspeak is mass_spectrum_obj[1]
+
+    mass_spectrum_obj.filter_by_s2n(12, 100)
+    assert list(mass_spectrum_obj.mz_exp) == [301.5, 215.09269]
+    assert [mspeak.index for mspeak in mass_spectrum_obj] == [0, 1]
+
+    mass_spectrum_obj.reset_indexes()
+    assert list(mass_spectrum_obj.signal_to_noise) == s2n
+
+def simulated_profile(seed=1):
+
+    random.seed(seed)
+    mz = linspace(200, 400, 200000)
+    abundance = random.normal(5, 0.3, mz.size)
+    for center in random.uniform(205, 395, 200):
+        sigma = center / random.uniform(2e5, 6e5) / 2.355
+        abundance += random.uniform(5, 1000) * exp(-0.5 * ((mz - center) / sigma) ** 2)
+
+    return mz, abundance
+
+def test_vectorized_centroid():
+
+    mz, abundance = simulated_profile()
+    
+    mass_spectrum_obj = ms_from_array_profile(mz, abundance, 'vectorized centroid', auto_process=False)
+    
+    apexes = where((abundance[1:-1] > abundance[:-2]) & (abundance[1:-1] > abundance[2:]) & (abundance[1:-1] > 20))[0] + 1
+    
+    start_indexes, final_indexes = mass_spectrum_obj.find_minima_indexes(apexes, abundance, len(abundance))
+    resolving_powers = mass_spectrum_obj.calculate_resolving_powers(abundance, mz, apexes)
+    mz_centroid = mass_spectrum_obj.fit_quadratic_apexes(mz, abundance, apexes)
+    
+    # compares to the per apex polyfit path
+    MSParameters.ms_peak.peak_interpolation_method = 'polyfit'
+    
+    try:
+        for i, apex in enumerate(apexes):
+            
+            assert start_indexes[i] == mass_spectrum_obj.find_minima(apex, abundance, len(abundance), right=False)
+            assert final_indexes[i] == mass_spectrum_obj.find_minima(apex, abundance, len(abundance), right=True)
+            assert resolving_powers[i] == pytest.approx(mass_spectrum_obj.calculate_resolving_power(abundance, mz, apex), rel=1e-7)
+            
+            mz_apex = mass_spectrum_obj.find_apex_fit_quadratic(mz, abundance, None, apex, len(abundance), lambda hi, li: 100)[0]
+            assert mz_centroid[i] == pytest.approx(mz_apex, rel=1e-8)
+    
+    finally:
+        MSParameters.ms_peak.peak_interpolation_method = 'analytic'
+
+def test_peak_interpolation_methods():
+
+    mz, abundance = simulated_profile(seed=2)
+    # stand-in for the frequency domain, decreasing with m/z as in FT-ICR data
+    freq = 1e8 / mz
+
+    results = {}
+    
+    try:
+        for method in ('analytic', 'polyfit'):
+            
+            MSParameters.ms_peak.peak_interpolation_method = method
+            
+            for label in (Labels.thermo_profile, Labels.bruker_frequency):
+
+                mass_spectrum_obj = ms_from_array_profile(mz, abundance, 'interpolation', auto_process=False, data_type=label)
+                mass_spectrum_obj.cal_noise_threshold()
+                mass_spectrum_obj.calc_centroid(mz, abundance.copy(), freq)
+                
+                results[(method, label)] = array([(mspeak.mz_exp, mspeak.abundance, mspeak.resolving_power, 
+                                                   mspeak.signal_to_noise, mspeak.freq_exp or 0) 
+                                                   for mspeak in mass_spectrum_obj._mspeaks])
+
+        with pytest.raises(Exception):
+            MSParameters.ms_peak.peak_interpolation_method = 'spline'
+            mass_spectrum_obj.calc_centroid(mz, abundance.copy(), freq)
+    
+    finally:
+        MSParameters.ms_peak.peak_interpolation_method = 'analytic'
+
+    for label in (Labels.thermo_profile, Labels.bruker_frequency):
+        
+        analytic, polyfit = results[('analytic', label)], results[('polyfit', label)]
+        
+        assert len(analytic) > 100
+        assert analytic.shape == polyfit.shape
+        assert analytic == pytest.approx(polyfit, rel=1e-7)
+
 
 if __name__ == "__main__":
     #mass_spectrum_obj, kendrick_group_index = test_create_mass_spectrum()
@@ -46,8 +46,47 @@ def test_molecular_formula():
               "prob_ratio:", isotopologue_obj.prob_ratio)
       '''
 
+def test_isotopologue_patterns():
+    
+    from corems.molecular_formula.calc.MolecularFormulaCalc import IsotopologuePatterns
+
+    IsotopologuePatterns.clear()
+
+    formulas = [{'C':10, 'H':h, 'O':10, 'Cl':2, Labels.ion_type: 'Radical'} for h in (0, 2, 4)]
+    
+    patterns = [IsotopologuePatterns.get_pattern(formula_dict, 1 - (1/500)) for formula_dict in formulas]
+    
+    # hydrogen is not part of the pattern, all formulas share the same composition
+    assert patterns[0] is patterns[1] is patterns[2]
+    
+    pattern = patterns[0]
+    
+    assert pattern.isotopes_count.shape == (len(pattern), len(pattern.isotopes_labels))
+    assert pattern.formula_dict(pattern.index_mono, formulas[1]) == formulas[1]
+    assert pattern.relative_abundances[pattern.index_mono] == 1
+    
+    isotopologues = list(MolecularFormula(formulas[0], 1).isotopologues(0.01, 1, 500))
+    
+    assert isotopologues[0].string == 'C10 O10 Cl1 37Cl1'
+
+def test_lazy_molecular_formula():
+
+    formula_obj = MolecularFormula({'C':10, 'H':20, 'O':4}, -1, ion_type=Labels.protonated_de_ion)
+
+    # slotted, no instance dict
+    assert not hasattr(formula_obj, '__dict__')
+    with pytest.raises(AttributeError):
+        formula_obj.not_a_formula_attribute = 1
+
+    mz_calc = formula_obj.mz_calc
+    assert formula_obj.mz_calc is mz_calc
+    assert formula_obj.kmd == formula_obj._calc_kdm({'C':1, 'H':2})[0]
+    assert formula_obj.isotopologue_count_percentile == 100
+
+    # the cached values follow the ion type
+    formula_obj.ion_type = Labels.radical_ion
+    assert formula_obj.mz_calc == pytest.approx(mz_calc + 1.007825, abs=1e-5)
+    assert formula_obj.kendrick_mass == formula_obj._calc_kdm({'C':1, 'H':2})[1]
+
 if __name__ == "__main__":
       test_molecular_formula()
-   
-
-    
\ No newline at end of file
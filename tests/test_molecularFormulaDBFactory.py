@@ -4,15 +4,29 @@ __date__ = "Jul 22, 2019"
 
 import pickle
 
+from sqlalchemy import func
+
 from pathlib import Path
 import time, sys, os, pytest
 sys.path.append(".")
 
 from corems.encapsulation.constant import Labels
 from corems.molecular_id.factory.MolecularLookupTable import  MolecularCombinations
-from corems.molecular_id.factory.molecularSQL import MolForm_SQL
+from corems.molecular_id.factory.molecularSQL import HeteroAtoms, MolecularFormulaLink, MolForm_SQL, class_partition_ddl, get_class_dict, partitioned_table_ddl
+from corems.molecular_id.factory.MolecularFormulaIndex import MolecularFormulaIndex
+from corems.molecular_id.factory.EngineRegistry import EngineRegistry
 from corems.molecular_id.input.nistMSI import ReadNistMSI
-from corems.encapsulation.factory.processingSetting  import MolecularFormulaSearchSettings
+from corems.encapsulation.factory.processingSetting  import MolecularFormulaSearchSettings, MolecularLookupDictSettings
+from corems.encapsulation.factory.parameters import MSParameters
+
+def sqlite_url(tmp_path, name):
+
+    return 'sqlite:///{}'.format(tmp_path / name)
+
+def pin_valences(monkeypatch):
+    
+    # the class DBE uses the global valences, other test modules change them
+    monkeypatch.setattr(MSParameters.molecular_search, 'used_atom_valences', MolecularFormulaSearchSettings().used_atom_valences)
 
 def test_nist_to_sql():
 
@@ -37,6 +51,296 @@ def test_query_sql():
         
         #print('total mol formulas found: ', len(list( results.get(classe[0]).get(301))))
 
+def test_formula_index_matches_sql(tmp_path, monkeypatch):
+
+    pin_valences(monkeypatch)
+
+    molecular_search_settings = MolecularFormulaSearchSettings()
+    molecular_search_settings.url_database = sqlite_url(tmp_path, 'molformula.db')
+    molecular_search_settings.db_jobs = 1
+    molecular_search_settings.usedAtoms = {'C': (1, 50), 'H': (4, 100), 'O': (0, 10), 'N': (0, 1), 'Cl': (0, 1)}
+    molecular_search_settings.isAdduct = True
+
+    nominal_mzs = list(range(100, 600))
+
+    with MolForm_SQL(url=molecular_search_settings.url_database) as sqldb:
+        
+        classes = [class_tuple[0] for class_tuple in MolecularCombinations(sqldb).runworker(molecular_search_settings)]
+        
+        formula_index = MolecularFormulaIndex.from_sql_db(sqldb)
+
+        # built for the current database stamp, reused until the lookup tables change
+        assert formula_index.stamp == sqldb.get_database_stamp()
+        assert MolecularFormulaIndex.from_sql_db(sqldb) is formula_index
+
+        def formulas_by_nominal(dict_res):
+            return {classe: {nominal_mz: sorted(formula.formula_string for formula in formulas) for nominal_mz, formulas in by_nominal.items()} for classe, by_nominal in dict_res.items()}
+
+        for ion_charge in (-1, +1):
+            
+            for ion_type in (Labels.protonated_de_ion, Labels.radical_ion):
+                
+                sql_res = sqldb.get_dict_by_classes(classes, ion_type, nominal_mzs, ion_charge, molecular_search_settings)
+                index_res = formula_index.get_dict_by_classes(classes, ion_type, nominal_mzs, ion_charge, molecular_search_settings)
+                
+                assert sql_res
+                assert formulas_by_nominal(sql_res) == formulas_by_nominal(index_res)
+
+            sql_res = sqldb.get_dict_by_classes(classes, Labels.adduct_ion, nominal_mzs, ion_charge, molecular_search_settings, adducts=['Cl'])
+            index_res = formula_index.get_dict_by_classes(classes, Labels.adduct_ion, nominal_mzs, ion_charge, molecular_search_settings, adducts=['Cl'])
+            
+            assert formulas_by_nominal(sql_res['Cl']) == formulas_by_nominal(index_res['Cl'])
+
+        # stored nominal m/z columns
+        for formula in sqldb.session.query(MolecularFormulaLink).limit(1000):
+            assert formula.protonated_neg == int(formula.protonated_mass(-1))
+            assert formula.radical_pos == int(formula.radical_mass(+1))
+
+        # longer than the SQLite bound parameters limit
+        long_classes = classes + ['{"X": %d}' % i for i in range(1000)]
+        
+        sql_res = sqldb.get_dict_by_classes(long_classes, Labels.protonated_de_ion, list(range(0, 1500)), -1, molecular_search_settings)
+        index_res = formula_index.get_dict_by_classes(classes, Labels.protonated_de_ion, list(range(0, 1500)), -1, molecular_search_settings)
+
+        assert sql_res
+        assert formulas_by_nominal(sql_res) == formulas_by_nominal(index_res)
+
+def test_parallel_database_generation(tmp_path, monkeypatch):
+
+    pin_valences(monkeypatch)
+
+    formulas = []
+
+    for db_jobs, url in ((1, sqlite_url(tmp_path, 'molformula_serial.db')), (2, sqlite_url(tmp_path, 'molformula_parallel.db'))):
+        
+        molecular_search_settings = MolecularFormulaSearchSettings()
+        molecular_search_settings.url_database = url
+        molecular_search_settings.db_jobs = db_jobs
+        molecular_search_settings.usedAtoms = {'C': (1, 40), 'H': (4, 80), 'O': (0, 8), 'N': (0, 2), 'S': (0, 1)}
+
+        with MolForm_SQL(url=url) as sqldb:
+            
+            MolecularCombinations(sqldb).runworker(molecular_search_settings)
+            
+            formulas.append(sorted((formula.classe_string, formula.formula_string) for formula in sqldb.session.query(MolecularFormulaLink)))
+
+    assert formulas[0]
+    assert formulas[0] == formulas[1]
+
+def test_parallel_database_generation_sqlite_single_writer(tmp_path, monkeypatch):
+
+    pin_valences(monkeypatch)
+
+    # enough classes and rows for the workers chunks to overlap, SQLite allows one writer at a time
+    used_atoms = {'C': (1, 90), 'H': (4, 200), 'O': (0, 22), 'N': (0, 3), 'S': (0, 2), 'P': (0, 1)}
+
+    rows_by_class = []
+
+    for db_jobs in (1, 4):
+        
+        molecular_search_settings = MolecularFormulaSearchSettings()
+        molecular_search_settings.url_database = sqlite_url(tmp_path, 'molformula_{}_jobs.db'.format(db_jobs))
+        molecular_search_settings.db_jobs = db_jobs
+        molecular_search_settings.usedAtoms = used_atoms
+
+        with MolForm_SQL(url=molecular_search_settings.url_database) as sqldb:
+            
+            MolecularCombinations(sqldb).runworker(molecular_search_settings)
+            
+            rows_by_class.append(sorted(sqldb.session.query(HeteroAtoms.name, func.count(MolecularFormulaLink.carbonHydrogen_id))
+                                                     .filter(MolecularFormulaLink.heteroAtoms_id == HeteroAtoms.id).group_by(HeteroAtoms.name)))
+
+    assert len(rows_by_class[0]) > 100
+    assert sum(count for _, count in rows_by_class[0]) > 200000
+    assert rows_by_class[0] == rows_by_class[1]
+
+def test_generated_formulas_match_loop_generation(tmp_path, monkeypatch):
+
+    pin_valences(monkeypatch)
+
+    url = sqlite_url(tmp_path, 'molformula_generation.db')
+
+    molecular_search_settings = MolecularFormulaSearchSettings()
+    molecular_search_settings.url_database = url
+    molecular_search_settings.db_jobs = 1
+    molecular_search_settings.usedAtoms = {'C': (1, 30), 'H': (4, 60), 'O': (0, 6), 'N': (0, 2), 'P': (0, 1)}
+
+    with MolForm_SQL(url=url) as sqldb:
+        
+        molecular_combinations = MolecularCombinations(sqldb)
+        molecular_combinations.runworker(molecular_search_settings)
+
+        settings = MolecularLookupDictSettings()
+        settings.usedAtoms = molecular_search_settings.usedAtoms
+
+        stored_rows = sorted(sqldb.session.query(MolecularFormulaLink.heteroAtoms_id, MolecularFormulaLink.carbonHydrogen_id, 
+                                                 MolecularFormulaLink.mass, MolecularFormulaLink.DBE))
+
+        # previous generation path, one formula at a time
+        loop_rows = []
+        
+        for classe_obj in sqldb.session.query(HeteroAtoms):
+            
+            class_dict = classe_obj.to_dict()
+            class_dict.pop('HC', None)
+
+            class_mass = molecular_combinations.calc_mz(class_dict)
+            class_dbe = molecular_combinations.calc_dbe_class(class_dict)
+
+            for ch_obj in molecular_combinations.get_carbonsHydrogens(settings, molecular_combinations.get_h_odd_or_even(class_dict)):
+                
+                mass = ch_obj.mass + class_mass
+                dbe = ch_obj.dbe + class_dbe
+
+                if settings.min_mz <= mass <= settings.max_mz:
+                    if settings.min_dbe <= dbe <= settings.max_dbe:
+                        loop_rows.append((classe_obj.id, ch_obj.id, mass, dbe))
+
+        assert stored_rows
+        assert stored_rows == sorted(loop_rows)
+
+def test_upgrade_nominal_mz_columns(tmp_path, monkeypatch):
+
+    pin_valences(monkeypatch)
+
+    url = sqlite_url(tmp_path, 'molformula_old_schema.db')
+
+    molecular_search_settings = MolecularFormulaSearchSettings()
+    molecular_search_settings.url_database = url
+    molecular_search_settings.db_jobs = 1
+    molecular_search_settings.usedAtoms = {'C': (1, 30), 'H': (4, 60), 'O': (0, 6)}
+
+    nominal_mzs = list(range(100, 500))
+
+    def formulas_by_nominal(sqldb, classes):
+        return [{classe: {nominal_mz: sorted(formula.formula_string for formula in formulas) for nominal_mz, formulas in by_nominal.items()} 
+                 for classe, by_nominal in sqldb.get_dict_by_classes(classes, ion_type, nominal_mzs, ion_charge, molecular_search_settings).items()}
+                for ion_type, ion_charge in ((Labels.protonated_de_ion, +1), (Labels.radical_ion, -1))]
+
+    with MolForm_SQL(url=url) as sqldb:
+        
+        classes = [class_tuple[0] for class_tuple in MolecularCombinations(sqldb).runworker(molecular_search_settings)]
+        
+        assert sqldb.use_nominal_mz_columns()
+        
+        expected = formulas_by_nominal(sqldb, classes)
+
+        # molecularformula table created before the stored nominal m/z columns
+        sqldb.session.close()
+        
+        with sqldb.engine.begin() as connection:
+            connection.execute('CREATE TABLE molecularformula_old AS SELECT "heteroAtoms_id", "carbonHydrogen_id", mass, "DBE" FROM molecularformula')
+            connection.execute('DROP TABLE molecularformula')
+            connection.execute('ALTER TABLE molecularformula_old RENAME TO molecularformula')
+
+    EngineRegistry.dispose_all()
+
+    with MolForm_SQL(url=url) as sqldb:
+        
+        # the search calculates the nominal m/z from the mass
+        assert not sqldb.use_nominal_mz_columns()
+        assert formulas_by_nominal(sqldb, classes) == expected
+
+        # new classes are inserted without the missing columns
+        new_settings = MolecularFormulaSearchSettings()
+        new_settings.url_database = url
+        new_settings.db_jobs = 1
+        new_settings.usedAtoms = {'C': (1, 30), 'H': (4, 60), 'O': (0, 6), 'N': (0, 1)}
+        
+        assert len(MolecularCombinations(sqldb).runworker(new_settings)) > len(classes)
+        
+        sqldb.upgrade_nominal_mz_columns()
+        
+        assert sqldb.use_nominal_mz_columns()
+        assert formulas_by_nominal(sqldb, classes) == expected
+
+        # interrupted fill, only the missing values are filled again
+        sqldb.session.close()
+        
+        with sqldb.engine.begin() as connection:
+            connection.execute('UPDATE molecularformula SET protonated_pos = NULL WHERE mass > 300')
+        
+        EngineRegistry.dispose_all()
+    
+    with MolForm_SQL(url=url) as sqldb:
+        
+        assert not sqldb.use_nominal_mz_columns()
+        
+        sqldb.upgrade_nominal_mz_columns()
+        
+        assert sqldb.use_nominal_mz_columns()
+        assert formulas_by_nominal(sqldb, classes) == expected
+
+def test_engine_registry(tmp_path):
+
+    url = sqlite_url(tmp_path, 'molformula.db')
+
+    with MolForm_SQL(url=url) as sqldb:
+        engine = sqldb.engine
+
+    # closing the sql obj keeps the engine and its pool
+    with MolForm_SQL(url=url) as sqldb:
+        assert sqldb.engine is engine
+        assert sqldb.session.query(HeteroAtoms).count() >= 0
+
+    # the pool is set by the first sql obj of the url
+    with pytest.warns(UserWarning, match='pool_size=2'):
+        with MolForm_SQL(url=url, pool_size=2) as sqldb:
+            assert sqldb.engine is engine
+
+    # a forked process creates its own engine
+    registry_key = (url, None, os.getpid())
+    EngineRegistry._engines[(url, None, -1)] = EngineRegistry._engines.pop(registry_key)
+    
+    with MolForm_SQL(url=url) as sqldb:
+        assert sqldb.engine is not engine
+        assert (url, None, -1) not in EngineRegistry._engines
+
+    # in memory databases are private
+    assert MolForm_SQL(url='sqlite://').engine is not MolForm_SQL(url='sqlite://').engine
+
+def test_partition_by_class_ddl():
+
+    from sqlalchemy.dialects import postgresql
+    from sqlalchemy.schema import CreateTable
+
+    # the partitioning is PostgreSQL only, SQLite databases are not partitioned
+    with MolForm_SQL(url='sqlite://', partition_by_class=True) as sqldb:
+        assert not sqldb.is_partitioned()
+        
+        # nothing to create for the new classes
+        sqldb.add_class_partitions([1, 2])
+        
+        with pytest.raises(Exception):
+            sqldb.create_partitioned_table(sqldb.engine)
+
+    statements = partitioned_table_ddl(postgresql.dialect())
+    
+    assert statements[0].startswith('CREATE TABLE IF NOT EXISTS molecularformula (')
+    assert statements[0].endswith(') PARTITION BY LIST ("heteroAtoms_id")')
+    assert sorted(statement.split()[5] for statement in statements[1:]) == sorted(index.name for index in MolecularFormulaLink.__table__.indexes)
+
+    assert class_partition_ddl(12) == 'CREATE TABLE IF NOT EXISTS "molecularformula_12" PARTITION OF "molecularformula" FOR VALUES IN (12)'
+
+    # the shared table is not changed
+    assert 'PARTITION BY' not in str(CreateTable(MolecularFormulaLink.__table__).compile(dialect=postgresql.dialect()))
+
+def test_class_dict():
+
+    classe = '{"O": 2, "N": 1}'
+
+    # parsed once, the same read only mapping for all the formulas of the class
+    assert get_class_dict(classe) is get_class_dict(''.join(classe))
+    assert dict(get_class_dict(classe)) == {"O": 2, "N": 1}
+    
+    with pytest.raises(TypeError):
+        get_class_dict(classe)['O'] = 3
+
+    hetero_atoms = HeteroAtoms(name=classe)
+    class_dict = hetero_atoms.to_dict()
+    class_dict['O'] = 3
+    assert hetero_atoms.to_dict() == {"O": 2, "N": 1}
+
 def generate_database():
     
     '''corems_parameters_file: Path for CoreMS JSON Parameters file
@@ -5,6 +5,7 @@ __date__ = "Jul 25, 2019"
 import sys
 sys.path.append('.')
 
+import threading
 import time
 from pathlib import Path
 
@@ -12,7 +13,7 @@ import pytest
 
 from corems.molecular_id.factory.classification import  HeteroatomsClassification
 from corems.mass_spectrum.input.numpyArray import ms_from_array_centroid
-from corems.molecular_id.search.molecularFormulaSearch import SearchMolecularFormulas
+from corems.molecular_id.search.molecularFormulaSearch import SearchMolecularFormulas, formula_cache
 from corems.molecular_id.search.priorityAssignment import OxygenPriorityAssignment
 from corems.transient.input.brukerSolarix import ReadBrukerSolarix
 from corems.encapsulation.factory.parameters import MSParameters
@@ -63,6 +64,230 @@ def test_run_molecular_formula_search():
         for formula in ms_peak:
             print(formula.string_formated, formula.mz_error)
 
+def test_batch_search_matches_serial_search():
+    
+    mz = [215.09269, 245.02932, 259.04543, 287.07606]
+    abundance = [1, 1, 1, 1]
+    rp, s2n = [1, 1, 1, 1], [1, 1, 1, 1]
+    
+    used_atoms = MSParameters.molecular_search.usedAtoms
+    MSParameters.molecular_search.usedAtoms = {'C': (1, 90), 'H': (4, 200), 'O': (0, 12)}
+    
+    assignments = []
+    
+    for use_batch_search in (True, False):
+        
+        MSParameters.molecular_search.use_batch_search = use_batch_search
+        
+        mass_spectrum_obj = ms_from_array_centroid(mz, abundance, rp, s2n, 'batch search')
+        
+        SearchMolecularFormulas(mass_spectrum_obj, find_isotopologues=False).run_worker_mass_spectrum()
+        
+        assignments.append([sorted(formula.string for formula in ms_peak) for ms_peak in mass_spectrum_obj])
+    
+    MSParameters.molecular_search.use_batch_search = True
+    MSParameters.molecular_search.usedAtoms = used_atoms
+    
+    assert any(assignments[0])
+    assert assignments[0] == assignments[1]
+
+def test_parallel_search_matches_serial_search():
+    
+    # 216.09604 is the 13C isotopologue of C10 H16 O5, 301.5 lowers the min abundance 
+    mz = [215.09269, 216.09604, 245.02932, 259.04543, 287.07606, 301.5]
+    abundance = [100, 11, 100, 100, 100, 1]
+    rp, s2n = [1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 1, 1]
+    
+    used_atoms = MSParameters.molecular_search.usedAtoms
+    MSParameters.molecular_search.usedAtoms = {'C': (1, 90), 'H': (4, 200), 'O': (0, 12), 'N': (0, 1)}
+    
+    assignments = []
+    
+    for search_jobs in (2, 1):
+        
+        MSParameters.molecular_search.search_jobs = search_jobs
+        
+        mass_spectrum_obj = ms_from_array_centroid(mz, abundance, rp, s2n, 'parallel search')
+        
+        SearchMolecularFormulas(mass_spectrum_obj).run_worker_mass_spectrum()
+        
+        assignments.append([[(formula.string, formula.is_isotopologue, len(formula.mspeak_mf_isotopologues_indexes)) for formula in ms_peak] for ms_peak in mass_spectrum_obj])
+    
+    MSParameters.molecular_search.search_jobs = 1
+    MSParameters.molecular_search.usedAtoms = used_atoms
+    
+    assert assignments[0][1] == [('C9 H16 O5 13C1', True, 0)]
+    assert assignments[0] == assignments[1]
+    
+def test_batch_confidence_scores():
+    
+    mz = [215.09269, 216.09604, 245.02932, 259.04543, 287.07606, 301.5]
+    abundance = [100, 11, 100, 100, 100, 1]
+    rp, s2n = [1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 1, 1]
+    
+    used_atoms = MSParameters.molecular_search.usedAtoms
+    MSParameters.molecular_search.usedAtoms = {'C': (1, 90), 'H': (4, 200), 'O': (0, 12), 'N': (0, 1)}
+    
+    mass_spectrum_obj = ms_from_array_centroid(mz, abundance, rp, s2n, 'batch scores')
+    
+    SearchMolecularFormulas(mass_spectrum_obj).run_worker_mass_spectrum()
+    
+    MSParameters.molecular_search.usedAtoms = used_atoms
+
+    formulas = [formula for ms_peak in mass_spectrum_obj for formula in ms_peak]
+    
+    scores = [(formula.mz_error_score, formula.isotopologue_similarity, formula.average_mz_error_score, formula.confidence_score) for formula in formulas]
+    
+    for formula in formulas:
+        formula._mz_error_score = formula._isotopologue_similarity = None
+        formula._mass_error_average_score = formula._confidence_score = None
+    
+    mass_spectrum_obj.score_molecular_formulas()
+
+    assert any(formula.is_isotopologue for formula in formulas)
+    
+    for formula, formula_scores in zip(formulas, scores):
+        assert (formula._mz_error_score, formula._isotopologue_similarity, 
+                formula._mass_error_average_score, formula._confidence_score) == pytest.approx(formula_scores)
+
+def test_formula_cache():
+    
+    mz = [215.09269, 245.02932, 259.04543, 287.07606]
+    abundance = [1, 1, 1, 1]
+    rp, s2n = [1, 1, 1, 1], [1, 1, 1, 1]
+    
+    used_atoms = MSParameters.molecular_search.usedAtoms
+    cache_bytes = MSParameters.molecular_search.formula_cache_bytes
+    MSParameters.molecular_search.usedAtoms = {'C': (1, 90), 'H': (4, 200), 'O': (0, 12)}
+    
+    formula_cache.clear()
+
+    assignments = []
+    
+    for formula_cache_bytes in (0, cache_bytes, cache_bytes):
+        
+        MSParameters.molecular_search.formula_cache_bytes = formula_cache_bytes
+        
+        mass_spectrum_obj = ms_from_array_centroid(mz, abundance, rp, s2n, 'formula cache')
+        
+        SearchMolecularFormulas(mass_spectrum_obj, find_isotopologues=False).run_worker_mass_spectrum()
+        
+        assignments.append([sorted(formula.string for formula in ms_peak) for ms_peak in mass_spectrum_obj])
+
+    # one entry per class, classes are HC and O1 to O12
+    assert len(formula_cache) == 13
+    
+    # loaded for the nominal m/z range of the mass spectrum, a wider range reloads the classes
+    assert all(candidates.nominal_range == (215, 287) for candidates in formula_cache.candidates.values())
+    
+    mass_spectrum_obj = ms_from_array_centroid(mz + [331.10235], abundance + [1], rp + [1], s2n + [1], 'formula cache')
+    SearchMolecularFormulas(mass_spectrum_obj, find_isotopologues=False).run_worker_mass_spectrum()
+    
+    assert all(candidates.nominal_range == (215, 331) for candidates in formula_cache.candidates.values())
+
+    # the formula objs size includes the attributes, not only the obj header
+    candidates = next(candidates for candidates in formula_cache.candidates.values() if len(candidates))
+    assert candidates.formula_nbytes(candidates.formulas) > sys.getsizeof(candidates.formulas[0]) + 100
+    
+    # least recently used classes are evicted to stay under the budget
+    MSParameters.molecular_search.formula_cache_bytes = formula_cache.nbytes // 2
+    mass_spectrum_obj = ms_from_array_centroid(mz, abundance, rp, s2n, 'formula cache')
+    SearchMolecularFormulas(mass_spectrum_obj, find_isotopologues=False).run_worker_mass_spectrum()
+    
+    assert 0 < formula_cache.nbytes <= MSParameters.molecular_search.formula_cache_bytes
+    
+    formula_cache.clear()
+    MSParameters.molecular_search.formula_cache_bytes = cache_bytes
+    MSParameters.molecular_search.usedAtoms = used_atoms
+    
+    assert any(assignments[0])
+    assert assignments[0] == assignments[1] == assignments[2]
+
+def test_search_error_state():
+    
+    mz = [215.09269, 245.02932, 259.04543, 287.07606]
+    abundance = [1, 1, 1, 1]
+    rp, s2n = [1, 1, 1, 1], [1, 1, 1, 1]
+    
+    used_atoms = MSParameters.molecular_search.usedAtoms
+    error_method = MSParameters.molecular_search.error_method
+    min_ppm_error = MSParameters.molecular_search.min_ppm_error
+    max_ppm_error = MSParameters.molecular_search.max_ppm_error
+    
+    MSParameters.molecular_search.usedAtoms = {'C': (1, 90), 'H': (4, 200), 'O': (0, 12)}
+    # moves the ppm window after every match
+    MSParameters.molecular_search.error_method = 'average'
+    
+    def search(assignments, key):
+        
+        mass_spectrum_obj = ms_from_array_centroid(mz, abundance, rp, s2n, 'error state')
+        
+        SearchMolecularFormulas(mass_spectrum_obj, find_isotopologues=False).run_worker_mass_spectrum()
+        
+        assignments[key] = [sorted(formula.string for formula in ms_peak) for ms_peak in mass_spectrum_obj]
+
+    assignments = {}
+    
+    try:
+        
+        search(assignments, 'serial')
+        
+        threads = [threading.Thread(target=search, args=(assignments, i)) for i in range(4)]
+        
+        for thread in threads: thread.start()
+        
+        for thread in threads: thread.join()
+    
+    finally:
+        
+        MSParameters.molecular_search.error_method = error_method
+        MSParameters.molecular_search.usedAtoms = used_atoms
+    
+    # the window is kept by each search, the settings are not changed
+    assert MSParameters.molecular_search.min_ppm_error == min_ppm_error
+    assert MSParameters.molecular_search.max_ppm_error == max_ppm_error
+    
+    assert any(assignments['serial'])
+    assert all(assignments[i] == assignments['serial'] for i in range(4))
+
+def test_mass_defect_buckets():
+    
+    # 216.09604 is the 13C isotopologue of C10 H16 O5, 301.5 lowers the min abundance 
+    mz = [215.09269, 216.09604, 245.02932, 259.04543, 287.07606, 301.5]
+    abundance = [100, 11, 100, 100, 100, 1]
+    rp, s2n = [1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 1, 1]
+    
+    used_atoms = MSParameters.molecular_search.usedAtoms
+    error_method = MSParameters.molecular_search.error_method
+    
+    MSParameters.molecular_search.usedAtoms = {'C': (1, 90), 'H': (4, 200), 'O': (0, 12)}
+    
+    assignments = []
+    
+    try:
+        for method in ('average', 'lowest'):
+            
+            MSParameters.molecular_search.error_method = method
+            
+            for use_mass_defect_buckets in (True, False):
+                
+                MSParameters.molecular_search.use_mass_defect_buckets = use_mass_defect_buckets
+                
+                mass_spectrum_obj = ms_from_array_centroid(mz, abundance, rp, s2n, 'mass defect buckets')
+                
+                SearchMolecularFormulas(mass_spectrum_obj).run_worker_mass_spectrum()
+                
+                assignments.append([sorted((formula.string, formula.is_isotopologue) for formula in ms_peak) for ms_peak in mass_spectrum_obj])
+    
+    finally:
+        MSParameters.molecular_search.use_mass_defect_buckets = True
+        MSParameters.molecular_search.error_method = error_method
+        MSParameters.molecular_search.usedAtoms = used_atoms
+    
+    assert any(assignments[0])
+    assert assignments[0] == assignments[1]
+    assert assignments[2] == assignments[3]
+
 def test_mspeak_search():
 
     mass_spec_obj = create_mass_spectrum()